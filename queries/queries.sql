@@ -1,4 +1,5 @@
 -- How many users were active on a given day
+-- (also available without scanning the snapshot with activity_index.daily_active_users / weekly_active_users / monthly_active_users)
 -- Option 1: specific day
  select count(*) as total_active_users
    from user_daily_snapshots u
@@ -0,0 +1,132 @@
+import pandas as pd
+import numpy as np
+import os
+from datetime import timedelta
+import util
+
+# Compact activity index: for each day, one compressed bitmap per kind of activity over integer user indexes.
+# User ids are mapped to integers by an append-only dictionary (user_id_map), so bit i of every bitmap refers to
+# the same user. Users without activity are just zero bits, so no rows are written for inactive users.
+ACTIVITY_KINDS = {
+    'active': 'is_active',
+    'deposited': 'qty_deposits',
+    'withdrew': 'qty_withdrawals',
+    'logged_in': 'qty_logins'
+}
+
+
+def user_id_map_table_name():
+    return 'user_id_map'
+
+def bitmap_file_path(date):
+    return 'data-lake/curated/activity_bitmap/' + date.strftime('%Y-%m-%d') + '.npz'
+
+def read_user_id_map():
+    map_path = util.curated_file_path(user_id_map_table_name())
+    if util.resolve_file_path(map_path) is None:
+        return pd.DataFrame({'user_id': pd.Series(dtype=str), 'user_index': pd.Series(dtype='int64')})
+    return util.read_csv(map_path, dtype={'user_id': str, 'user_index': 'int64'})
+
+def assign_user_indexes(user_ids):
+    """
+    Returns the integer index of each user id, adding the ones not seen before to the end of the dictionary.
+    New ids are added in sorted order, so indexes don't depend on the order of the rows.
+    """
+    user_id_map = read_user_id_map()
+    new_user_ids = pd.Index(pd.unique(np.asarray(user_ids, dtype=object))).difference(user_id_map['user_id']).sort_values()
+
+    if len(new_user_ids) > 0:
+        new_df = pd.DataFrame({
+            'user_id': new_user_ids,
+            'user_index': np.arange(len(user_id_map), len(user_id_map) + len(new_user_ids), dtype='int64')
+        })
+        user_id_map = pd.concat([user_id_map, new_df], ignore_index=True)
+        util.write_csv(user_id_map, util.curated_file_path(user_id_map_table_name()))
+
+    return pd.Series(user_id_map['user_index'].to_numpy(), index=user_id_map['user_id']).loc[user_ids].to_numpy()
+
+def build_bitmap(user_indexes, size):
+    bits = np.zeros(size, dtype=bool)
+    bits[user_indexes] = True
+    return np.packbits(bits)
+
+def save_activity_bitmaps(date, user_daily_snapshot_df):
+    """
+    Writes the activity bitmaps of a day from the rows generated for user_daily_snapshot.
+    """
+    user_indexes = assign_user_indexes(user_daily_snapshot_df['user_id'].to_numpy())
+    size = int(user_indexes.max()) + 1 if len(user_indexes) > 0 else 0
+
+    bitmaps = {}
+    for kind, column in ACTIVITY_KINDS.items():
+        has_activity = user_daily_snapshot_df[column].to_numpy() > 0
+        bitmaps[kind] = build_bitmap(user_indexes[has_activity], size)
+
+    path = bitmap_file_path(date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(path, **bitmaps)
+
+def read_bitmap(date, kind='active'):
+    path = bitmap_file_path(date)
+    if not os.path.isfile(path):
+        return np.zeros(0, dtype=np.uint8)
+    with np.load(path) as bitmaps:
+        return bitmaps[kind]
+
+def combine(bitmaps, operation):
+    """
+    Combines packed bitmaps of different sizes (the dictionary grows over time) with a numpy bitwise operation.
+    """
+    size = max((len(bitmap) for bitmap in bitmaps), default=0)
+    result = None
+    for bitmap in bitmaps:
+        padded = np.zeros(size, dtype=np.uint8)
+        padded[:len(bitmap)] = bitmap
+        result = padded if result is None else operation(result, padded)
+    return result if result is not None else np.zeros(0, dtype=np.uint8)
+
+def count(bitmap):
+    return int(np.unpackbits(bitmap).sum())
+
+def active_users_bitmap(start_date, end_date, kind='active'):
+    """
+    Bitmap of users with activity of the given kind on any day between start_date and end_date (inclusive).
+    """
+    bitmaps = []
+    current_date = start_date
+    while current_date <= end_date:
+        bitmaps.append(read_bitmap(current_date, kind))
+        current_date += timedelta(days=1)
+    return combine(bitmaps, np.bitwise_or)
+
+def daily_active_users(date, kind='active'):
+    return count(read_bitmap(date, kind))
+
+def weekly_active_users(date, kind='active'):
+    # distinct users in the 7 days ending on date
+    return count(active_users_bitmap(date - timedelta(days=6), date, kind))
+
+def monthly_active_users(date, kind='active'):
+    # distinct users in the 30 days ending on date
+    return count(active_users_bitmap(date - timedelta(days=29), date, kind))
+
+def retention(cohort_date, return_date, kind='active'):
+    """
+    Share of the users with activity on cohort_date that also had activity on return_date.
+    """
+    cohort = read_bitmap(cohort_date, kind)
+    cohort_size = count(cohort)
+    if cohort_size == 0:
+        return 0.0
+    return count(combine([cohort, read_bitmap(return_date, kind)], np.bitwise_and)) / cohort_size
+
+def users_in_bitmap(bitmap):
+    """
+    Translates the bits set in a bitmap back to user ids.
+    """
+    user_indexes = np.flatnonzero(np.unpackbits(bitmap))
+    user_id_map = read_user_id_map().set_index('user_index')['user_id']
+    return user_id_map.loc[user_indexes].tolist()
+
+def active_on_both(first_date, second_date, kind='active'):
+    return users_in_bitmap(combine([read_bitmap(first_date, kind), read_bitmap(second_date, kind)], np.bitwise_and))
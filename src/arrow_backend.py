@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import os
+from datetime import datetime
+import util
+import catalog
+
+# Execution backend of the load steps on Arrow tables: same functions as pandas_backend.py, implemented with
+# pyarrow.compute kernels. CSV parsing, joins and group-bys run multithreaded in Arrow's thread pool.
+# Rows come out in the same order as pandas for filters, sorts, dedupes and concats; joins don't keep the order
+# of the left table, so outputs are the same rows as the pandas backend but may be in another order.
+NAME = 'arrow'
+
+arrow_types = {str: pa.string(), int: pa.int64(), float: pa.float64(), bool: pa.bool_(), pd.Timestamp: pa.timestamp('ns')}
+cast_types = {'int64': pa.int64(), 'float64': pa.float64(), 'bool': pa.bool_()}
+join_types = {'inner': 'inner', 'left': 'left outer', 'outer': 'full outer'}
+
+
+def read(table_name, layer, date=None, columns=None, predicates=None):
+    # predicates prune columns and filter after parsing (or skip the file, see catalog.py), the block index of
+    # curated tables is only used by pandas
+    spec = util.table_spec(table_name)
+    columns = columns or list(spec.schema.keys())
+    read_columns = columns + [col for col in util.predicate_columns(predicates or []) if col not in columns]
+    types = {col: arrow_types[spec.schema[col]] for col in read_columns}
+    partition_path = spec.file_path(layer, date)
+    path = util.resolve_file_path(partition_path)
+
+    if not util.partition_exists(partition_path) or (predicates and not catalog.may_match(table_name, layer, date, predicates)):
+        return pa.table({col: pa.array([], type=types[col]) for col in columns})
+
+    # the codec is detected from the extension, days of compacted partitions are read from their monthly file
+    if path is not None:
+        source = pa.input_stream(path, compression='detect')
+    else:
+        source = pa.BufferReader(util.read_compacted_days(partition_path, partition_path))
+    with source as stream:
+        table = pv.read_csv(stream, convert_options=pv.ConvertOptions(column_types=types, include_columns=read_columns,
+                                                                      strings_can_be_null=True))
+    return filter(table, predicates).select(columns) if predicates else table
+
+def write(table, path):
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # microseconds, as pandas writes them
+    for i, column in enumerate(table.schema):
+        if pa.types.is_timestamp(column.type):
+            table = table.set_column(i, column.name, pc.cast(table[column.name], pa.timestamp('us')))
+
+    with pa.output_stream(path, compression='detect') as stream:
+        pv.write_csv(table, stream, pv.WriteOptions(quoting_style='needed'))
+    util.remove_other_codec_copies(path)
+
+def from_pandas(df):
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+def to_pandas(table):
+    return table.to_pandas()
+
+def num_rows(table):
+    return table.num_rows
+
+def empty_like(table):
+    return table.slice(0, 0)
+
+def scalar(value, arrow_type):
+    # python and pandas timestamps as scalars of the type of the column they are compared to
+    if isinstance(value, (pd.Timestamp, datetime)) and pa.types.is_timestamp(arrow_type):
+        return pa.scalar(pd.Timestamp(value).to_datetime64()).cast(arrow_type)
+    return value
+
+def predicate_mask(table, predicate):
+    if isinstance(predicate, list):
+        masks = [predicate_mask(table, alternative) for alternative in predicate]
+        mask = masks[0]
+        for other in masks[1:]:
+            mask = pc.or_(mask, other)
+        return mask
+
+    column, op, value = predicate
+    values = table[column]
+    if op.startswith('date'):
+        values = pc.floor_temporal(values, unit='day')
+        value = pd.Timestamp(value).normalize()
+        op = op[len('date'):]
+    value = scalar(value, values.type) if op != 'in' else value
+
+    # empty values never match, except for '!=' (as NaN and NaT in pandas)
+    if op == '==':
+        return pc.fill_null(pc.equal(values, value), False)
+    if op == '!=':
+        return pc.fill_null(pc.not_equal(values, value), True)
+    if op == '<=':
+        return pc.fill_null(pc.less_equal(values, value), False)
+    if op == '>':
+        return pc.fill_null(pc.greater(values, value), False)
+    if op == '>=':
+        return pc.fill_null(pc.greater_equal(values, value), False)
+    if op == 'in':
+        return pc.is_in(values, value_set=pa.array(value, type=values.type))
+    raise ValueError(f"Unsupported filter op: {op}")
+
+def filter(table, predicates):
+    if not predicates:
+        return table
+    mask = predicate_mask(table, predicates[0])
+    for predicate in predicates[1:]:
+        mask = pc.and_(mask, predicate_mask(table, predicate))
+    return table.filter(mask)
+
+def select(table, columns):
+    return table.select(columns)
+
+def set_column(table, name, values):
+    if name in table.column_names:
+        return table.set_column(table.column_names.index(name), name, values)
+    return table.append_column(name, values)
+
+def with_column(table, name, value):
+    # value is a scalar, repeated in every row
+    if isinstance(value, (pd.Timestamp, datetime)):
+        values = np.full(table.num_rows, pd.Timestamp(value).to_datetime64(), dtype='datetime64[ns]')
+    else:
+        values = np.full(table.num_rows, value)
+    return set_column(table, name, pa.array(values))
+
+def with_date(table, name, column):
+    # date of a timestamp column
+    return set_column(table, name, pc.floor_temporal(table[column], unit='day'))
+
+def row_max(table, name, columns):
+    return set_column(table, name, pc.max_element_wise(*[table[col] for col in columns], skip_nulls=True))
+
+def fill_null(table, values):
+    for name, value in values.items():
+        if name not in table.column_names:
+            continue
+        column = table[name]
+        if pa.types.is_null(column.type):
+            # columns of an empty pandas DataFrame have no type
+            column = column.cast(pa.scalar(value).type)
+        table = set_column(table, name, pc.fill_null(column, pa.scalar(value).cast(column.type)))
+    return table
+
+def cast(table, types):
+    for name, dtype in types.items():
+        table = set_column(table, name, pc.cast(table[name], cast_types[dtype]))
+    return table
+
+def join(left, right, on, how='inner', suffixes=('_x', '_y')):
+    keys = [on] if isinstance(on, str) else on
+
+    # keys of an empty or converted table may have another type
+    for key in keys:
+        if right.schema.field(key).type != left.schema.field(key).type:
+            right = set_column(right, key, right[key].cast(left.schema.field(key).type))
+
+    return left.join(right, keys=keys, join_type=join_types[how], left_suffix=suffixes[0], right_suffix=suffixes[1],
+                     coalesce_keys=True, use_threads=True)
+
+def group_aggregate(table, keys, aggregations):
+    """
+    aggregations: output column -> (input column, function), functions are 'sum', 'max', 'size' and 'nunique'.
+    Groups come sorted by the keys, rows with empty keys are left out.
+    """
+    kernels = {
+        'sum': ('sum', pc.ScalarAggregateOptions(min_count=0)),
+        'max': ('max', None),
+        'size': ('count', pc.CountOptions(mode='all')),
+        'nunique': ('count_distinct', pc.CountOptions(mode='only_valid'))
+    }
+    for key in keys:
+        table = table.filter(pc.is_valid(table[key]))
+
+    specs = [(column, kernels[function][0], kernels[function][1]) for column, function in aggregations.values()]
+    grouped = table.group_by(keys, use_threads=True).aggregate(specs)
+
+    result = grouped.select(keys)
+    for name, (column, kernel, _) in zip(aggregations, specs):
+        result = result.append_column(name, grouped[f"{column}_{kernel}"])
+    return result.sort_by([(key, 'ascending') for key in keys])
+
+def dedupe(table, keys, keep='last'):
+    # row kept of each group of keys (first or last), in the original order
+    rows = pa.array(np.arange(table.num_rows))
+    kernel = 'max' if keep == 'last' else 'min'
+    kept = set_column(table.select(keys), '_row', rows).group_by(keys, use_threads=True).aggregate([('_row', kernel)])
+    return table.take(np.sort(kept['_row_' + kernel].to_numpy()))
+
+def sort(table, by, ascending=True):
+    by = [by] if isinstance(by, str) else by
+    ascending = ascending if isinstance(ascending, list) else [ascending] * len(by)
+    sort_keys = [(col, 'ascending' if asc else 'descending') for col, asc in zip(by, ascending)]
+    return table.take(pc.sort_indices(table, sort_keys=sort_keys))
+
+def concat(tables):
+    return pa.concat_tables(tables, promote_options='permissive')
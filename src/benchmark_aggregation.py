@@ -0,0 +1,121 @@
+import pandas as pd
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pandas.testing import assert_frame_equal
+import load
+import fused
+import synthetic
+
+# pandas operations counted as a pass over the data
+COUNTED_OPERATIONS = [
+    (pd.DataFrame, 'merge'), (pd.DataFrame, 'join'), (pd.DataFrame, 'groupby'), (pd.Series, 'groupby'),
+    (pd.DataFrame, 'drop_duplicates'), (pd.DataFrame, 'fillna'), (pd.Series, 'fillna'), (pd, 'concat')
+]
+
+
+@contextmanager
+def count_passes(counts):
+    """
+    Counts the calls to COUNTED_OPERATIONS made by the code in the block. Calls made by pandas internally
+    are not counted.
+    """
+    originals = [(owner, name, getattr(owner, name)) for owner, name in COUNTED_OPERATIONS]
+
+    def counted(name, function):
+        def wrapper(*args, **kwargs):
+            # the pandas package, not modules of the repo named after it (pandas_backend)
+            module = sys._getframe(1).f_globals.get('__name__', '')
+            if module != 'pandas' and not module.startswith('pandas.'):
+                counts[name] = counts.get(name, 0) + 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    for owner, name, function in originals:
+        setattr(owner, name, counted(name, function))
+    try:
+        yield counts
+    finally:
+        for owner, name, function in originals:
+            setattr(owner, name, function)
+
+def typed_inputs(num_users, events_per_day):
+    data = synthetic.generate_landing_data(num_users=num_users, num_days=1, events_per_day=events_per_day)
+    for df in data.values():
+        if 'event_timestamp' in df:
+            df['event_timestamp'] = pd.to_datetime(df['event_timestamp'])
+    data['user_level'] = data['user_level'].dropna(subset=['user_id'])
+    data['deposit'] = data['deposit'].drop_duplicates(subset='id')
+    data['event'] = data['event'].drop_duplicates(subset='id')
+    return data
+
+def measure(function, inputs, repeat):
+    """
+    Runs function on copies of the inputs, returning its result, best time, peak traced memory and passes.
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        copies = [df.copy() for df in inputs]
+        start = time.perf_counter()
+        result = function(*copies)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    copies = [df.copy() for df in inputs]
+    counts = {}
+    tracemalloc.start()
+    with count_passes(counts):
+        function(*copies)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, seconds, peak, counts
+
+def run(num_users=100000, events_per_day=400000, repeat=3):
+    """
+    Compares the default and fused aggregations of user_daily_snapshot and daily_stats for one day of synthetic data:
+    time, peak allocated memory and number of pandas passes (merge, join, groupby, drop_duplicates, fillna, concat).
+    Outputs of both engines are checked to be equal.
+    """
+    date = datetime(2023, 1, 1)
+    data = typed_inputs(num_users, events_per_day)
+
+    facts = {
+        'user_daily_snapshot': (
+            [data['user_id'], data['deposit'], data['withdrawal'], data['event']],
+            lambda *dfs: load.compute_fact_user_daily_snapshot(date, *dfs),
+            lambda *dfs: fused.compute_fact_user_daily_snapshot(date, *dfs)
+        ),
+        'daily_stats': (
+            [data['user_level'], data['deposit'], data['withdrawal']],
+            lambda *dfs: load.assemble_fact_daily_stats(pd.Timestamp(date), load.compute_daily_stats_partials(pd.Timestamp(date), *dfs)),
+            lambda *dfs: fused.compute_fact_daily_stats(date, *dfs)
+        )
+    }
+
+    results = []
+    for fact, (inputs, default_function, fused_function) in facts.items():
+        outputs = {}
+        for engine, function in [('default', default_function), ('fused', fused_function)]:
+            outputs[engine], seconds, peak, counts = measure(function, inputs, repeat)
+            results.append({
+                'fact': fact,
+                'engine': engine,
+                'rows': len(outputs[engine]),
+                'pandas_passes': sum(counts.values()),
+                'seconds': round(seconds, 3),
+                'peak_mb': round(peak / (1024 * 1024), 1),
+                'operations': ', '.join(f"{name}={count}" for name, count in sorted(counts.items()))
+            })
+
+        assert_frame_equal(outputs['fused'].reset_index(drop=True), outputs['default'].reset_index(drop=True), check_dtype=False)
+
+    results_df = pd.DataFrame(results)
+    print(results_df.to_string(index=False))
+    return results_df
+
+
+if __name__ == '__main__':
+    # optional arguments: number of users and events per day
+    run(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,86 @@
+import pandas as pd
+import sys
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from pandas.testing import assert_frame_equal
+import util
+import synthetic
+import extract_daily_batches as e
+import cleanup as c
+import load as l
+
+
+def prepare_data_lake(start_date, num_users, num_days, events_per_day):
+    # synthetic landing files extracted and cleaned into the trusted layer of the current directory
+    synthetic.write_landing_data(synthetic.generate_landing_data(num_users=num_users, start_date=start_date, num_days=num_days,
+                                                                 events_per_day=events_per_day))
+    end_date = start_date + timedelta(days=num_days - 1)
+    e.extract(start_date, end_date)
+    c.cleanup(start_date, end_date)
+    return end_date
+
+def time_load(backend, start_date, end_date):
+    """
+    Loads the curated layer from scratch for the date range with the given backend, returning the seconds spent
+    in each load step (summed over the days).
+    """
+    shutil.rmtree('data-lake/curated', ignore_errors=True)
+    l.set_backend(backend)
+
+    seconds = Counter()
+    current_date = start_date
+    while current_date <= end_date:
+        l.load_late_arrivals(current_date)
+        for step in l.load_steps():
+            start = time.perf_counter()
+            step(current_date)
+            seconds[step.__name__] += time.perf_counter() - start
+        current_date += timedelta(days=1)
+    return seconds
+
+def read_curated_tables():
+    # curated tables sorted by all their columns, so outputs of backends can be compared regardless of the row order
+    tables = {}
+    for table_name, _ in l.load_step_tables().values():
+        df = util.load_csv_to_dataframe(table_name, 'curated')
+        tables[table_name] = df.sort_values(list(df.columns)).reset_index(drop=True)
+    return tables
+
+def run(num_users=20000, num_days=3, events_per_day=100000):
+    """
+    Compares the seconds spent in each load step with the pandas and arrow backends on synthetic data, and checks
+    that both backends load the same curated rows (amounts up to float rounding, since sums run in another order).
+    """
+    start_date = datetime(2023, 1, 1)
+    results = []
+    outputs = {}
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            end_date = prepare_data_lake(start_date, num_users, num_days, events_per_day)
+            for backend in l.BACKENDS:
+                seconds = time_load(backend, start_date, end_date)
+                outputs[backend] = read_curated_tables()
+                results += [{'step': step, 'backend': backend, 'seconds': round(step_seconds, 3)} for step, step_seconds in seconds.items()]
+        finally:
+            l.set_backend('pandas')
+            os.chdir(cwd)
+
+    for table_name, expected_df in outputs['pandas'].items():
+        assert_frame_equal(outputs['arrow'][table_name], expected_df, check_dtype=False, rtol=1e-9)
+
+    results_df = pd.DataFrame(results).pivot(index='step', columns='backend', values='seconds')
+    results_df['speedup'] = (results_df['pandas'] / results_df['arrow']).round(2)
+    print(results_df.to_string())
+    return results_df
+
+
+if __name__ == '__main__':
+    # optional arguments: number of users, days and events per day
+    run(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,75 @@
+import pandas as pd
+import sys
+import os
+import time
+import tempfile
+import util
+import synthetic
+
+
+def benchmark_codec(df, codec, directory, repeat=3):
+    """
+    Writes and reads df with the given codec, returning compression ratio and throughput (MB/s of
+    uncompressed csv data) for both operations. Best time of the repetitions is used.
+    """
+    plain_path = os.path.join(directory, 'plain.csv')
+    df.to_csv(plain_path, index=False)
+    plain_size = os.path.getsize(plain_path)
+
+    path = os.path.join(directory, 'table.csv' + util.compression_extensions[codec])
+
+    write_seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        util.write_csv(df, path)
+        write_seconds = min(write_seconds, time.perf_counter() - start)
+
+    read_seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        util.read_csv(path)
+        read_seconds = min(read_seconds, time.perf_counter() - start)
+
+    compressed_size = os.path.getsize(path)
+    os.remove(path)
+
+    megabytes = plain_size / (1024 * 1024)
+    return {
+        'codec': codec or 'none',
+        'size_mb': round(compressed_size / (1024 * 1024), 3),
+        'ratio': round(plain_size / compressed_size, 2),
+        'write_mb_s': round(megabytes / write_seconds, 1),
+        'read_mb_s': round(megabytes / read_seconds, 1)
+    }
+
+
+def run(num_users=5000, num_days=30, events_per_day=10000):
+    """
+    Reports compression ratio, write throughput and read throughput per codec, for each table of the raw layer,
+    using synthetic data. Use it to choose the codec for each layer in util.layer_compression.
+    """
+    data = synthetic.generate_landing_data(num_users=num_users, num_days=num_days, events_per_day=events_per_day)
+    codecs = [None, 'gzip']
+    try:
+        import zstandard
+        codecs.append('zstd')
+    except ImportError:
+        print('zstandard is not installed, skipping zstd codec')
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for table_name, df in data.items():
+            for codec in codecs:
+                result = benchmark_codec(df, codec, directory)
+                result['table'] = table_name
+                result['rows'] = len(df)
+                results.append(result)
+
+    results_df = pd.DataFrame(results)[['table', 'rows', 'codec', 'size_mb', 'ratio', 'write_mb_s', 'read_mb_s']]
+    print(results_df.to_string(index=False))
+    return results_df
+
+
+if __name__ == '__main__':
+    # optional arguments: number of users, number of days and events per day
+    run(*[int(arg) for arg in sys.argv[1:]])
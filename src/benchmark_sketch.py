@@ -0,0 +1,83 @@
+import pandas as pd
+import numpy as np
+import sys
+import time
+import sketch
+
+
+def generate_deposits(num_users, num_days, deposits_per_day, seed=42):
+    """
+    Synthetic deposits already joined to the user level, as in generate_fact_daily_stats.
+    """
+    rng = np.random.RandomState(seed)
+    user_ids = np.array(['%032x' % rng.randint(0, 2**62) for _ in range(num_users)])
+    levels = rng.randint(0, 5, num_users)
+    jurisdictions = np.array(['mx', 'ar', 'br', 'co'])[rng.randint(0, 4, num_users)]
+
+    total = num_days * deposits_per_day
+    # skewed user activity, so some users deposit in most days and others rarely
+    users = np.minimum(rng.zipf(1.3, total) - 1, num_users - 1)
+    return pd.DataFrame({
+        'date': pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.randint(0, num_days, total), unit='D'),
+        'user_id': user_ids[users],
+        'level': levels[users],
+        'jurisdiction': jurisdictions[users],
+        'currency': np.array(['mxn', 'btc', 'eth', 'usd'])[rng.randint(0, 4, total)],
+        'amount': rng.exponential(500.0, total)
+    })
+
+
+def run(num_users=200000, num_days=365, deposits_per_day=20000):
+    """
+    Compares distinct deposit users over date ranges computed by merging daily_stats sketches against
+    the exact scan of the deposits, reporting the relative error and the time of both approaches.
+    """
+    keys = ['currency', 'level', 'jurisdiction']
+    deposits_df = generate_deposits(num_users, num_days, deposits_per_day)
+
+    start = time.perf_counter()
+    daily_stats_df = sketch.sketch_by_group(deposits_df, ['date'] + keys, 'user_id', 'deposit_users_sketch')
+    build_seconds = time.perf_counter() - start
+    for column in ['active_users_sketch', 'withdrawal_users_sketch']:
+        daily_stats_df[column] = ''
+    daily_stats_df['total_withdrawal_amount'] = 0.0
+    daily_stats_df['total_deposit_amount'] = 0.0
+    print(f"Built {len(daily_stats_df)} daily sketches in {build_seconds:.2f}s "
+          f"(expected relative standard error {sketch.relative_standard_error():.2%})")
+
+    results = []
+    for days in [7, 30, 90, num_days]:
+        start_date = pd.Timestamp('2023-01-01')
+        end_date = start_date + pd.Timedelta(days=days - 1)
+
+        start = time.perf_counter()
+        exact_df = (
+            deposits_df[(deposits_df['date'] >= start_date) & (deposits_df['date'] <= end_date)]
+            .groupby(keys, as_index=False)
+            .agg(exact=('user_id', 'nunique'))
+        )
+        exact_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rollup_df = sketch.rollup_daily_stats(daily_stats_df, start_date, end_date, keys)
+        rollup_seconds = time.perf_counter() - start
+
+        compared_df = exact_df.merge(rollup_df, on=keys)
+        error = (compared_df['total_distinct_deposit_users'] - compared_df['exact']).abs() / compared_df['exact']
+        results.append({
+            'days': days,
+            'groups': len(compared_df),
+            'mean_error': f"{error.mean():.2%}",
+            'max_error': f"{error.max():.2%}",
+            'exact_scan_s': round(exact_seconds, 3),
+            'sketch_rollup_s': round(rollup_seconds, 3)
+        })
+
+    results_df = pd.DataFrame(results)
+    print(results_df.to_string(index=False))
+    return results_df
+
+
+if __name__ == '__main__':
+    # optional arguments: number of users, number of days and deposits per day
+    run(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,189 @@
+import io
+import json
+import os
+import numpy as np
+import pandas as pd
+import util
+import memory
+
+# Row groups for the curated csv tables: a table is written as consecutive blocks of BLOCK_ROWS rows, each one
+# compressed on its own (a file of concatenated gzip members or zstd frames is still a regular compressed csv), and a
+# sidecar index (<table>.csv.blocks.json) records the byte range of each block and the min, max and number of empty
+# values of each of its columns. Readers with predicates only read and parse the blocks whose statistics can match
+# (e.g. the blocks with rows of a date, the load appends each day at the end of the tables), and merges copy the
+# blocks without rows of the date being loaded as they are.
+# The index records the size and modification time of the file it describes, a file rewritten by another writer
+# (the arrow backend, the chunked merge) has no valid index and is read whole.
+# Tables compacted by user (see clustering.py) start with blocks sorted by user, the index records how many and the
+# last date they have: their user_id statistics are disjoint ranges, so reads of a user only read its blocks.
+BLOCK_ROWS = 50000
+
+
+def index_path(path):
+    # shared by the copies of the file written with any codec, only the one matching the file version is valid
+    return util.uncompressed_file_path(path) + '.blocks.json'
+
+def file_version(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def read_index(path):
+    """
+    Block index of the file at path, None if the file has no index or was rewritten since it was written.
+    """
+    if path is None or not os.path.isfile(path) or not os.path.isfile(index_path(path)):
+        return None
+    with open(index_path(path)) as index_file:
+        index = json.load(index_file)
+    if index['path'] != os.path.basename(path) or index['version'] != file_version(path):
+        return None
+    return index
+
+def stats_value(value):
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return value.item() if isinstance(value, np.generic) else value
+
+def column_stats(df):
+    stats = {}
+    for col in df.columns:
+        values = df[col].dropna()
+        try:
+            low, high = (stats_value(values.min()), stats_value(values.max())) if len(values) else (None, None)
+        except TypeError:
+            # values that can't be compared (mixed types), the block is never skipped by this column
+            continue
+        stats[col] = {'min': low, 'max': high, 'nulls': int(len(df) - len(values))}
+    return stats
+
+def encode_block(df, codec, header=False):
+    return util.compress_bytes(df.to_csv(index=False, header=header).encode('utf-8'), codec)
+
+def write(parts, path, block_rows=None, clustered=None):
+    """
+    Writes a table to path as blocks, and its index. parts are DataFrames, split in blocks of block_rows rows, or
+    blocks of the index of the current version of the file at path, copied without parsing them.
+    clustered is {'blocks': number of first blocks sorted by user, 'until': their last date}.
+    """
+    block_rows = block_rows or BLOCK_ROWS
+    codec = util.file_codec(path)
+    frames = [part for part in parts if isinstance(part, pd.DataFrame)]
+    columns = list(frames[0].columns) if frames else read_index(path)['columns']
+
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    blocks = []
+    temporary_path = path + '.tmp'
+    current_file = open(path, 'rb') if any(isinstance(part, dict) for part in parts) else None
+    try:
+        with open(temporary_path, 'wb') as output:
+            output.write(encode_block(pd.DataFrame(columns=columns), codec, header=True))
+            for part in parts:
+                if isinstance(part, dict):
+                    current_file.seek(part['offset'])
+                    data = current_file.read(part['length'])
+                    blocks.append(dict(part, offset=output.tell()))
+                    output.write(data)
+                    continue
+                for start in range(0, len(part), block_rows):
+                    block = part.iloc[start:start + block_rows]
+                    data = encode_block(block[columns], codec)
+                    blocks.append({'offset': output.tell(), 'length': len(data), 'rows': len(block), 'stats': column_stats(block)})
+                    output.write(data)
+    finally:
+        if current_file is not None:
+            current_file.close()
+
+    os.replace(temporary_path, path)
+    util.remove_other_codec_copies(path)
+    index = {'path': os.path.basename(path), 'version': file_version(path), 'columns': columns, 'blocks': blocks}
+    if clustered is not None and clustered['blocks'] > 0:
+        index['clustered'] = clustered
+    with open(index_path(path) + '.tmp', 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(index_path(path) + '.tmp', index_path(path))
+
+def typed_stat(value, column_type):
+    return pd.Timestamp(value) if column_type == pd.Timestamp else value
+
+def block_may_match(block, predicate, schema):
+    """
+    False when no row of the block can match the predicate (same predicates as the backends filter), from the block
+    statistics.
+    """
+    if isinstance(predicate, list):
+        return any(block_may_match(block, alternative, schema) for alternative in predicate)
+
+    column, op, value = predicate
+    stats = block['stats'].get(column)
+    if stats is None:
+        return True
+    if stats['min'] is None:
+        # only empty values, which match only '!='
+        return op.endswith('!=')
+
+    low, high = typed_stat(stats['min'], schema.get(column)), typed_stat(stats['max'], schema.get(column))
+    if op.startswith('date'):
+        low, high, value = low.normalize(), high.normalize(), pd.Timestamp(value).normalize()
+        op = op[len('date'):]
+    elif isinstance(low, pd.Timestamp) and op != 'in':
+        value = pd.Timestamp(value)
+
+    try:
+        if op == '==':
+            return low <= value <= high
+        if op == '!=':
+            return not (low == value == high and stats['nulls'] == 0)
+        if op == '<=':
+            return low <= value
+        if op == '>':
+            return high > value
+        if op == '>=':
+            return high >= value
+        if op == 'in':
+            return any(low <= typed_stat(item, schema.get(column)) <= high for item in value)
+    except TypeError:
+        return True
+    raise ValueError(f"Unsupported filter op: {op}")
+
+def selected_blocks(index, predicates, spec):
+    # positions of the blocks whose rows may match all the predicates
+    return [position for position, block in enumerate(index['blocks'])
+            if all(block_may_match(block, predicate, spec.schema) for predicate in predicates or [])]
+
+def read_blocks(path, index, positions, spec, columns, row_filter=None):
+    """
+    Typed DataFrames of the blocks at the given positions, with only the given columns, filtered by row_filter
+    while reading.
+    """
+    codec = util.file_codec(path)
+    frames = []
+    with open(path, 'rb') as table_file:
+        for position in positions:
+            block = index['blocks'][position]
+            table_file.seek(block['offset'])
+            data = util.decompress_bytes(table_file.read(block['length']), codec)
+            df = pd.read_csv(io.BytesIO(data), header=None, names=index['columns'], usecols=columns, dtype=spec.dtypes(columns))
+            df = memory.fit(util.parse_timestamp_columns(df, spec, columns))
+            frames.append(row_filter(df) if row_filter is not None else df)
+    return frames
+
+def read(table_name, columns, predicates, row_filter):
+    """
+    Rows of a curated table matching the predicates, reading only the blocks that may have them. Files without an
+    index are read in chunks, filtered by row_filter as they are read.
+    """
+    spec = util.table_spec(table_name)
+    path = util.resolve_file_path(spec.file_path('curated'))
+    index = read_index(path)
+
+    if index is None:
+        frames = [row_filter(chunk) for chunk in util.load_csv_chunks(table_name, 'curated', columns=columns)]
+    else:
+        frames = read_blocks(path, index, selected_blocks(index, predicates, spec), spec, columns, row_filter)
+
+    if not frames:
+        return row_filter(util.empty_table_dataframe(table_name, columns))
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,31 @@
+import numpy as np
+
+# Bloom filters of the catalog (users of each partition) and of the id index. The bits are kept packed as np.packbits
+# does (bit i is the bit 7 - i % 8 of byte i // 8) and are set and tested in the packed bytes, so a lookup only
+# touches the bytes of its values. The positions of a value come from its 64 bits hash by double hashing: the i-th
+# one is h1 + i * h2, from the two halves of the hash.
+
+
+def new_filter(num_bits):
+    # bits rounded up to whole bytes
+    return np.zeros(max(-(-num_bits // 8), 1), dtype=np.uint8)
+
+def positions(hashes, num_bits, num_hashes):
+    """
+    Bit positions of each hash in a filter of num_bits bits, one row per hash.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    h1 = hashes & np.uint64(0xFFFFFFFF)
+    h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+    steps = np.arange(num_hashes, dtype=np.uint64)
+    return ((h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(num_bits)).astype(np.int64)
+
+def add(bits, hashes, num_bits, num_hashes):
+    # sets the bits of the hashes in the packed bytes, in place
+    hash_positions = positions(hashes, num_bits, num_hashes).ravel()
+    np.bitwise_or.at(bits, hash_positions >> 3, (128 >> (hash_positions & 7)).astype(np.uint8))
+
+def contains(bits, hashes, num_bits, num_hashes):
+    # for each hash, False when it's certainly not in the filter
+    hash_positions = positions(hashes, num_bits, num_hashes)
+    return ((bits[hash_positions >> 3] >> (7 - (hash_positions & 7))) & 1).astype(bool).all(axis=1)
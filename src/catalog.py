@@ -0,0 +1,220 @@
+import base64
+import json
+import math
+import os
+import zlib
+import numpy as np
+import pandas as pd
+import util
+import sketch
+import block_index
+import bloom
+
+# Statistics of each partition of the lake (zone maps): a trusted partition of a table and date, or a curated table.
+# Every write of cleanup_and_save and of the load records, in data-lake/_catalog/<layer>/<table>/<date>.json, the
+# number of rows and bytes of the file, the min, max and number of empty values of event_timestamp and id, the number
+# of distinct users and a Bloom filter of the user ids. Readers skip the partitions whose statistics can't match their
+# predicates and the query layer the partitions that don't have a user, without opening them, and the planner
+# estimates the size of the work units from them.
+# An entry records the size and modification time of the file it describes, entries of files rewritten since (by
+# another writer) are ignored. Curated tables also keep the rows of each user hash (<table>.users.npz), so merges of
+# blocks (see load.merge_curated_table_blocks) update the distinct users from the rows they replace, without reading
+# the blocks they copy.
+CATALOG_DIR = 'data-lake/_catalog'
+STATS_COLUMNS = ['id', 'event_timestamp']
+
+settings = {
+    'bloom_filter': True,
+    'false_positive_rate': 0.01
+}
+
+
+def configure(bloom_filter=True, false_positive_rate=0.01):
+    settings.update(bloom_filter=bloom_filter, false_positive_rate=false_positive_rate)
+
+def entry_path(table_name, layer, date=None):
+    name = date.strftime('%Y-%m-%d') if date is not None and layer != 'curated' else 'table'
+    return os.path.join(CATALOG_DIR, layer, table_name, name + '.json')
+
+def users_path(table_name):
+    return os.path.join(CATALOG_DIR, 'curated', table_name, 'table.users.npz')
+
+def stats_value(value):
+    # timestamps as the trusted layer writes them, so entries of every layer compare the same way
+    if isinstance(value, pd.Timestamp):
+        return str(value)
+    return value.item() if isinstance(value, np.generic) else value
+
+def users_stats(user_hashes=None, user_counts=None, rows=0):
+    return {
+        'rows': rows,
+        'columns': {},
+        'user_hashes': user_hashes if user_hashes is not None else np.array([], dtype=np.uint64),
+        'user_counts': user_counts if user_counts is not None else np.array([], dtype=np.int64)
+    }
+
+def partial_stats(df):
+    """
+    Statistics of a DataFrame, or of a chunk of a partition (see combine_stats).
+    """
+    stats = users_stats(rows=len(df))
+    for col in STATS_COLUMNS:
+        if col in df.columns:
+            values = df[col].dropna()
+            low, high = (stats_value(values.min()), stats_value(values.max())) if len(values) else (None, None)
+            stats['columns'][col] = {'min': low, 'max': high, 'nulls': int(len(df) - len(values))}
+    if 'user_id' in df.columns:
+        stats['user_hashes'], stats['user_counts'] = np.unique(sketch.hash_values(df['user_id'].dropna()), return_counts=True)
+    return stats
+
+def removed_users_stats(df):
+    # users of rows removed from a partition, combined with the stats of the partition before
+    stats = partial_stats(df)
+    return users_stats(stats['user_hashes'], -stats['user_counts'])
+
+def block_stats(block):
+    # statistics of a block of a curated table, from the block index (see block_index.py)
+    stats = users_stats(rows=block['rows'])
+    for col in STATS_COLUMNS:
+        if col in block['stats']:
+            column_stats = dict(block['stats'][col])
+            if col == 'event_timestamp' and column_stats['min'] is not None:
+                column_stats['min'], column_stats['max'] = str(pd.Timestamp(column_stats['min'])), str(pd.Timestamp(column_stats['max']))
+            stats['columns'][col] = column_stats
+    return stats
+
+def combine_values(values, function):
+    values = [value for value in values if value is not None]
+    return function(values) if values else None
+
+def combine_stats(partials):
+    # statistics of the chunks of a partition, in any order
+    columns = {}
+    for col in STATS_COLUMNS:
+        column_partials = [partial['columns'][col] for partial in partials if col in partial['columns']]
+        if column_partials:
+            columns[col] = {
+                'min': combine_values([stats['min'] for stats in column_partials], min),
+                'max': combine_values([stats['max'] for stats in column_partials], max),
+                'nulls': sum(stats['nulls'] for stats in column_partials)
+            }
+    # rows of each user hash, the hashes of removed rows have negative counts
+    user_hashes, inverse = np.unique(np.concatenate([partial['user_hashes'] for partial in partials] + [np.array([], dtype=np.uint64)]), return_inverse=True)
+    user_counts = np.bincount(inverse, weights=np.concatenate([partial['user_counts'] for partial in partials] + [np.array([], dtype=np.int64)]),
+                              minlength=len(user_hashes)).astype(np.int64)
+    stats = users_stats(user_hashes[user_counts > 0], user_counts[user_counts > 0], sum(partial['rows'] for partial in partials))
+    stats['columns'] = columns
+    return stats
+
+def bloom_filter(user_hashes):
+    """
+    Bloom filter of the distinct user hashes, sized for settings['false_positive_rate'].
+    """
+    rate = settings['false_positive_rate']
+    num_bits = max(64, int(math.ceil(-len(user_hashes) * math.log(rate) / math.log(2) ** 2)))
+    num_hashes = max(1, int(round(num_bits / max(1, len(user_hashes)) * math.log(2))))
+    bits = bloom.new_filter(num_bits)
+    bloom.add(bits, user_hashes, num_bits, num_hashes)
+    data = base64.b64encode(zlib.compress(bits.tobytes())).decode('ascii')
+    return {'bits': num_bits, 'hashes': num_hashes, 'data': data}
+
+def bloom_contains(user_bloom, user_ids):
+    # for each user, False when it's certainly not in the filter
+    bits = np.frombuffer(zlib.decompress(base64.b64decode(user_bloom['data'])), dtype=np.uint8)
+    return bloom.contains(bits, sketch.hash_values(user_ids), user_bloom['bits'], user_bloom['hashes'])
+
+def record_stats(table_name, layer, date, partials, path=None):
+    """
+    Records the statistics of the partition from the partial statistics of its rows, once its file (at path, the
+    path of the partition by default) is written.
+    """
+    if table_name not in util.TABLES:
+        return None
+    path = util.resolve_file_path(path or util.table_spec(table_name).file_path(layer, date))
+    if path is None:
+        return None
+    stats = combine_stats(partials)
+    stat = os.stat(path)
+    entry = {
+        'path': path,
+        'version': [stat.st_size, stat.st_mtime_ns],
+        'rows': stats['rows'],
+        'bytes': stat.st_size,
+        'stats': stats['columns'],
+        'distinct_users': len(stats['user_hashes']),
+        'bloom': bloom_filter(stats['user_hashes']) if settings['bloom_filter'] else None
+    }
+
+    catalog_path = entry_path(table_name, layer, date)
+    os.makedirs(os.path.dirname(catalog_path), exist_ok=True)
+    if layer == 'curated':
+        with open(users_path(table_name) + '.tmp', 'wb') as users_file:
+            np.savez(users_file, hashes=stats['user_hashes'], counts=stats['user_counts'])
+        os.replace(users_path(table_name) + '.tmp', users_path(table_name))
+    with open(catalog_path + '.tmp', 'w') as catalog_file:
+        json.dump(entry, catalog_file)
+    os.replace(catalog_path + '.tmp', catalog_path)
+    return entry
+
+def record(table_name, layer, date, df, path=None):
+    # statistics of a partition written from df
+    return record_stats(table_name, layer, date, [partial_stats(df)], path)
+
+def record_file(table_name, layer, date=None, chunksize=100000):
+    """
+    Records the statistics of a partition reading its file by chunks, for writers that never hold it whole.
+    """
+    spec = util.table_spec(table_name)
+    columns = [col for col in STATS_COLUMNS + ['user_id'] if col in spec.schema]
+    partials = [partial_stats(chunk) for chunk in util.load_csv_chunks(table_name, layer, date, columns, chunksize)]
+    return record_stats(table_name, layer, date, partials)
+
+def entry(table_name, layer, date=None):
+    """
+    Catalog entry of a partition, None if it has none or its file was rewritten since.
+    """
+    catalog_path = entry_path(table_name, layer, date)
+    if table_name not in util.TABLES or not os.path.isfile(catalog_path):
+        return None
+    with open(catalog_path) as catalog_file:
+        partition = json.load(catalog_file)
+    path = util.resolve_file_path(util.table_spec(table_name).file_path(layer, date))
+    if path != partition['path']:
+        return None
+    stat = os.stat(path)
+    return partition if partition['version'] == [stat.st_size, stat.st_mtime_ns] else None
+
+def curated_users_stats(table_name):
+    """
+    Rows of each user hash of a curated table, None if its entry isn't valid. Read before rewriting the table.
+    """
+    if entry(table_name, 'curated') is None or not os.path.isfile(users_path(table_name)):
+        return None
+    with np.load(users_path(table_name)) as users:
+        return users_stats(users['hashes'], users['counts'])
+
+def may_match(table_name, layer, date, predicates):
+    """
+    False when no row of the partition can match the predicates (same predicates as the backends filter).
+    """
+    partition = entry(table_name, layer, date)
+    if partition is None:
+        return True
+    spec = util.table_spec(table_name)
+    return all(block_index.block_may_match(partition, predicate, spec.schema) for predicate in predicates or [])
+
+def possible_users(table_name, layer, user_ids, date=None):
+    # the users that may be in the partition
+    partition = entry(table_name, layer, date)
+    if partition is None or partition['bloom'] is None or not len(user_ids):
+        return list(user_ids)
+    return [user_id for user_id, contained in zip(user_ids, bloom_contains(partition['bloom'], list(user_ids))) if contained]
+
+def may_contain_user(table_name, layer, user_id, date=None):
+    # False when the user is certainly not in the partition
+    return bool(possible_users(table_name, layer, [user_id], date))
+
+def partition_rows(table_name, layer, date=None):
+    # rows of the partition, None when unknown
+    partition = entry(table_name, layer, date)
+    return partition['rows'] if partition is not None else None
@@ -1,8 +1,15 @@
 import pandas as pd
+import numpy as np
 import sys
 import os
+import shutil
+import tempfile
 from datetime import datetime, timedelta
 import util
+import id_index
+import profiling
+import memory
+import catalog
 
 def is_valid_timestamp(value):
     """
@@ -30,26 +37,47 @@ def validate_row(row, schema):
                 return False
     return True
 
-def validate_dataframe_schema(df, schema):
+def column_type_mask(series, expected_type):
     """
-    Validate the entire DataFrame against the provided schema.
-    Each column is validated based on schema, using vectorized operations.
+    Vectorized equivalent of applying isinstance(value, expected_type) to every value of the column.
+    Columns with a numeric/bool dtype are decided by the dtype alone, strings by pandas type inference,
+    and only object columns with mixed types fall back to checking each value.
+    """
+    if pd.api.types.is_bool_dtype(series):
+        # bool is a subclass of int in python
+        return pd.Series(expected_type in (bool, int), index=series.index)
+    if pd.api.types.is_integer_dtype(series):
+        return pd.Series(expected_type == int, index=series.index)
+    if pd.api.types.is_float_dtype(series):
+        return pd.Series(expected_type == float, index=series.index)
+    if expected_type == str and pd.api.types.infer_dtype(series, skipna=True) in ('string', 'empty'):
+        return series.notna()
+    return series.map(lambda x: isinstance(x, expected_type)).astype(bool)
+
+def schema_mask(df, schema):
+    """
+    Returns a boolean Series telling which rows of the DataFrame match the provided schema.
     """
     # Start with all rows as valid
-    is_valid = pd.Series([True] * len(df), index=df.index)  # Ensure alignment with df's index
+    is_valid = pd.Series(True, index=df.index)  # Ensure alignment with df's index
 
     for col, expected_type in schema.items():
         if col in df.columns:
             if expected_type == pd.Timestamp:
                 # Convert column to datetime, setting invalid formats to NaT
-                valid_timestamp = pd.to_datetime(df[col], errors='coerce').notna()
-                is_valid &= valid_timestamp  # Mark invalid rows as False
+                is_valid &= pd.to_datetime(df[col], errors='coerce').notna()
             else:
                 # Check if column is of the correct type
-                valid_type = df[col].apply(lambda x: isinstance(x, expected_type))
-                is_valid &= valid_type
+                is_valid &= column_type_mask(df[col], expected_type)
+
+    return is_valid
 
-    valid_df = df[is_valid].reset_index(drop=True)
+def validate_dataframe_schema(df, schema):
+    """
+    Validate the entire DataFrame against the provided schema.
+    Each column is validated based on schema, using vectorized operations.
+    """
+    valid_df = df[schema_mask(df, schema)].reset_index(drop=True)
     return valid_df
 
 
@@ -64,111 +92,329 @@ def normalize_timestamp_column(df, schema):
     
     return df
 
+def empty_primary_key_mask(df, primary_keys):
+    # Rows where any of the primary key columns are null or empty
+    return df[primary_keys].isnull().any(axis=1) | (df[primary_keys] == "").any(axis=1)
+
 def discard_empty_primary_key_rows(df, primary_keys):
     # Drop rows where any of the primary key columns are null or empty
-    mask = df[primary_keys].isnull().any(axis=1) | (df[primary_keys] == "").any(axis=1)
-    df_cleaned = df[~mask]
+    df_cleaned = df[~empty_primary_key_mask(df, primary_keys)]
     return df_cleaned
 
-def cleanup_and_save(input_path, output_path, primary_keys, schema):
+def rejection_reasons(df, primary_keys, schema, is_duplicate=None):
+    """
+    Classifies every row of the DataFrame in a single vectorized pass, returning the reason code it's rejected
+    for, or None for valid rows. Reasons are checked in the same order cleanup applies them: duplicated primary key
+    (the last occurrence is kept), empty primary key and schema mismatch.
+    Duplicates can be given, for chunks of a file (see cleanup_and_save_in_chunks).
+    """
+    if is_duplicate is None:
+        is_duplicate = df.duplicated(subset=primary_keys, keep='last')
+    is_empty_key = empty_primary_key_mask(df, primary_keys)
+    is_invalid = ~schema_mask(df, schema)
+
+    reasons = np.select(
+        [is_duplicate.to_numpy(), is_empty_key.to_numpy(), is_invalid.to_numpy()],
+        ['duplicate_primary_key', 'empty_primary_key', 'invalid_schema'],
+        default=''
+    )
+    return pd.Series(reasons, index=df.index).replace('', None)
+
+def mark_cross_day_duplicates(df, reasons, table_name, batch_date, id_column):
+    """
+    Rejects valid rows whose id was accepted in an earlier batch, looking up only the ids of the batch in the
+    persistent id index of the table (see id_index.py).
+    """
+    valid = reasons.isna()
+    is_duplicate = pd.Series(False, index=df.index)
+    is_duplicate[valid] = id_index.cross_day_duplicates(table_name, batch_date, df.loc[valid, id_column].astype('int64'))
+    return reasons.mask(is_duplicate, 'duplicate_id_across_days')
+
+def quarantine_rows(df, reasons, table_name, batch_date):
+    """
+    Saves rejected rows, with their reason code, to the quarantine/<table>/<date>/ partition and records
+    the counters of each reason for the batch. Previous quarantine of the batch is replaced when reprocessing.
+    """
+    quarantine_path = util.data_lake_file_path(table_name, 'quarantine', batch_date)
+    rejected = reasons.notna()
+
+    if rejected.any():
+        util.write_csv(df[rejected].assign(reason=reasons[rejected]), quarantine_path)
+    elif util.resolve_file_path(quarantine_path) is not None:
+        os.remove(util.resolve_file_path(quarantine_path))
+
+    counters = reasons[rejected].value_counts().to_dict()
+    util.save_quarantine_counters(batch_date, table_name, counters)
+    if counters:
+        print(f"Quarantined {table_name} rows for {batch_date.strftime('%Y-%m-%d')}: {counters}")
+
+    return counters
+
+def late_rows_file_path(table_name, event_date, batch_date):
+    # rows of batch_date routed to the partition of event_date, kept so re-cleaning event_date doesn't lose them
+    return ('data-lake/trusted/_late_rows/' + table_name + '/' + event_date.strftime('%Y-%m-%d') + '/'
+            + batch_date.strftime('%Y-%m-%d') + '.csv' + util.layer_file_extension('trusted'))
+
+def read_routed_late_rows(table_name, event_date, schema, primary_keys):
+    """
+    Rows routed to the partition of event_date by later batches, in batch order, or None if there are none.
+    """
+    directory = os.path.dirname(late_rows_file_path(table_name, event_date, event_date))
+    if not os.path.isdir(directory):
+        return None
+    string_columns = {col: str for col, col_type in schema.items() if col_type in (str, pd.Timestamp)}
+    frames = [util.read_csv(os.path.join(directory, name), dtype=string_columns) for name in sorted(os.listdir(directory))]
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True).drop_duplicates(subset=primary_keys, keep='last')
+
+def merge_late_rows(df, late_df, primary_keys):
+    # rows of the batch, then the late rows routed to its date, which replace the batch rows with the same key
+    if late_df is None:
+        return df
+    is_replaced = df.set_index(primary_keys).index.isin(late_df.set_index(primary_keys).index)
+    return pd.concat([df[~is_replaced], late_df], ignore_index=True)
+
+def route_late_arriving_rows(df, batch_date, table_name, primary_keys):
+    """
+    Rows whose event date is earlier than the batch date arrived late. They are merged into the trusted partition
+    of their event date (deduplicated by primary key, so reprocessing a batch is idempotent) and recorded in the
+    late arrivals manifest of the batch date, so the load step only recomputes the affected days.
+    Returns the rows that belong to the batch partition and the list of affected event dates.
+    """
+    # timestamps are already normalized to '%Y-%m-%d %H:%M:%S' strings at this point
+    event_dates = df['event_timestamp'].str[:10]
+    is_late = event_dates < batch_date.strftime('%Y-%m-%d')
+
+    late_dates = []
+    for date_str, late_df in df[is_late].groupby(event_dates[is_late]):
+        event_date = datetime.strptime(date_str, '%Y-%m-%d')
+        partition_path = util.data_lake_file_path(table_name, 'trusted', event_date)
+        util.write_csv(late_df, late_rows_file_path(table_name, event_date, batch_date))
+
+        if util.partition_exists(partition_path):
+            partition_df = util.read_csv(partition_path)
+            late_df = pd.concat([partition_df, late_df], ignore_index=True)
+            late_df.drop_duplicates(subset=primary_keys, keep='last', inplace=True)
+
+        util.write_csv(late_df, partition_path)
+        catalog.record(table_name, 'trusted', event_date, late_df)
+        print(f"{int(is_late[event_dates == date_str].sum())} late {table_name} rows routed to {partition_path}")
+        late_dates.append(event_date)
+
+    # rows routed by a previous run of the batch to dates it doesn't route to anymore
+    for event_date in util.read_late_arrivals(batch_date).get(table_name, []):
+        late_rows_path = util.resolve_file_path(late_rows_file_path(table_name, event_date, batch_date))
+        if event_date not in late_dates and late_rows_path is not None:
+            os.remove(late_rows_path)
+
+    util.save_late_arrivals(batch_date, table_name, late_dates)
+
+    return df[~is_late], late_dates
+
+def cleanup_and_save(input_path, output_path, primary_keys, schema, table_name=None, batch_date=None):
     """
     Load a CSV from input_path, clean it by removing duplicates and rows that
     don't match the schema, normalize timestamp formats and save it to output_path.
+    When table_name and batch_date are given, rejected rows are saved to the quarantine layer, late arriving rows
+    are routed to the partition of their event date and the list of affected dates is returned.
     """
     # todo: improve handling of tables with non-existing data for a specific date
-    if not os.path.isfile(input_path): 
-        return True
+    # (raw days of compacted months are read from their monthly file, see compaction.py)
+    if not util.partition_exists(input_path):
+        return []
+    input_path = util.resolve_file_path(input_path) or input_path
         
+    # raw partitions larger than the memory budget are cleaned by chunks
+    if memory.exceeds_budget(input_path):
+        return cleanup_and_save_in_chunks(input_path, output_path, primary_keys, schema, table_name, batch_date)
+
+    # string and timestamp columns are read as strings, numeric columns are inferred so invalid values can be detected
+    string_columns = {col: str for col, col_type in schema.items() if col_type in (str, pd.Timestamp)}
     try:
-        df = pd.read_csv(input_path)
+        df = util.read_csv(input_path, dtype=string_columns)
     except Exception as e:
         print(f"Error reading CSV file: {e}")
         sys.exit(1)
 
-    # Drop duplicate rows based on primary keys
-    df.drop_duplicates(subset=primary_keys, inplace=True, keep='last')
+    # Classify duplicated, empty primary key and schema invalid rows in a single pass
+    reasons = rejection_reasons(df, primary_keys, schema)
+
+    # Ids re-sent on a later day are duplicates too, for tables with a persistent id index
+    uses_id_index = batch_date is not None and table_name in util.TABLES and util.table_spec(table_name).id_index
+    if uses_id_index:
+        reasons = mark_cross_day_duplicates(df, reasons, table_name, batch_date, primary_keys[0])
 
-    # Remove rows with empty or null primary keys
-    df = discard_empty_primary_key_rows(df, primary_keys)
+    # Keep rejected rows in quarantine, with their reason, instead of silently dropping them
+    if table_name is not None and batch_date is not None:
+        quarantine_rows(df, reasons, table_name, batch_date)
 
-    # Filter rows that match schema
-    cleaned_df = validate_dataframe_schema(df, schema)
+    # Keep only valid rows
+    cleaned_df = df[reasons.isna()].reset_index(drop=True)
+    accepted_ids = cleaned_df[primary_keys[0]].astype('int64') if uses_id_index else None
 
     # Normalize timestamp columns
     cleaned_df = normalize_timestamp_column(cleaned_df, schema)
 
+    # Route rows from previous dates to their own partitions
+    late_dates = []
+    if batch_date is not None and 'event_timestamp' in schema:
+        cleaned_df, late_dates = route_late_arriving_rows(cleaned_df, batch_date, table_name, primary_keys)
+        # and keep the rows later batches routed to this one
+        cleaned_df = merge_late_rows(cleaned_df, read_routed_late_rows(table_name, batch_date, schema, primary_keys), primary_keys)
+
     # Save the cleaned data to output_path
     try:
-        output_dir = os.path.dirname(output_path)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        cleaned_df.to_csv(output_path, index=False)
+        util.write_csv(cleaned_df, output_path)
         print(f"Cleaned data saved to {output_path}")
     except Exception as e:
         print(f"Error saving CSV file: {e}")
         sys.exit(1)
 
+    if batch_date is not None:
+        catalog.record(table_name, 'trusted', batch_date, cleaned_df, output_path)
+
+    # Record the accepted ids (late arriving ones included) once the batch is saved
+    if uses_id_index:
+        id_index.update_id_index(table_name, batch_date, accepted_ids)
+
+    return late_dates
+
+def common_dtype(dtypes):
+    # dtype pandas infers for a column when its chunks were inferred with dtypes: numbers mixed with anything else are strings
+    dtypes = set(dtypes)
+    if len(dtypes) == 1:
+        dtype = dtypes.pop()
+        return str if dtype == object else dtype
+    if all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) for dtype in dtypes):
+        return 'float64'
+    return str
+
+def cleanup_and_save_in_chunks(input_path, output_path, primary_keys, schema, table_name=None, batch_date=None):
+    """
+    Same as cleanup_and_save for raw partitions larger than the memory budget, reading the file by chunks:
+    1. the dtype of each column is inferred from every chunk, so values are validated as if the file was read whole,
+    2. chunks are parsed with those dtypes and spilled to a temporary directory, keeping a hash of the primary key
+       of every row to find duplicates (the last occurrence is kept),
+    3. each spilled chunk is classified and its valid rows appended to the output.
+    Only key hashes, accepted ids and rejected and late arriving rows are kept in memory between chunks.
+    """
+    string_columns = {col: str for col, col_type in schema.items() if col_type in (str, pd.Timestamp)}
+    chunksize = memory.chunk_rows(util.sample_row_bytes(input_path))
+    print(f"Cleaning {input_path} by chunks of {chunksize} rows")
+
+    chunk_dtypes = {}
+    with util.read_csv(input_path, dtype=string_columns, chunksize=chunksize) as reader:
+        for chunk in reader:
+            for col, dtype in chunk.dtypes.items():
+                chunk_dtypes.setdefault(col, []).append(dtype)
+    dtypes = {col: common_dtype(col_dtypes) for col, col_dtypes in chunk_dtypes.items()}
+
+    uses_id_index = batch_date is not None and table_name in util.TABLES and util.table_spec(table_name).id_index
+    # spilled next to the output, on the same disk as the lake
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    spill_dir = tempfile.mkdtemp(prefix='.cleanup-', dir=os.path.dirname(output_path) or '.')
+    try:
+        spilled_paths, key_hashes = [], []
+        with util.read_csv(input_path, dtype=dtypes, chunksize=chunksize) as reader:
+            for number, chunk in enumerate(reader):
+                key_hashes.append(pd.util.hash_pandas_object(chunk[primary_keys], index=False).to_numpy())
+                spilled_paths.append(os.path.join(spill_dir, f'{number}.pkl'))
+                chunk.to_pickle(spilled_paths[-1])
+        is_duplicate = pd.Series(np.concatenate(key_hashes) if key_hashes else np.array([], dtype='uint64')).duplicated(keep='last').to_numpy()
+
+        rejected, late, accepted_ids, partials = [], [], [], []
+        # rows later batches routed to this one, appended after the batch rows they replace
+        routed_df = read_routed_late_rows(table_name, batch_date, schema, primary_keys) if batch_date is not None and 'event_timestamp' in schema else None
+
+        def cleaned_chunks():
+            offset = 0
+            for path in spilled_paths:
+                chunk = pd.read_pickle(path)
+                duplicates = pd.Series(is_duplicate[offset:offset + len(chunk)], index=chunk.index)
+                offset += len(chunk)
+
+                reasons = rejection_reasons(chunk, primary_keys, schema, duplicates)
+                if uses_id_index:
+                    reasons = mark_cross_day_duplicates(chunk, reasons, table_name, batch_date, primary_keys[0])
+                rejected.append((chunk[reasons.notna()], reasons[reasons.notna()]))
+
+                cleaned_df = normalize_timestamp_column(chunk[reasons.isna()].reset_index(drop=True), schema)
+                if uses_id_index:
+                    accepted_ids.append(cleaned_df[primary_keys[0]].astype('int64'))
+                if batch_date is not None and 'event_timestamp' in schema:
+                    is_late = cleaned_df['event_timestamp'].str[:10] < batch_date.strftime('%Y-%m-%d')
+                    late.append(cleaned_df[is_late])
+                    cleaned_df = cleaned_df[~is_late]
+                if routed_df is not None:
+                    cleaned_df = cleaned_df[~cleaned_df.set_index(primary_keys).index.isin(routed_df.set_index(primary_keys).index)]
+                partials.append(catalog.partial_stats(cleaned_df))
+                yield cleaned_df
+            if routed_df is not None:
+                partials.append(catalog.partial_stats(routed_df))
+                yield routed_df
+
+        util.write_csv_chunks(cleaned_chunks(), output_path)
+        print(f"Cleaned data saved to {output_path}")
+        if batch_date is not None:
+            catalog.record_stats(table_name, 'trusted', batch_date, partials, output_path)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # rejected and late rows of all the chunks at once, so the previous quarantine and late partitions are replaced
+    if table_name is not None and batch_date is not None and rejected:
+        quarantine_rows(pd.concat([df for df, _ in rejected]), pd.concat([reasons for _, reasons in rejected]), table_name, batch_date)
+
+    late_dates = []
+    if batch_date is not None and 'event_timestamp' in schema and late:
+        _, late_dates = route_late_arriving_rows(pd.concat(late, ignore_index=True), batch_date, table_name, primary_keys)
+
+    if uses_id_index:
+        id_index.update_id_index(table_name, batch_date, pd.concat(accepted_ids, ignore_index=True) if accepted_ids else pd.Series(dtype='int64'))
+
+    return late_dates
+
 
 def clean(start_date, end_date, raw_dir, trusted_dir, primary_keys, schema, table_name):
     """
     Handles the input and output paths with dates and iterates over a range of dates,
     calling cleanup_and_save function to remove duplicates and enforce schema.
+    Returns the event dates that received late arriving rows.
     """
+    late_dates = set()
 
+    # input codec is detected when reading, output is written with the trusted layer codec
     input_path = raw_dir + '{}/{}/{}.csv'
-    output_path = trusted_dir + '{}/{}/{}.csv'
+    output_path = trusted_dir + '{}/{}/{}.csv' + util.layer_file_extension('trusted')
 
     current_date = start_date
     while current_date <= end_date:
         date_str = current_date.strftime('%Y-%m-%d')
         input_path_date = input_path.format(table_name, date_str, table_name)
         output_path_date = output_path.format(table_name, date_str, table_name)
-        cleanup_and_save(input_path_date, output_path_date, primary_keys, schema)
+        late_dates.update(cleanup_and_save(input_path_date, output_path_date, primary_keys, schema, table_name, current_date))
         
         # Move to the next day
         current_date += timedelta(days=1)
 
+    return late_dates
 
-def cleanup(start_date, end_date):
+
+def cleanup(start_date, end_date, tables=None):
     """
-    This method will trigger cleanup_and_save method for all tables in raw layer, so they are cleaned and saved in trusted layer
+    This method will trigger cleanup_and_save method for all tables in raw layer (or only the given tables), so they are cleaned and saved in trusted layer
+    Returns a dictionary with the event dates that received late arriving rows for each table.
     """
+    late_dates = {}
 
     raw_dir = 'data-lake/raw/'
     trusted_dir = 'data-lake/trusted/'
 
-    # user_level
-    primary_keys = util.user_level_pk()
-    schema = util.user_level_schema()
-    table_name = util.user_level_table_name()
-    print('Starting cleanup of user_level data')
-    clean(start_date, end_date, raw_dir, trusted_dir, primary_keys, schema, table_name)
-
-    # withdrawal
-    primary_keys = util.withdrawal_pk()
-    schema = util.withdrawal_schema()
-    table_name = util.withdrawal_table_name()
-    print('Starting cleanup of withdrawal data')
-    clean(start_date, end_date, raw_dir, trusted_dir, primary_keys, schema, table_name)
-
-    # user_id
-    primary_keys = util.user_id_pk()
-    schema = util.user_id_schema()
-    table_name = util.user_id_table_name()
-    print('Starting cleanup of user_id data')
-    clean(start_date, end_date, raw_dir, trusted_dir, primary_keys, schema, table_name)
-
-    # event
-    primary_keys = util.event_pk()
-    schema = util.event_schema()
-    table_name = util.event_table_name()
-    print('Starting cleanup of event data')
-    clean(start_date, end_date, raw_dir, trusted_dir, primary_keys, schema, table_name)
-
-    # deposit
-    primary_keys = util.deposit_pk()
-    schema = util.deposit_schema()
-    table_name = util.deposit_table_name()
-    print('Starting cleanup of deposit data')
-    clean(start_date, end_date, raw_dir, trusted_dir, primary_keys, schema, table_name)
\ No newline at end of file
+    for spec in util.source_tables():
+        if tables is not None and spec.name not in tables:
+            continue
+        print('Starting cleanup of ' + spec.name + ' data')
+        with profiling.profile_stage('cleanup_' + spec.name, start_date):
+            late_dates[spec.name] = clean(start_date, end_date, raw_dir, trusted_dir, spec.primary_keys, spec.schema, spec.name)
+
+    return late_dates
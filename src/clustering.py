@@ -0,0 +1,73 @@
+import argparse
+import math
+import util
+import block_index
+import catalog
+import pandas_backend
+import etl
+
+# Compaction of the curated fact tables clustered by user: the load appends each day at the end of the tables, so
+# the rows of a user are spread over the whole file and reading them scans it all. Compacting rewrites a table sorted
+# by (user_id, date), keeping the load order of the rows of a user and date (daily_stats keeps the first level loaded
+# on the latest date of a user). The block index is then a sparse index of the users: the user_id statistics of the
+# blocks are disjoint ranges, and reads of some users only read the blocks whose range has them.
+# The days loaded after the compaction are appended after the clustered blocks (see load.merge_curated_table_blocks)
+# until the table is compacted again.
+
+
+def clustered_tables():
+    # curated fact tables with rows by user and date
+    return [spec.name for spec in util.TABLES.values() if spec.date_column and 'user_id' in spec.schema]
+
+def compact(table_name):
+    """
+    Rewrites a curated table clustered by user, in blocks with a block index. Returns the number of rows and blocks,
+    None if the table doesn't exist.
+    """
+    spec = util.table_spec(table_name)
+    path = spec.file_path('curated')
+    if util.resolve_file_path(path) is None:
+        return None
+
+    df = util.load_csv_to_dataframe(table_name, 'curated')
+    dates = df[spec.date_column].dt.normalize()
+    df = df.assign(cluster_date=dates).sort_values(['user_id', 'cluster_date'], kind='stable').drop(columns='cluster_date')
+
+    blocks = math.ceil(len(df) / block_index.BLOCK_ROWS)
+    until = dates.max().strftime('%Y-%m-%d') if len(df) else None
+    block_index.write([df], util.resolve_file_path(path), clustered={'blocks': blocks, 'until': until})
+    catalog.record(table_name, 'curated', None, df)
+
+    print(f"Compacted {table_name} clustered by user: {len(df)} rows in {blocks} blocks")
+    return {'rows': len(df), 'blocks': blocks}
+
+def compact_tables(tables=None):
+    return {table_name: compact(table_name) for table_name in tables or clustered_tables()}
+
+def read_user_rows(table_name, user_ids, columns=None):
+    """
+    Rows of some users in a curated table, reading only the blocks that may have them.
+    """
+    user_ids = [user_ids] if isinstance(user_ids, str) else list(user_ids)
+    present = catalog.possible_users(table_name, 'curated', user_ids)
+    if not present:
+        return util.empty_table_dataframe(table_name, columns)
+    return pandas_backend.read(table_name, 'curated', columns=columns, predicates=[('user_id', 'in', present)])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Rewrites curated fact tables clustered by user.')
+    parser.add_argument('--tables', type=etl.parse_list, default=None, help='comma separated tables, default: ' + ','.join(clustered_tables()))
+    args = parser.parse_args(argv)
+    unknown_tables = set(args.tables or []) - set(clustered_tables())
+    if unknown_tables:
+        parser.error('unknown tables: ' + ', '.join(sorted(unknown_tables)))
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    compact_tables(args.tables)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import argparse
+import io
+import json
+import os
+from datetime import datetime
+import pandas as pd
+import util
+import memory
+import etl
+
+# Compaction of the small files of the raw and trusted layers: extract and cleanup write a file per table and day,
+# and reading many days (backfills, reprocessing) is dominated by opening and parsing thousands of tiny files.
+# Compacting merges the daily files of a month into a monthly file with an index of the byte and row range of each
+# day (see util.compacted_day), and removes them. Readers of a day read its range of the monthly file, reads of a
+# date range read each month at once (see read_range).
+# Only closed months are compacted by default: months before the last one with partitions, that the daily pipeline
+# doesn't write anymore. Compaction is idempotent, a month is only rewritten when it has daily files again (a
+# reprocessed day, late arriving rows), and safe alongside the pipeline: the monthly file and then its index are
+# replaced atomically before the daily files are removed, readers retry when the file changes under them, and daily
+# files rewritten while the month was being compacted are kept (they win over the monthly file until the next run).
+LAYERS = ['raw', 'trusted']
+
+
+def table_dir(table_name, layer):
+    return 'data-lake/' + layer + '/' + table_name
+
+def is_date(name):
+    try:
+        datetime.strptime(name, '%Y-%m-%d')
+    except ValueError:
+        return False
+    return True
+
+def daily_path(table_name, layer, date_str):
+    return util.data_lake_file_path(table_name, layer, datetime.strptime(date_str, '%Y-%m-%d'))
+
+def daily_partitions(table_name, layer):
+    # date string -> existing daily file, in date order
+    directory = table_dir(table_name, layer)
+    if not os.path.isdir(directory):
+        return {}
+    partitions = {}
+    for name in sorted(os.listdir(directory)):
+        path = util.resolve_file_path(daily_path(table_name, layer, name)) if is_date(name) else None
+        if path is not None:
+            partitions[name] = path
+    return partitions
+
+def compacted_months(table_name, layer):
+    directory = table_dir(table_name, layer)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-len('.csv.days.json')] for name in os.listdir(directory) if name.endswith('.csv.days.json'))
+
+def closed_months(table_name, layer):
+    # months with daily files before the last month with partitions
+    daily_months = {date_str[:7] for date_str in daily_partitions(table_name, layer)}
+    months = daily_months | set(compacted_months(table_name, layer))
+    return sorted(month for month in daily_months if month < max(months))
+
+def file_version(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def split_header(data):
+    # header line and rows of a decompressed csv file
+    end = data.find(b'\n') + 1 if b'\n' in data else len(data)
+    return data[:end], data[end:]
+
+def remove_daily_file(path):
+    base_path = util.uncompressed_file_path(path)
+    for extension in util.compression_extensions.values():
+        if os.path.isfile(base_path + extension):
+            os.remove(base_path + extension)
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        # other files in the date folder
+        pass
+
+def compact_month(table_name, layer, month):
+    """
+    Merges the daily files of a month of a table into its monthly file, with the days compacted before. Returns the
+    days and rows of the monthly file, None when the month has no daily files (nothing to do).
+    """
+    with util.file_lock('compact-' + layer + '-' + table_name):
+        daily = {date_str: path for date_str, path in daily_partitions(table_name, layer).items() if date_str.startswith(month + '-')}
+        if not daily:
+            return None
+
+        month_path = util.monthly_file_path(daily_path(table_name, layer, month + '-01'))
+        output_path = month_path + util.layer_file_extension(layer)
+        codec = util.file_codec(output_path)
+        index = util.read_compacted_index(month_path)
+        current_path = os.path.join(os.path.dirname(month_path), index['path']) if index is not None else None
+        header = index['header'].encode('utf-8') if index is not None else None
+
+        days = {}
+        versions = {}
+        temporary_path = output_path + '.tmp'
+        current_file = open(current_path, 'rb') if current_path is not None else None
+        try:
+            with open(temporary_path, 'wb') as output:
+                for date_str in sorted(set(daily) | set(index['days'] if index is not None else [])):
+                    if date_str in daily:
+                        versions[date_str] = file_version(daily[date_str])
+                        with open(daily[date_str], 'rb') as daily_file:
+                            day_header, rows = split_header(util.decompress_bytes(daily_file.read(), util.file_codec(daily[date_str])))
+                        header = header or day_header
+                        if day_header != header:
+                            # columns in another order, the day stays in its daily file
+                            print(f"Not compacting {daily[date_str]}: its header differs from the month")
+                            del versions[date_str]
+                            if index is None or date_str not in index['days']:
+                                continue
+                        else:
+                            data = util.compress_bytes(rows, codec) if rows else b''
+                            if output.tell() == 0:
+                                output.write(util.compress_bytes(header, codec))
+                            days[date_str] = {'offset': output.tell(), 'length': len(data), 'rows': rows.count(b'\n')}
+                            output.write(data)
+                            continue
+                    # day compacted before, copied (recompressed when the layer codec changed)
+                    day = index['days'][date_str]
+                    current_file.seek(day['offset'])
+                    data = current_file.read(day['length'])
+                    if util.file_codec(current_path) != codec and data:
+                        data = util.compress_bytes(util.decompress_bytes(data, util.file_codec(current_path)), codec)
+                    if output.tell() == 0:
+                        output.write(util.compress_bytes(header, codec))
+                    days[date_str] = {'offset': output.tell(), 'length': len(data), 'rows': day['rows']}
+                    output.write(data)
+        finally:
+            if current_file is not None:
+                current_file.close()
+
+        if not versions:
+            os.remove(temporary_path)
+            return None
+
+        first_row = 0
+        for day in days.values():
+            day['first_row'] = first_row
+            first_row += day['rows']
+
+        os.replace(temporary_path, output_path)
+        util.remove_other_codec_copies(output_path)
+        new_index = {'path': os.path.basename(output_path), 'version': file_version(output_path), 'header': header.decode('utf-8'), 'days': days}
+        index_path = util.compacted_index_path(month_path)
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(new_index, index_file)
+        os.replace(index_path + '.tmp', index_path)
+
+        # daily files rewritten meanwhile are newer than their copy in the month
+        for date_str, version in versions.items():
+            if os.path.isfile(daily[date_str]) and file_version(daily[date_str]) == version:
+                remove_daily_file(daily[date_str])
+
+    print(f"Compacted {layer} {table_name} {month}: {len(versions)} daily files into {len(days)} days, {first_row} rows")
+    return {'days': len(days), 'rows': first_row}
+
+def compact(layers=None, tables=None, months=None):
+    """
+    Compacts the given months (the closed ones by default) of the source tables in the raw and trusted layers.
+    Returns {(layer, table, month): result of compact_month}.
+    """
+    results = {}
+    for layer in layers or LAYERS:
+        for spec in util.source_tables():
+            if tables is not None and spec.name not in tables:
+                continue
+            for month in months or closed_months(spec.name, layer):
+                results[(layer, spec.name, month)] = compact_month(spec.name, layer, month)
+    return results
+
+def read_range(table_name, layer, start_date, end_date, columns=None):
+    """
+    Typed rows of the partitions of a date range, as load_csv_to_dataframe of each day concatenated in date order.
+    The compacted days of a month are read at once, daily files one by one.
+    """
+    spec = util.table_spec(table_name)
+    columns = columns or list(spec.schema.keys())
+
+    def parse(source):
+        df = pd.read_csv(source, usecols=columns, dtype=spec.dtypes(columns))
+        return memory.fit(util.parse_timestamp_columns(df, spec, columns))
+
+    frames = []
+    compacted_run = []
+
+    def read_compacted_run():
+        # consecutive compacted days without a newer daily file, stored one after the other
+        if compacted_run:
+            first_path, last_path = daily_path(table_name, layer, compacted_run[0]), daily_path(table_name, layer, compacted_run[-1])
+            frames.append(parse(io.BytesIO(util.read_compacted_days(first_path, last_path))))
+            compacted_run.clear()
+
+    for date in pd.date_range(pd.Timestamp(start_date).normalize(), pd.Timestamp(end_date).normalize()):
+        path = util.data_lake_file_path(table_name, layer, date)
+        if compacted_run and compacted_run[0][:7] != date.strftime('%Y-%m'):
+            read_compacted_run()
+        if util.resolve_file_path(path) is not None:
+            read_compacted_run()
+            frames.append(parse(util.resolve_file_path(path)))
+        elif util.compacted_day(path) is not None:
+            compacted_run.append(date.strftime('%Y-%m-%d'))
+    read_compacted_run()
+
+    return pd.concat(frames, ignore_index=True) if frames else util.empty_table_dataframe(table_name, columns)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Merges the daily files of the raw and trusted layers into monthly files.')
+    parser.add_argument('--layers', type=etl.parse_list, default=LAYERS, help='comma separated layers: ' + ','.join(LAYERS))
+    parser.add_argument('--tables', type=etl.parse_list, default=None, help='comma separated source tables, all by default')
+    parser.add_argument('--months', type=etl.parse_list, default=None, help='comma separated months (YYYY-MM), the closed ones by default')
+    args = parser.parse_args(argv)
+    unknown_layers = set(args.layers) - set(LAYERS)
+    if unknown_layers:
+        parser.error('unknown layers: ' + ', '.join(sorted(unknown_layers)))
+    unknown_tables = set(args.tables or []) - set(etl.source_table_names())
+    if unknown_tables:
+        parser.error('unknown tables: ' + ', '.join(sorted(unknown_tables)))
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    compact(args.layers, args.tables, args.months)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+import argparse
+import numpy as np
+import pandas as pd
+import sys
+import os
+import glob
+import tempfile
+import time
+from datetime import datetime, timedelta
+import util
+import rollup
+import activity_index
+import shard
+import synthetic
+import etl
+import load as l
+import work_queue
+import memory
+import sampling
+
+# Differential check of the execution modes of the pipeline: the reference day by day run of process_etl and each
+# mode run on the same synthetic landing data, in separate directories, and every curated table is compared after
+# normalizing types (typed readers) and row order (sorted by the keys of the table). New modes are added here as
+# the process_etl arguments that enable them, queue_workers runs the pipeline on local work_queue workers instead.
+MODES = {
+    'sharded': {'workers': 2},
+    'chunked': {'merge_chunk_rows': 500},
+    'fused': {'aggregation_engine': 'fused'},
+    'arrow': {'backend': 'arrow'},
+    'compressed': {'compression': {'raw': 'gzip', 'trusted': 'gzip', 'curated': 'gzip'}},
+    'queue': {'queue_workers': 2},
+    # small enough for the synthetic data to be cleaned, merged and read by chunks
+    'budget': {'memory_budget': 256 * 1024}
+}
+
+# settings of every run, reference included, so the optional tables are compared too
+PIPELINE_SETTINGS = {'dim_user_history': True}
+
+# relative tolerance of float measures: amounts summed in another order (by shard, by arrow) differ in the last digits
+FLOAT_TOLERANCE = 1e-9
+ACTIVITY_BITMAP = 'activity_bitmap'
+
+
+def curated_table_keys():
+    # curated tables (facts, dimensions, rollups and the user index map) and the columns that identify their rows
+    keys = {spec.name: spec.primary_keys for spec in util.TABLES.values() if 'curated' in spec.layers}
+    for table_name, spec in [(util.FACT_USER_DAILY_SNAPSHOT.name, rollup.user_rollup_spec()), (util.FACT_DAILY_STATS.name, rollup.stats_rollup_spec())]:
+        for grain in rollup.GRAINS:
+            keys[rollup.rollup_table_name(table_name, grain)] = ['period_start'] + spec['keys']
+    keys[activity_index.user_id_map_table_name()] = ['user_id']
+    return keys
+
+def read_curated_table(table_name, keys):
+    """
+    Typed curated table sorted by its keys (and the rest of the columns), or None if the table wasn't written.
+    """
+    path = util.curated_file_path(table_name)
+    if util.resolve_file_path(path) is None:
+        return None
+
+    if table_name in util.TABLES:
+        df = util.load_csv_to_dataframe(table_name, 'curated')
+    else:
+        df = util.read_csv(path, dtype={'user_id': str, 'jurisdiction': str, 'currency': str})
+    return df.sort_values(keys + [col for col in df.columns if col not in keys]).reset_index(drop=True)
+
+def read_activity_bitmaps():
+    # arrays of the activity bitmaps by file name
+    bitmaps = {}
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(activity_index.bitmap_file_path(datetime(2000, 1, 1))), '*.npz'))):
+        with np.load(path) as arrays:
+            bitmaps[os.path.basename(path)] = {name: arrays[name] for name in arrays.files}
+    return bitmaps
+
+def values_differ(reference, other):
+    if pd.api.types.is_float_dtype(reference) and pd.api.types.is_float_dtype(other):
+        return ~np.isclose(reference.to_numpy(), other.to_numpy(), rtol=FLOAT_TOLERANCE, atol=0, equal_nan=True)
+    same = (reference.to_numpy() == other.to_numpy()) | (reference.isna().to_numpy() & other.isna().to_numpy())
+    return ~same
+
+def diff_table(reference_df, mode_df, keys):
+    """
+    Compares two versions of a table by key: returns the keys only in the reference (missing), only in the mode
+    (extra), the keys whose other columns differ (changed), duplicated keys and columns not in both versions.
+    """
+    columns = [col for col in reference_df.columns if col in mode_df.columns]
+    different_columns = sorted(set(reference_df.columns) ^ set(mode_df.columns))
+
+    duplicated = pd.concat([reference_df[reference_df.duplicated(keys)][keys], mode_df[mode_df.duplicated(keys)][keys]])
+    merged = reference_df[columns].merge(mode_df[columns], on=keys, how='outer', suffixes=('_reference', '_mode'), indicator=True)
+
+    changed_mask = np.zeros(len(merged), dtype=bool)
+    both = (merged['_merge'] == 'both').to_numpy()
+    for col in columns:
+        if col not in keys:
+            changed_mask |= both & values_differ(merged[col + '_reference'], merged[col + '_mode'])
+
+    def key_tuples(df):
+        return list(df[keys].itertuples(index=False, name=None))
+
+    return {
+        'missing': key_tuples(merged[merged['_merge'] == 'left_only']),
+        'extra': key_tuples(merged[merged['_merge'] == 'right_only']),
+        'changed': key_tuples(merged[changed_mask]),
+        'duplicated': key_tuples(duplicated),
+        'columns': different_columns
+    }
+
+def diff_activity_bitmaps(reference_bitmaps, mode_bitmaps):
+    # bitmap files missing in either run or with different arrays, as 'changed'
+    changed = [(name,) for name in sorted(set(reference_bitmaps) | set(mode_bitmaps))
+               if name not in reference_bitmaps or name not in mode_bitmaps
+               or reference_bitmaps[name].keys() != mode_bitmaps[name].keys()
+               or any(not np.array_equal(array, mode_bitmaps[name][kind]) for kind, array in reference_bitmaps[name].items())]
+    return {'missing': [], 'extra': [], 'changed': changed, 'duplicated': [], 'columns': []}
+
+def restore_default_settings():
+    # process_etl settings are module globals, so each run starts from the defaults
+    for layer in util.layer_compression:
+        util.set_layer_compression(layer, None)
+    util.set_merge_chunk_rows(None)
+    l.set_aggregation_engine('default')
+    l.set_backend('pandas')
+    memory.set_budget(None)
+    l.set_dim_user_history(False)
+    sampling.set_fraction(None)
+    shard.shutdown()
+
+def run_pipeline(directory, data, start_date, end_date, settings):
+    """
+    Runs the whole pipeline in directory on the landing data with the process_etl settings of a mode, returning
+    the seconds it took and the curated tables.
+    """
+    cwd = os.getcwd()
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    try:
+        synthetic.write_landing_data(data)
+        settings = dict(PIPELINE_SETTINGS, **settings)
+        queue_workers = settings.pop('queue_workers', None)
+        start = time.perf_counter()
+        if queue_workers:
+            work_queue.run_local(start_date, end_date, queue_workers, **settings)
+        else:
+            etl.process_etl(start_date, end_date, **settings)
+        seconds = time.perf_counter() - start
+
+        tables = {table_name: read_curated_table(table_name, keys) for table_name, keys in curated_table_keys().items()}
+        tables[ACTIVITY_BITMAP] = read_activity_bitmaps()
+        return seconds, tables
+    finally:
+        restore_default_settings()
+        os.chdir(cwd)
+
+def compare_runs(reference_tables, mode_tables):
+    diffs = {}
+    for table_name, keys in curated_table_keys().items():
+        reference_df, mode_df = reference_tables[table_name], mode_tables[table_name]
+        if reference_df is None or mode_df is None:
+            # written in only one of the runs
+            diffs[table_name] = {'missing': [], 'extra': [], 'changed': [], 'duplicated': [], 'columns': [],
+                                 'written': (reference_df is not None, mode_df is not None)}
+            continue
+        diffs[table_name] = diff_table(reference_df, mode_df, keys)
+    diffs[ACTIVITY_BITMAP] = diff_activity_bitmaps(reference_tables[ACTIVITY_BITMAP], mode_tables[ACTIVITY_BITMAP])
+    return diffs
+
+def is_match(diff):
+    return not any(diff[kind] for kind in ['missing', 'extra', 'changed', 'duplicated', 'columns']) and diff.get('written', (True, True)) == (True, True)
+
+def print_report(timings, results, max_keys=5):
+    print(timings.to_string(index=False))
+    print(results.drop(columns='diff').to_string(index=False))
+    for _, row in results[~results['match']].iterrows():
+        for kind in ['missing', 'extra', 'changed', 'duplicated']:
+            if row['diff'][kind]:
+                print(f"{row['mode']} {row['table']} {kind} keys: {row['diff'][kind][:max_keys]}")
+        if row['diff']['columns']:
+            print(f"{row['mode']} {row['table']} columns in only one run: {row['diff']['columns']}")
+
+def run(modes=None, num_users=1000, num_days=5, events_per_day=2000, directory=None):
+    """
+    Runs the reference pipeline and each mode (all of MODES by default) on the same synthetic data and compares
+    every curated table. Returns the timings by mode and the comparison of each (mode, table), and prints both with
+    the first mismatching keys.
+    """
+    modes = modes or list(MODES)
+    start_date = datetime(2023, 1, 1)
+    end_date = start_date + timedelta(days=num_days - 1)
+    data = synthetic.generate_landing_data(num_users=num_users, start_date=start_date, num_days=num_days, events_per_day=events_per_day)
+
+    with tempfile.TemporaryDirectory(dir=directory) as root:
+        reference_seconds, reference_tables = run_pipeline(os.path.join(root, 'reference'), data, start_date, end_date, {})
+
+        timings = [{'mode': 'reference', 'seconds': round(reference_seconds, 3), 'speedup': 1.0}]
+        results = []
+        for mode in modes:
+            seconds, mode_tables = run_pipeline(os.path.join(root, mode), data, start_date, end_date, MODES[mode])
+            timings.append({'mode': mode, 'seconds': round(seconds, 3), 'speedup': round(reference_seconds / seconds, 2)})
+
+            for table_name, diff in compare_runs(reference_tables, mode_tables).items():
+                reference_df = reference_tables[table_name]
+                results.append({
+                    'mode': mode,
+                    'table': table_name,
+                    'rows': len(reference_df) if reference_df is not None else 0,
+                    'missing': len(diff['missing']),
+                    'extra': len(diff['extra']),
+                    'changed': len(diff['changed']),
+                    'match': is_match(diff),
+                    'diff': diff
+                })
+
+    timings_df, results_df = pd.DataFrame(timings), pd.DataFrame(results)
+    print_report(timings_df, results_df)
+    return timings_df, results_df
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Compares the curated tables of the reference pipeline with other execution modes.')
+    parser.add_argument('--modes', type=etl.parse_list, default=list(MODES), help='comma separated modes: ' + ','.join(MODES))
+    parser.add_argument('--users', type=int, default=1000, help='synthetic users')
+    parser.add_argument('--days', type=int, default=5, help='synthetic days')
+    parser.add_argument('--events-per-day', type=int, default=2000, help='synthetic events of each table per day')
+    args = parser.parse_args(argv)
+
+    unknown_modes = set(args.modes) - set(MODES)
+    if unknown_modes:
+        parser.error('unknown modes: ' + ', '.join(sorted(unknown_modes)))
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    _, results = run(args.modes, args.users, args.days, args.events_per_day)
+    # non zero exit code when any mode doesn't match, so it can gate a CI job
+    return 0 if results['match'].all() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
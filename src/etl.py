@@ -1,40 +1,217 @@
+import argparse
+import itertools
+import os
 from datetime import datetime, timedelta
 import extract_daily_batches as e
 import cleanup as c
 import load as l
+import util
+import profiling
+import memory
+import catalog
+import sampling
 
-start_date = datetime(2020, 1, 1)
-end_date = datetime(2023, 8, 23)
-landing_dir = 'data-lake/landing/'
-raw_dir = 'data-lake/raw/'
+# for this exercise, we are considering daily batches from 2020-01-01 to 2023-08-23
+DEFAULT_START_DATE = datetime(2020, 1, 1)
+DEFAULT_END_DATE = datetime(2023, 8, 23)
+STAGES = ['extract', 'cleanup', 'load']
 
 
-def extract(start_date, end_date, landing_dir, raw_dir):
-    # simulate extraction of other tables (containing event_date)
-    event_files = ['deposit','event','user_level','withdrawal']
-    e.extract_events(event_files, landing_dir, raw_dir)
+def source_table_names():
+    return [spec.name for spec in util.source_tables()]
 
+def curated_table_names():
+    return [table_name for table_name, _ in l.load_step_tables().values()]
 
-    # simulate extraction of user_id (no event_date)
-    user_id_file_path = landing_dir + 'user_id/user_id_sample_data.csv'
-    destination_user_id_directory = raw_dir + 'user_id/' 
-    destination_user_id_file_name = 'user_id.csv'
-    e.extract_user_id(start_date, end_date, user_id_file_path, destination_user_id_directory, destination_user_id_file_name)
+def plan_work_units(start_date, end_date, tables=None, stages=STAGES):
+    """
+    Returns the (stage, table, date) work units to run, in execution order: extraction of the whole date range first,
+    then cleanup and load of each day. Extract and cleanup units are source tables, load units are curated tables.
+    Extract units have no date, a table is extracted for the whole range at once.
+    """
+    source_tables = [name for name in source_table_names() if tables is None or name in tables]
+    curated_tables = [l.load_step_tables()[step][0] for step in l.selected_load_steps(tables)]
 
+    units = []
+    if 'extract' in stages:
+        units += [('extract', table_name, None) for table_name in source_tables]
 
-def process_etl():
-    
-    # for this exercise, we are considering daily batches from 2020-01-01 to 2023-08-23
-    start_date = datetime(2020,1,1)
-    end_date = datetime(2023,8,23)
-
-    e.extract(start_date, end_date)
-    
     current_date = start_date
     while current_date <= end_date:
-        c.cleanup(current_date, current_date)
-        l.load(current_date)
-        current_date = current_date + timedelta(days=1)
+        if 'cleanup' in stages:
+            units += [('cleanup', table_name, current_date) for table_name in source_tables]
+        if 'load' in stages:
+            units += [('load', table_name, current_date) for table_name in curated_tables]
+        current_date += timedelta(days=1)
+
+    return units
+
+def file_size(path):
+    resolved_path = util.resolve_file_path(path)
+    if resolved_path is not None:
+        return os.path.getsize(resolved_path)
+    # compressed size of a compacted day (see compaction.py)
+    day = util.compacted_day(path)
+    return day['length'] if day is not None else 0
+
+def curated_inputs(table_name):
+    # curated tables a load unit reads: the table merged into and the ones its step reads (see load.load_step_curated_inputs)
+    step = {destination: step for step, (destination, _) in l.load_step_tables().items()}[table_name]
+    return [table_name] + l.load_step_curated_inputs().get(step, [])
+
+def estimate_input_bytes(stage, table_name, date):
+    """
+    Size of the files a work unit reads: the landing file for extract, the raw partition for cleanup, and the
+    trusted partitions read plus the curated tables read and merged into for load. Files not created yet count as 0.
+    """
+    if stage == 'extract':
+        return file_size(e.landing_file_path(table_name))
+    if stage == 'cleanup':
+        return file_size(util.data_lake_file_path(table_name, 'raw', date))
+
+    inputs = {destination: sources for destination, sources in l.load_step_tables().values()}[table_name]
+    trusted_bytes = sum(file_size(util.data_lake_file_path(source, 'trusted', date)) for source in inputs)
+    return trusted_bytes + sum(file_size(util.curated_file_path(curated)) for curated in curated_inputs(table_name))
+
+def estimate_input_rows(stage, table_name, date):
+    """
+    Rows of the trusted partitions and the curated tables a load unit reads, from the catalog (see catalog.py).
+    Files not created yet count as 0. None for extract and cleanup units (raw files aren't in the catalog) and when a
+    partition has no entry.
+    """
+    if stage != 'load':
+        return None
+    inputs = {destination: sources for destination, sources in l.load_step_tables().values()}[table_name]
+    rows = [catalog.partition_rows(source, 'trusted', date) if file_size(util.data_lake_file_path(source, 'trusted', date)) else 0
+            for source in inputs]
+    for curated in curated_inputs(table_name):
+        if util.resolve_file_path(util.curated_file_path(curated)) is not None:
+            rows.append(catalog.partition_rows(curated, 'curated'))
+    return sum(rows) if None not in rows else None
+
+def print_work_units(units):
+    for stage, table_name, date in units:
+        date_str = date.strftime('%Y-%m-%d') if date is not None else 'all dates'
+        size_mb = estimate_input_bytes(stage, table_name, date) / (1024 * 1024)
+        rows = estimate_input_rows(stage, table_name, date)
+        rows_str = f"{rows} rows" if rows is not None else '-'
+        print(f"{stage:<8} {table_name:<20} {date_str:<10} {size_mb:>10.3f} MB {rows_str:>14}")
+    print(f"{len(units)} work units")
+
+def run_work_units(units, start_date, end_date, workers=1):
+    """
+    Runs the work units, grouping the tables of the same stage and date in a single call.
+    """
+    for (stage, date), group in itertools.groupby(units, key=lambda unit: (unit[0], unit[2])):
+        tables = [table_name for _, table_name, _ in group]
+        with memory.track(stage, date):
+            if stage == 'extract':
+                e.extract(start_date, end_date, tables)
+            elif stage == 'cleanup':
+                c.cleanup(date, date, tables)
+            else:
+                l.load(date, workers, tables)
+
+def process_etl(start_date=DEFAULT_START_DATE, end_date=DEFAULT_END_DATE, tables=None, stages=STAGES, workers=1,
+                compression=None, merge_chunk_rows=None, profile_dir=None, profile_sample_rate=1.0, dry_run=False,
+                aggregation_engine='default', backend='pandas', memory_budget=None, dim_user_history=False,
+                sample_fraction=None):
+
+    # compression codec for each layer, e.g. {'raw': 'zstd', 'trusted': 'zstd', 'curated': 'gzip'}
+    # run src/benchmark_compression.py to compare the trade-offs of each codec
+    for layer, codec in (compression or {}).items():
+        util.set_layer_compression(layer, codec)
+
+    # merge curated facts reading chunks of merge_chunk_rows rows, for tables that don't fit in memory
+    util.set_merge_chunk_rows(merge_chunk_rows)
+
+    # 'fused' computes user_daily_snapshot and daily_stats in a single pass over a daily event stream (see fused.py)
+    l.set_aggregation_engine(aggregation_engine)
+
+    # extract only a deterministic fraction of the users of every table, for development runs (see sampling.py)
+    sampling.set_fraction(sample_fraction)
+
+    # keep the type 2 history of dim_user in dim_user_history
+    l.set_dim_user_history(dim_user_history)
+
+    # 'arrow' runs the generate and merge logic of the load on pyarrow.compute kernels (see arrow_backend.py)
+    l.set_backend(backend)
+
+    # memory budget in bytes of cleanup and load: numeric columns are downcast, larger inputs are processed in
+    # chunks spilled to disk and the peak memory of each stage is reported against it (see memory.py)
+    memory.set_budget(memory_budget)
+
+    # per stage cpu profiles, sampled call stacks and allocations in profile_dir (see profiling.py)
+    if profile_dir:
+        profiling.enable(profile_dir, profile_sample_rate)
+
+    units = plan_work_units(start_date, end_date, tables, stages)
+    if dry_run:
+        print_work_units(units)
+        return units
+
+    # with workers > 1 the aggregations of the load run on shards of users in parallel processes (see shard.py)
+    run_work_units(units, start_date, end_date, workers)
+    memory.report()
+    return units
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d')
+
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def parse_compression(value):
+    # e.g. raw=zstd,curated=gzip
+    compression = {}
+    for item in parse_list(value):
+        layer, _, codec = item.partition('=')
+        compression[layer] = None if codec in ('', 'none') else codec
+    return compression
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the daily batches of the pipeline (extract, cleanup and load) for a date range.')
+    parser.add_argument('--from', dest='start_date', type=parse_date, default=DEFAULT_START_DATE, help='first date, YYYY-MM-DD')
+    parser.add_argument('--to', dest='end_date', type=parse_date, default=DEFAULT_END_DATE, help='last date (inclusive), YYYY-MM-DD')
+    parser.add_argument('--tables', type=parse_list, default=None,
+                        help='comma separated source tables (extract and cleanup) and/or curated tables (load), all by default')
+    parser.add_argument('--stages', type=parse_list, default=STAGES, help='comma separated stages: ' + ','.join(STAGES))
+    parser.add_argument('--workers', type=int, default=1, help='processes for the sharded load steps')
+    parser.add_argument('--dry-run', action='store_true', help='print the planned work units with their input sizes and exit')
+    parser.add_argument('--aggregation', choices=l.AGGREGATION_ENGINES, default='default', help='aggregation engine of the snapshot and stats facts')
+    parser.add_argument('--backend', choices=l.BACKENDS, default='pandas', help='execution backend of the load steps')
+    parser.add_argument('--compression', type=parse_compression, default=None, help='codec per layer, e.g. raw=zstd,curated=gzip')
+    parser.add_argument('--merge-chunk-rows', type=int, default=None, help='merge curated facts in chunks of this many rows')
+    parser.add_argument('--sample', dest='sample_fraction', type=float, default=None,
+                        help='extract this fraction of the users (e.g. 0.01), same users on every run')
+    parser.add_argument('--dim-user-history', action='store_true', help='keep the type 2 history of dim_user')
+    parser.add_argument('--memory-budget', type=memory.parse_size, default=None, help='memory budget of cleanup and load, e.g. 512MB')
+    parser.add_argument('--profile-dir', default=None, help='write per stage profiles to this directory')
+    parser.add_argument('--profile-sample-rate', type=float, default=1.0, help='fraction of the runs of each stage to profile')
+    args = parser.parse_args(argv)
+
+    unknown_stages = set(args.stages) - set(STAGES)
+    if unknown_stages:
+        parser.error('unknown stages: ' + ', '.join(sorted(unknown_stages)))
+    unknown_tables = set(args.tables or []) - set(source_table_names()) - set(curated_table_names())
+    if unknown_tables:
+        parser.error('unknown tables: ' + ', '.join(sorted(unknown_tables)))
+    if args.start_date > args.end_date:
+        parser.error('--from must not be after --to')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.sample_fraction is not None and not 0 < args.sample_fraction <= 1:
+        parser.error('--sample must be in (0, 1]')
+
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    process_etl(args.start_date, args.end_date, args.tables, args.stages, args.workers, args.compression,
+                args.merge_chunk_rows, args.profile_dir, args.profile_sample_rate, args.dry_run, args.aggregation,
+                args.backend, args.memory_budget, args.dim_user_history, args.sample_fraction)
 
 
-process_etl()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,46 @@
 import pandas as pd
+import io
 import os
-import shutil
 from datetime import datetime, timedelta
 import util
+import profiling
+import sampling
 
 
 
-def extract_events(files, landing_dir, raw_dir):
+def landing_file_path(table_name, landing_dir='landing'):
+    return 'data-lake/' + landing_dir + '/' + table_name + '/' + table_name + '_sample_data.csv'
+
+def extract_events(files, landing_dir, raw_dir, start_date=None, end_date=None):
     """
     This method simulates the extraction process, from landing to raw layer, for all files that has a event_timestamp column.
+    When start_date and end_date are given, only the daily batches in the range are extracted.
     """
     
     print('Generating daily batches data for event tables (with timestamp)')
     
-    input_path = 'data-lake/' + landing_dir + '/{}/{}_sample_data.csv'
-    output_path = 'data-lake/' + raw_dir + '/{}/{}'
-
     for f in files:
 
         # Load the CSV file
-        df = pd.read_csv(input_path.format(f, f))
+        df = util.read_csv(landing_file_path(f, landing_dir))
 
         # Convert event_timestamp to datetime
         df['event_timestamp'] = pd.to_datetime(df['event_timestamp'], format='mixed')
 
+        # Keep only the requested dates
+        if start_date is not None and end_date is not None:
+            event_dates = df['event_timestamp'].dt.normalize()
+            df = df[(event_dates >= pd.Timestamp(start_date).normalize()) & (event_dates <= pd.Timestamp(end_date).normalize())]
+
+        # Keep only the sampled users, when sampling (see sampling.py)
+        landing_rows = len(df)
+        df = sampling.sample(df)
+        sampling.record_table(f, landing_rows, len(df))
+
         # Group by date
         for date, data in df.groupby(df['event_timestamp'].dt.date):
-            # Define directory path for each date
-            date_str = date.strftime('%Y-%m-%d')
-            dir_path = output_path.format(f, date_str, f)
-            os.makedirs(dir_path, exist_ok=True)
-            
-            # Save each group to a CSV file within the date-specific folder
-            data.to_csv(f"{dir_path}/{f}.csv", index=False)
+            # Save each group to a CSV file within the date-specific folder, compressed with the raw layer codec
+            util.write_csv(data, util.data_lake_file_path(f, raw_dir, date))
     return True
 
 
@@ -45,10 +53,23 @@ def extract_user_id(start_date, end_date, landing_dir, raw_dir):
 
     print('Generating daily batches data for user_id')
 
-    user_id_table_name = util.user_id_table_name()
-    src_file_path = 'data-lake/' + landing_dir + '/' + user_id_table_name+ '/' +  user_id_table_name + '_sample_data.csv'
+    user_id_table_name = util.USER_ID.name
+    src_file_path = landing_file_path(user_id_table_name, landing_dir)
     destination_directory = 'data-lake/' + raw_dir + '/' + user_id_table_name + '/'
-    destination_file_name = user_id_table_name + '.csv'
+    destination_file_name = user_id_table_name + '.csv' + util.layer_file_extension(raw_dir)
+
+    # compress the source file only once, all the daily copies share the same content
+    with open(src_file_path, 'rb') as src_file:
+        data = src_file.read()
+    if sampling.fraction is not None:
+        # values read as text, so the sampled users are written as they are in the source file (empty ones are kept)
+        df = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False)
+        user_ids = df['user_id'].mask(df['user_id'] == '')
+        is_sampled = sampling.is_sampled(user_ids)
+        sampled_df = df[is_sampled]
+        sampling.record_table(user_id_table_name, len(df), len(sampled_df), users=(user_ids.nunique(), user_ids[is_sampled].nunique()))
+        data = sampled_df.to_csv(index=False).encode('utf-8')
+    content = util.compress_bytes(data, util.layer_compression.get(raw_dir))
 
     current_date = start_date
     while current_date <= end_date:
@@ -64,21 +85,31 @@ def extract_user_id(start_date, end_date, landing_dir, raw_dir):
         destination_path = os.path.join(destination_folder, destination_file_name)
         
         # Copy the file to the date-specific folder
-        shutil.copy(src_file_path, destination_path)
+        with open(destination_path, 'wb') as destination_file:
+            destination_file.write(content)
+        util.remove_other_codec_copies(destination_path)
         
         # Move to the next day
         current_date += timedelta(days=1)
 
-def extract(start_date, end_date):
+def extract(start_date, end_date, tables=None):
     """
     This process is here only to simulate the daily batches extraction. It will get data from landing layer
     and create the daily increments in raw layer. In an environment closer to real world, we would already start with
     the data from daily increments/batches or something like a CDC.
+    Only the given tables are extracted (all by default), of the sampled users when sampling (see sampling.py).
     """
-    
+    sampling.prepare_data_lake()
+
     landing_dir = 'landing'
     raw_dir = 'raw'
     event_files = ['deposit', 'event', 'user_level', 'withdrawal']
+    if tables is not None:
+        event_files = [f for f in event_files if f in tables]
     
-    extract_events(event_files, landing_dir, raw_dir)
-    extract_user_id(start_date, end_date, landing_dir, raw_dir)
\ No newline at end of file
+    if event_files:
+        with profiling.profile_stage('extract_events'):
+            extract_events(event_files, landing_dir, raw_dir, start_date, end_date)
+    if tables is None or util.USER_ID.name in tables:
+        with profiling.profile_stage('extract_user_id'):
+            extract_user_id(start_date, end_date, landing_dir, raw_dir)
\ No newline at end of file
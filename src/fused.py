@@ -0,0 +1,131 @@
+import pandas as pd
+import numpy as np
+import sketch
+
+# Fused aggregation of user_daily_snapshot and daily_stats. Deposits, withdrawals and logins of the day are unioned
+# into a single typed event stream (user, kind, amount, currency) and the measures of each fact are computed in one
+# grouped pass over it, instead of one group-by per source followed by merges and fillna of each measure.
+# daily_stats is still computed in its own load step, since it needs the user levels loaded for the day.
+# Outputs are the same as load.compute_fact_user_daily_snapshot and load.generate_fact_daily_stats, including the
+# order of the rows (see benchmark_aggregation.py).
+DEPOSIT = 0
+WITHDRAWAL = 1
+LOGIN = 2
+LOGIN_EVENTS = ['login', '2falogin', 'login_api']
+
+
+def daily_event_parts(date, deposit_df, withdrawal_df, event_df=None):
+    """
+    Returns the deposits, withdrawals and (if event_df is given) logins of the date, with user_id, kind and, when
+    the inputs have them, amount and currency. Rows of each kind keep their original order.
+    """
+    snapshot_date = pd.to_datetime(date)
+
+    sources = [(DEPOSIT, deposit_df), (WITHDRAWAL, withdrawal_df)]
+    if event_df is not None:
+        sources.append((LOGIN, event_df[event_df['event_name'].isin(LOGIN_EVENTS)]))
+
+    parts = []
+    for kind, df in sources:
+        on_date = df[df['event_timestamp'].dt.normalize() == snapshot_date]
+        part = on_date.drop(columns=['event_timestamp', 'event_name'], errors='ignore')
+        part.insert(1, 'kind', np.int8(kind))
+        parts.append(part)
+    return parts
+
+def daily_event_stream(date, deposit_df, withdrawal_df, event_df=None):
+    # events of the date as a single DataFrame (see daily_event_parts)
+    return pd.concat(daily_event_parts(date, deposit_df, withdrawal_df, event_df), ignore_index=True)
+
+def compute_fact_user_daily_snapshot(date, user_df, deposit_df, withdrawal_df, event_df):
+    """
+    Same output as load.compute_fact_user_daily_snapshot: counts of each kind of event by user in a single pass.
+    """
+    # the stream is only made of the position of the user of each event in user_df (user_id is its primary key)
+    # and the kind of event, so no strings are copied. Events of users not in user_df are left out.
+    user_index = pd.Index(user_df['user_id'])
+    parts = daily_event_parts(date, deposit_df, withdrawal_df, event_df)
+    user_positions = np.concatenate([user_index.get_indexer(part['user_id']) for part in parts])
+    kinds = np.concatenate([part['kind'].to_numpy() for part in parts])
+    known = user_positions >= 0
+
+    # counts of each (user, kind) in a single pass
+    counts = np.bincount(user_positions[known] * 3 + kinds[known], minlength=len(user_df) * 3)
+    counts = counts.reshape(len(user_df), 3)
+
+    user_snapshot = user_df[['user_id']].copy()
+    user_snapshot['date'] = pd.to_datetime(date)
+    user_snapshot['qty_deposits'] = counts[:, DEPOSIT]
+    user_snapshot['qty_withdrawals'] = counts[:, WITHDRAWAL]
+    user_snapshot['qty_logins'] = counts[:, LOGIN]
+    user_snapshot['is_active'] = (counts[:, DEPOSIT] > 0) | (counts[:, WITHDRAWAL] > 0)
+
+    # users without any event are left out
+    return user_snapshot[counts.any(axis=1)]
+
+def compute_fact_daily_stats(date, user_level_df, deposit_df, withdrawal_df):
+    """
+    Same output as load.generate_fact_daily_stats: deposits and withdrawals are joined to the user level once and
+    amounts and distinct users by level, jurisdiction and currency are computed in a single group-by. Users are
+    hashed once for the three sketches.
+    """
+    snapshot_date = pd.to_datetime(date).normalize()
+    keys = ['level', 'jurisdiction', 'currency']
+
+    # most recent level of each user and jurisdiction until the date, as in load.compute_daily_stats_partials
+    event_dates = user_level_df['event_timestamp'].dt.normalize()
+    user_level_on_date = (
+        user_level_df.assign(event_date=event_dates)[event_dates <= snapshot_date]
+        .sort_values(by=['user_id', 'jurisdiction', 'event_date'], ascending=[True, True, False])
+        .drop_duplicates(subset=['user_id', 'jurisdiction'], keep='first')
+    )
+    levels = user_level_on_date[['level', 'jurisdiction']].drop_duplicates()
+
+    stream = daily_event_stream(snapshot_date, deposit_df, withdrawal_df)
+    joined = stream.merge(user_level_on_date[['user_id', 'level', 'jurisdiction']], on='user_id', how='inner')
+
+    # measures of the other kind are NaN, so they are skipped by sum and nunique
+    is_deposit = (joined['kind'] == DEPOSIT).to_numpy()
+    measures = joined[keys].copy()
+    measures['total_deposit_amount'] = joined['amount'].where(is_deposit)
+    measures['total_withdrawal_amount'] = joined['amount'].where(~is_deposit)
+    measures['deposit_user_id'] = joined['user_id'].where(is_deposit)
+    measures['withdrawal_user_id'] = joined['user_id'].where(~is_deposit)
+
+    fact_daily_stats = measures.groupby(keys, as_index=False).agg(
+        total_deposit_amount=('total_deposit_amount', 'sum'),
+        total_withdrawal_amount=('total_withdrawal_amount', 'sum'),
+        total_distinct_deposit_users=('deposit_user_id', 'nunique'),
+        total_distinct_withdrawal_users=('withdrawal_user_id', 'nunique')
+    )
+
+    # active users are counted by level and jurisdiction
+    total_active_users = joined.groupby(['level', 'jurisdiction'])['user_id'].nunique().rename('total_active_users')
+    fact_daily_stats = fact_daily_stats.join(total_active_users, on=['level', 'jurisdiction'])
+
+    # sketches of the three measures from a single hash of the users
+    registers, ranks = sketch.register_ranks(sketch.hash_values(joined['user_id'].to_numpy()))
+    sketches = [
+        (sketch.sketch_by_group_from_ranks(joined.loc[is_deposit, keys], registers[is_deposit], ranks[is_deposit], 'deposit_users_sketch'), keys),
+        (sketch.sketch_by_group_from_ranks(joined.loc[~is_deposit, keys], registers[~is_deposit], ranks[~is_deposit], 'withdrawal_users_sketch'), keys),
+        (sketch.sketch_by_group_from_ranks(joined[['level', 'jurisdiction']], registers, ranks, 'active_users_sketch'), ['level', 'jurisdiction'])
+    ]
+    for sketches_df, sketch_keys in sketches:
+        fact_daily_stats = fact_daily_stats.join(sketches_df.set_index(sketch_keys), on=sketch_keys)
+
+    # same order as the original: user levels order, then currencies with deposits before withdrawal only ones
+    level_order = pd.MultiIndex.from_frame(levels).get_indexer(pd.MultiIndex.from_frame(fact_daily_stats[['level', 'jurisdiction']]))
+    fact_daily_stats['level_order'] = level_order
+    fact_daily_stats['withdrawal_only'] = fact_daily_stats['total_distinct_deposit_users'] == 0
+    fact_daily_stats = fact_daily_stats.sort_values(['level_order', 'withdrawal_only'], kind='stable')
+
+    fact_daily_stats['date'] = snapshot_date
+    fact_daily_stats.fillna({'active_users_sketch': '', 'withdrawal_users_sketch': '', 'deposit_users_sketch': ''}, inplace=True)
+    for count_column in ['total_active_users', 'total_distinct_withdrawal_users', 'total_distinct_deposit_users']:
+        fact_daily_stats[count_column] = fact_daily_stats[count_column].astype(int)
+
+    return fact_daily_stats[['date', 'currency', 'level', 'jurisdiction',
+                             'total_active_users', 'total_distinct_withdrawal_users',
+                             'total_distinct_deposit_users',
+                             'total_withdrawal_amount', 'total_deposit_amount',
+                             'active_users_sketch', 'withdrawal_users_sketch', 'deposit_users_sketch']].reset_index(drop=True)
@@ -0,0 +1,199 @@
+import json
+import pandas as pd
+import numpy as np
+import os
+import bloom
+
+# Persistent index of the ids accepted by cleanup for tables with TableSpec.id_index, used to catch ids re-sent
+# on a later day without reading the history of the table. For each table it keeps sorted int64 arrays of ids and,
+# aligned with them, the batch date each id was accepted in (as days since epoch), so reprocessing a batch replaces its
+# own ids instead of rejecting them.
+# The arrays are stored in segments in data-lake/trusted/_id_index/<table>/: each batch appends a segment with its
+# ids, and the last segment is merged into the previous one while it's as large, so there are O(log ids) segments and
+# a batch doesn't rewrite the whole history. Only reprocessing a batch rewrites the segments with its ids.
+# A Bloom filter in front of the segments answers most lookups of new ids without a binary search. New ids only set
+# their own bits, the filter is rebuilt when a reprocessed batch removes ids or when the ids outgrow it (it's sized
+# for twice the ids). manifest.json lists the segments and the filter and is replaced last, so an interrupted update
+# leaves the previous index (with a few more bits set at most).
+NOT_FOUND = -1
+BLOOM_BITS_PER_ID = 10
+BLOOM_HASHES = 7
+# ids the Bloom filter is sized for at least, and ids hashed at once when it's rebuilt
+BLOOM_MIN_IDS = 1024
+BLOOM_CHUNK_IDS = 1 << 20
+
+# set to False to look up every id in the segments
+use_bloom_filter = True
+
+
+def id_index_dir(table_name):
+    return 'data-lake/trusted/_id_index/' + table_name
+
+def manifest_path(table_name):
+    return os.path.join(id_index_dir(table_name), 'manifest.json')
+
+def array_path(table_name, name):
+    return os.path.join(id_index_dir(table_name), name + '.npy')
+
+def batch_day(date):
+    return int((pd.Timestamp(date).normalize() - pd.Timestamp('1970-01-01')).days)
+
+def empty_manifest():
+    # bloom is {'name', 'capacity'}, None without a filter
+    return {'segments': [], 'bloom': None, 'next_file': 0}
+
+def write_manifest(table_name, manifest):
+    path = manifest_path(table_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(path + '.tmp', path)
+
+def read_manifest(table_name):
+    path = manifest_path(table_name)
+    if os.path.isfile(path):
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    return empty_manifest()
+
+def write_array(table_name, manifest, prefix, array):
+    # files are never rewritten, each version has a new name
+    name = prefix + '-' + str(manifest['next_file']).zfill(6)
+    manifest['next_file'] += 1
+    os.makedirs(id_index_dir(table_name), exist_ok=True)
+    np.save(array_path(table_name, name), array)
+    return name
+
+def write_segment(table_name, manifest, ids, days):
+    name = write_array(table_name, manifest, 'segment', ids)
+    np.save(array_path(table_name, name + '.days'), days)
+    return {'name': name, 'rows': len(ids), 'days': np.unique(days).tolist()}
+
+def read_segment(table_name, segment, mmap_mode=None):
+    return {
+        'ids': np.load(array_path(table_name, segment['name']), mmap_mode=mmap_mode),
+        'days': np.load(array_path(table_name, segment['name'] + '.days'), mmap_mode=mmap_mode)
+    }
+
+def remove_segment(table_name, segment):
+    for name in [segment['name'], segment['name'] + '.days']:
+        os.remove(array_path(table_name, name))
+
+def merge_segments(table_name, manifest, first, second):
+    first, second = read_segment(table_name, first), read_segment(table_name, second)
+    positions = np.searchsorted(first['ids'], second['ids'])
+    return write_segment(table_name, manifest, np.insert(first['ids'], positions, second['ids']), np.insert(first['days'], positions, second['days']))
+
+def read_id_index(table_name):
+    """
+    Segments of the index ({'ids', 'days'}, memory mapped) and its Bloom filter (empty without one).
+    """
+    manifest = read_manifest(table_name)
+    bloom_file = manifest['bloom']
+    return {
+        'segments': [read_segment(table_name, segment, mmap_mode='r') for segment in manifest['segments']],
+        'bloom': np.load(array_path(table_name, bloom_file['name']), mmap_mode='r') if bloom_file is not None else np.zeros(0, dtype=np.uint8)
+    }
+
+def id_hashes(ids):
+    return pd.util.hash_array(np.asarray(ids, dtype=np.int64))
+
+def new_bloom_filter(capacity):
+    return bloom.new_filter(capacity * BLOOM_BITS_PER_ID)
+
+def bloom_add(bits, ids):
+    bloom.add(bits, id_hashes(ids), len(bits) * 8, BLOOM_HASHES)
+
+def bloom_might_contain(bits, ids):
+    if len(bits) == 0:
+        # index without a Bloom filter, every id is a candidate
+        return np.ones(len(ids), dtype=bool)
+    return bloom.contains(bits, id_hashes(ids), len(bits) * 8, BLOOM_HASHES)
+
+def update_bloom_filter(table_name, manifest, new_ids, rebuild=False):
+    """
+    Sets the bits of new_ids in the Bloom filter of the index, or writes a new filter from all the segments when
+    rebuild is set or the ids outgrow it.
+    """
+    bloom_file = manifest['bloom']
+    ids = sum(segment['rows'] for segment in manifest['segments'])
+    if not use_bloom_filter:
+        manifest['bloom'] = None
+    elif rebuild or bloom_file is None or ids > bloom_file['capacity']:
+        capacity = max(2 * ids, BLOOM_MIN_IDS)
+        bits = new_bloom_filter(capacity)
+        for segment in manifest['segments']:
+            segment_ids = read_segment(table_name, segment, mmap_mode='r')['ids']
+            for start in range(0, len(segment_ids), BLOOM_CHUNK_IDS):
+                bloom_add(bits, segment_ids[start:start + BLOOM_CHUNK_IDS])
+        manifest['bloom'] = {'name': write_array(table_name, manifest, 'bloom', bits), 'capacity': capacity}
+    elif len(new_ids):
+        bits = np.load(array_path(table_name, bloom_file['name']), mmap_mode='r+')
+        bloom_add(bits, new_ids)
+        bits.flush()
+
+def lookup(index, ids):
+    """
+    Returns, for each id, the batch day it was accepted in, or NOT_FOUND.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    days = np.full(len(ids), NOT_FOUND, dtype=np.int32)
+    if not index['segments']:
+        return days
+
+    candidates = np.flatnonzero(bloom_might_contain(index['bloom'], ids) if use_bloom_filter else np.ones(len(ids), dtype=bool))
+    for segment in index['segments']:
+        positions = np.minimum(np.searchsorted(segment['ids'], ids[candidates]), len(segment['ids']) - 1)
+        found = segment['ids'][positions] == ids[candidates]
+        days[candidates[found]] = segment['days'][positions[found]]
+    return days
+
+def cross_day_duplicates(table_name, batch_date, ids):
+    """
+    Mask of the ids already accepted in a different batch. Ids accepted in batch_date itself are not duplicates,
+    so reprocessing a batch is idempotent.
+    """
+    days = lookup(read_id_index(table_name), ids)
+    return (days != NOT_FOUND) & (days != batch_day(batch_date))
+
+def update_id_index(table_name, batch_date, ids):
+    """
+    Replaces the ids recorded for batch_date with the ids accepted in the batch. Only the new batch is sorted and
+    appended as a segment, and its ids set their bits in the Bloom filter.
+    """
+    manifest = read_manifest(table_name)
+    day = batch_day(batch_date)
+    new_ids = np.unique(np.asarray(ids, dtype=np.int64))
+    previous_bloom = manifest['bloom']
+    removed = []
+
+    # a reprocessed batch replaces its ids, the segments with them are rewritten without them
+    segments = []
+    for segment in manifest['segments']:
+        if day not in segment['days']:
+            segments.append(segment)
+            continue
+        removed.append(segment)
+        data = read_segment(table_name, segment)
+        keep = data['days'] != day
+        if keep.any():
+            segments.append(write_segment(table_name, manifest, data['ids'][keep], data['days'][keep]))
+    reprocessed = bool(removed)
+
+    if len(new_ids):
+        segments.append(write_segment(table_name, manifest, new_ids, np.full(len(new_ids), day, dtype=np.int32)))
+    # segments grow geometrically: the last one is merged into the previous one while it's as large
+    while len(segments) > 1 and segments[-2]['rows'] <= segments[-1]['rows']:
+        last, previous = segments.pop(), segments.pop()
+        segments.append(merge_segments(table_name, manifest, previous, last))
+        removed += [previous, last]
+    manifest['segments'] = segments
+
+    update_bloom_filter(table_name, manifest, new_ids, rebuild=reprocessed)
+    write_manifest(table_name, manifest)
+
+    # files of the previous version, once the manifest doesn't list them
+    for segment in removed:
+        remove_segment(table_name, segment)
+    if previous_bloom is not None and previous_bloom != manifest['bloom']:
+        os.remove(array_path(table_name, previous_bloom['name']))
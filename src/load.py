@@ -3,222 +3,354 @@ import sys
 import os
 from datetime import datetime, timedelta
 import util
+import sketch
+import rollup
+import activity_index
+import shard
+import profiling
+import fused
+import pandas_backend
+import block_index
+import memory
+import catalog
+
+# Aggregation engine of user_daily_snapshot and daily_stats: 'default' for the step by step aggregations of this module,
+# 'fused' for the single pass aggregations over a daily event stream (see fused.py). Both produce the same rows.
+AGGREGATION_ENGINES = ['default', 'fused']
+aggregation_engine = 'default'
+
+def set_aggregation_engine(engine):
+    global aggregation_engine
+    if engine not in AGGREGATION_ENGINES:
+        raise ValueError(f"Unsupported aggregation engine: {engine}")
+    aggregation_engine = engine
+
+# Backend that runs the generate and merge logic of the load steps: 'pandas' (pandas_backend.py) or 'arrow'
+# (arrow_backend.py, multithreaded pyarrow.compute kernels on Arrow tables). Sharded (workers > 1) and fused
+# aggregations are pandas only, the arrow backend ignores them. Run src/benchmark_backend.py to compare them.
+BACKENDS = ['pandas', 'arrow']
+backend = pandas_backend
+
+def set_backend(name):
+    global backend
+    if name not in BACKENDS:
+        raise ValueError(f"Unsupported backend: {name}")
+    if name == 'arrow':
+        # pyarrow is only needed by this backend
+        import arrow_backend
+        backend = arrow_backend
+    else:
+        backend = pandas_backend
 
-def read_user_id_dataframe(date):
-    
-    user_file_path = util.data_lake_file_path(util.user_id_table_name(), 'trusted', date)
-    user_df = pd.read_csv(user_file_path)
+def uses_pandas_backend():
+    return backend.NAME == 'pandas'
 
-    user_df['user_id'] = user_df['user_id'].astype(str)
+# Type 2 history of dim_user (dim_user_history), next to dim_user which only has the current values
+dim_user_history = False
 
-    return user_df
+def set_dim_user_history(enabled):
+    global dim_user_history
+    dim_user_history = enabled
+
+def read_user_id_dataframe(date):
+    return backend.read(util.USER_ID.name, 'trusted', date)
 
 def read_user_level_dataframe(date):
-    
-    user_level_file_path = util.data_lake_file_path(util.user_level_table_name(), 'trusted', date)
+    return backend.read(util.USER_LEVEL.name, 'trusted', date)
 
-    if not os.path.isfile(user_level_file_path): 
-        user_level_df = util.create_empty_dataframe(util.user_level_schema())
-    else:
-        user_level_df = pd.read_csv(user_level_file_path)
-    
-    user_level_df['event_timestamp'] = pd.to_datetime(user_level_df['event_timestamp'], format='mixed')
-    user_level_df['user_id'] = user_level_df['user_id'].astype(str)
+def read_fact_user_level_dataframe(until_date=None):
+    # levels up to a date, older rows are skipped while reading
+    path = util.resolve_file_path(util.USER_LEVEL.file_path('curated'))
+    if until_date is not None and uses_pandas_backend() and memory.exceeds_budget(path):
+        return read_latest_user_levels_in_chunks(until_date, memory.chunk_rows(util.sample_row_bytes(path)))
+    predicates = [('event_timestamp', 'date<=', until_date)] if until_date is not None else None
+    return backend.read(util.USER_LEVEL.name, 'curated', predicates=predicates)
 
-    return user_level_df
+def read_latest_user_levels_in_chunks(until_date, chunksize):
+    """
+    Latest level of each user and jurisdiction up to a date, for user_level tables larger than the memory budget:
+    chunks are reduced as they are read, keeping the same row daily_stats keeps (latest event date, first in the
+    table among the rows of that date).
+    """
+    keys = ['user_id', 'jurisdiction']
+    latest = util.empty_table_dataframe(util.USER_LEVEL.name)
+    for chunk in util.load_csv_chunks(util.USER_LEVEL.name, 'curated', chunksize=chunksize):
+        chunk = chunk[chunk['event_timestamp'].dt.normalize() <= until_date]
+        df = pandas_backend.with_date(pandas_backend.concat([latest, chunk]), 'event_date', 'event_timestamp')
+        df = df.sort_values(by=keys + ['event_date'], ascending=[True, True, False], kind='stable')
+        latest = df.drop_duplicates(subset=keys, keep='first').drop(columns='event_date')
+    return latest.reset_index(drop=True)
+
+def read_event_dataframe(date, columns=None):
+    return backend.read(util.EVENT.name, 'trusted', date, columns)
+
+def load_curated_table(date, spec, source_df, merge_function):
+    """
+    Generic load of a curated table: reads the destination table (if it exists), merges the new increment
+    into it with merge_function(date, source_df, destination_df) and writes the result.
+    Returns the destination table as it was before the load (empty on first processing), so callers can
+    maintain derived tables incrementally.
+
+    Fact tables are merged in chunks when util.merge_chunk_rows is set (see merge_curated_table_in_chunks), in that
+    case only the rows the destination had for the date are returned. Otherwise, with the pandas backend, only the
+    blocks of fact tables with rows of the date are read and merged (see merge_curated_table_blocks), and the rows of
+    those blocks are returned. Fact tables estimated above the memory budget (see memory.py) are merged in chunks.
+    Tables are read, merged and written with the selected backend, the returned table is a pandas DataFrame.
+    """
+    destination_path = spec.file_path('curated')
 
-def read_fact_user_level_dataframe():
-    
-    fact_user_level_file_path = 'data-lake/curated/' + util.user_level_table_name() + '.csv'
+    if util.merge_chunk_rows and spec.date_column and util.resolve_file_path(destination_path) is not None:
+        return merge_curated_table_in_chunks(date, spec, backend.to_pandas(source_df), util.merge_chunk_rows)
 
-    if not os.path.isfile(fact_user_level_file_path): 
-        fact_user_level_df = util.create_empty_dataframe(util.user_level_schema())
-    else:
-        fact_user_level_df = pd.read_csv(fact_user_level_file_path)
-    
-    fact_user_level_df['event_timestamp'] = pd.to_datetime(fact_user_level_df['event_timestamp'], format='mixed')
-    fact_user_level_df['user_id'] = fact_user_level_df['user_id'].astype(str)
+    if uses_pandas_backend() and spec.date_column and block_index.read_index(destination_path) is not None:
+        return merge_curated_table_blocks(date, spec, source_df, merge_function)
 
-    return fact_user_level_df
+    # fact tables larger than the memory budget are merged in chunks too
+    resolved_path = util.resolve_file_path(destination_path)
+    if spec.date_column and memory.exceeds_budget(resolved_path):
+        chunksize = memory.chunk_rows(util.sample_row_bytes(resolved_path))
+        return merge_curated_table_in_chunks(date, spec, backend.to_pandas(source_df), chunksize)
 
-def read_event_dataframe(date):
-    
-    event_file_path = util.data_lake_file_path(util.event_table_name(), 'trusted', date)
-    if not os.path.isfile(event_file_path): 
-        event_df = util.create_empty_dataframe(util.event_schema())
-    else:
-        event_df = pd.read_csv(event_file_path)
+    if util.resolve_file_path(destination_path) is not None:
+        destination_df = backend.read(spec.name, 'curated')
+        final_df = merge_function(date, source_df, destination_df)
+        backend.write(final_df, destination_path)
+        catalog.record(spec.name, 'curated', None, backend.to_pandas(final_df))
+        return backend.to_pandas(destination_df)
+
+    # if destination data file doesn't exist yet (first processing)
+    backend.write(source_df, destination_path)
+    catalog.record(spec.name, 'curated', None, backend.to_pandas(source_df))
+    return backend.to_pandas(backend.empty_like(source_df))
+
+def merge_curated_table_in_chunks(date, spec, source_df, chunksize):
+    """
+    Out of core version of the merge of fact tables: streams the destination table in chunks of chunksize rows,
+    dropping the rows of the date being loaded (so the process is idempotent) and the rows whose primary key is
+    in the increment (the increment wins, as drop_duplicates(keep='last') does in the merge functions),
+    and appends the increment at the end. Memory is bounded by the chunk size plus the increment.
+    Returns the rows the destination had for the date.
+    """
+    load_date = pd.to_datetime(date).normalize()
+    source_df = source_df.drop_duplicates(subset=spec.primary_keys, keep='last')
+    source_keys = pd.MultiIndex.from_frame(source_df[spec.primary_keys])
 
-    # Convert event_timestamp to datetime
-    event_df['event_timestamp'] = pd.to_datetime(event_df['event_timestamp'], format='mixed')
-    event_df['user_id'] = event_df['user_id'].astype(str)
+    old_day_chunks = []
+    partials = [catalog.partial_stats(source_df)]
 
-    return event_df
+    def merged_chunks():
+        for chunk in util.load_csv_chunks(spec.name, 'curated', chunksize=chunksize):
+            on_load_date = chunk[spec.date_column].dt.normalize() == load_date
+            old_day_chunks.append(chunk[on_load_date])
+            in_source = pd.MultiIndex.from_frame(chunk[spec.primary_keys]).isin(source_keys)
+            partials.append(catalog.partial_stats(chunk[~on_load_date & ~in_source]))
+            yield chunk[~on_load_date & ~in_source]
+        yield source_df
+
+    util.write_csv_chunks(merged_chunks(), spec.file_path('curated'))
+    catalog.record_stats(spec.name, 'curated', None, partials)
+
+    return pd.concat(old_day_chunks, ignore_index=True) if old_day_chunks else source_df.iloc[0:0]
+
+def merge_curated_table_blocks(date, spec, source_df, merge_function):
+    """
+    Merge of fact tables reading only the blocks of the destination that have rows of the date: merge functions only
+    replace the rows of the date, so the other blocks are copied to the new version of the file without parsing them.
+    The last block is merged too when it's smaller than block_index.BLOCK_ROWS, so loading each day doesn't leave a
+    small block per day. In tables clustered by user (see clustering.py), dates after the compaction are only looked
+    for in the blocks appended since. Tables keyed by id also merge the blocks whose id range overlaps the increment,
+    so ids re-sent from another date replace their old rows as in the full merge. Returns the rows of the blocks merged.
+    """
+    path = spec.file_path('curated')
+    index = block_index.read_index(path)
+    positions = block_index.selected_blocks(index, [(spec.date_column, 'date==', date)], spec)
+
+    # blocks clustered by user have rows of every date until their last one, later dates are only in the next blocks
+    clustered = index.get('clustered', {'blocks': 0, 'until': None})
+    if clustered['blocks'] and pd.to_datetime(date).normalize() > pd.Timestamp(clustered['until']):
+        positions = [position for position in positions if position >= clustered['blocks']]
+
+    # the merge drops rows of other dates whose key is loaded again (ids re-sent on another day), in the blocks whose
+    # key range overlaps the increment
+    if spec.date_column not in spec.primary_keys and len(spec.primary_keys) == 1 and len(source_df):
+        key = source_df[spec.primary_keys[0]]
+        key_range = [(key.name, '>=', key.min()), (key.name, '<=', key.max())]
+        positions += [position for position in block_index.selected_blocks(index, key_range, spec) if position not in positions]
+
+    last_position = len(index['blocks']) - 1
+    if last_position >= clustered['blocks'] and last_position not in positions and index['blocks'][last_position]['rows'] < block_index.BLOCK_ROWS:
+        positions.append(last_position)
+
+    frames = block_index.read_blocks(path, index, positions, spec, index['columns'])
+    destination_df = pd.concat(frames, ignore_index=True) if frames else util.empty_table_dataframe(spec.name, index['columns'])
+    final_df = merge_function(date, source_df, destination_df)
+
+    copied_blocks = [block for position, block in enumerate(index['blocks']) if position not in positions]
+    # merged clustered blocks move after the others
+    clustered = dict(clustered, blocks=len([position for position in range(clustered['blocks']) if position not in positions]))
+    users = catalog.curated_users_stats(spec.name)
+    block_index.write(copied_blocks + [final_df], path, clustered=clustered)
+
+    # statistics of the copied blocks from the block index, users from the replaced and merged rows
+    if users is None:
+        catalog.record_file(spec.name, 'curated')
+    else:
+        partials = [catalog.block_stats(block) for block in copied_blocks] + [users, catalog.removed_users_stats(destination_df)]
+        catalog.record_stats(spec.name, 'curated', None, partials + [catalog.partial_stats(final_df)])
+    return destination_df
 
-def generate_dim_user(date):
+def generate_dim_user(date, workers=1):
     
     user_df = read_user_id_dataframe(date)
-    event_df = read_event_dataframe(date)
-    
-    # Merge the DataFrames
-    merged_df = pd.merge(user_df, event_df, on='user_id', how='left')
+    event_df = read_event_dataframe(date, columns=['event_timestamp', 'user_id', 'event_name'])
 
-    # Filter for login events
-    login_events = merged_df[(merged_df['event_name'] == 'login') | (merged_df['event_name'].isnull())]
+    if workers > 1 and uses_pandas_backend():
+        return shard.run_by_user(compute_dim_user, [user_df, event_df], workers)
+    return compute_dim_user(user_df, event_df)
 
-    # Get the latest login for each user
-    result_df = login_events.groupby('user_id', as_index=False)['event_timestamp'].max()
-    result_df.rename(columns={'event_timestamp': 'last_login'}, inplace=True)
+def compute_dim_user(user_df, event_df):
+    
+    # Filter for login events before merging, so every user is kept even if all its events in the day are not logins
+    # (otherwise the rows of a day would depend on which events arrived, and late arriving events couldn't be recomputed)
+    login_events = backend.filter(event_df, [('event_name', '==', 'login')])
 
-    #result_df['last_login'] = pd.to_datetime(result_df['last_login'], format='mixed')
+    # Merge the DataFrames
+    merged_df = backend.join(user_df, login_events, on='user_id', how='left')
 
-    return result_df
+    # Get the latest login for each user
+    return backend.group_aggregate(merged_df, ['user_id'], {'last_login': ('event_timestamp', 'max')})
 
 def merge_dim_user(source_df, destination_df):
     
-    merged_df = destination_df.merge(source_df, on='user_id', how='outer', suffixes=('_dest', '_src'))
-    merged_df['last_login'] = merged_df[['last_login_dest', 'last_login_src']].max(axis=1)
-    result_df = merged_df[['user_id', 'last_login']]
+    merged_df = backend.join(destination_df, source_df, on='user_id', how='outer', suffixes=('_dest', '_src'))
+    merged_df = backend.row_max(merged_df, 'last_login', ['last_login_dest', 'last_login_src'])
+    result_df = backend.select(merged_df, ['user_id', 'last_login'])
     
     # Drop any duplicate rows if necessary
-    result_df.drop_duplicates(subset=['user_id'], inplace=True)
-    
-    return result_df
+    return backend.dedupe(result_df, ['user_id'], keep='first')
 
-def load_dim_user(date):
-    
-    print('Loading Dim User for ' + date.strftime("%Y-%m-%d"))
-    
-    new_df = generate_dim_user(date)
-    destination_df_path = 'data-lake/curated/' + util.dim_user_table_name() + '.csv'
+def merge_dim_user_history(date, source_df, history_df):
+    """
+    Type 2 merge of the last logins of a day into dim_user_history. Only the versions of the users of the day change:
+    the logins of the day raise the last_login of the versions from the date on (as merge_dim_user keeps the latest
+    login, so loading an earlier date again gives the same versions), a version valid from the date is added and
+    versions with the same last_login as the previous one of the user are merged into it.
+    """
+    load_date = pd.to_datetime(date).normalize()
+    source_df = source_df[['user_id', 'last_login']].drop_duplicates(subset=['user_id'], keep='last')
 
-    # Ensure the directory exists
-    os.makedirs(os.path.dirname(destination_df_path), exist_ok=True)
+    is_updated = history_df['user_id'].isin(source_df['user_id'])
+    versions = history_df[is_updated & (history_df['valid_from'] != load_date)].drop(columns='valid_to')
+    day_login = versions['user_id'].map(source_df.set_index('user_id')['last_login'])
+    is_later = versions['valid_from'] > load_date
+    versions['last_login'] = versions['last_login'].mask(is_later, pd.concat([versions['last_login'], day_login], axis=1).max(axis=1))
 
-    if os.path.isfile(destination_df_path): 
-        destination_df = pd.read_csv(destination_df_path)
-        destination_df['last_login'] = pd.to_datetime(destination_df['last_login'], format='mixed')
-        final_df = merge_dim_user(new_df, destination_df)
-        final_df.to_csv(destination_df_path, index=False)
-    else:
-        # if dim data file doesn't exist yet (first processing)
-        new_df.to_csv(destination_df_path, index=False)
+    # value on the date: the latest earlier version raised by the logins of the day
+    earlier = versions[~is_later].sort_values(['user_id', 'valid_from']).drop_duplicates(subset=['user_id'], keep='last')
+    day_df = source_df.merge(earlier[['user_id', 'last_login']], on='user_id', how='left', suffixes=('', '_before'))
+    day_df = day_df.assign(last_login=day_df[['last_login', 'last_login_before']].max(axis=1), valid_from=load_date)
 
+    versions = pandas_backend.concat([versions, day_df[['user_id', 'last_login', 'valid_from']]])
+    versions = versions.sort_values(['user_id', 'valid_from'], kind='stable', ignore_index=True)
+    same_user = versions['user_id'].eq(versions['user_id'].shift())
+    previous_login = versions['last_login'].shift()
+    unchanged = same_user & (versions['last_login'].eq(previous_login) | (versions['last_login'].isna() & previous_login.isna()))
+    versions = versions[~unchanged].reset_index(drop=True)
 
-def generate_fact_deposit(date, deposit_table_name, deposit_schema):
-    deposit_file_path = util.data_lake_file_path(deposit_table_name, 'trusted', date)
+    # a version is valid until the next one of the user
+    versions['valid_to'] = versions['valid_from'].shift(-1).where(versions['user_id'].eq(versions['user_id'].shift(-1)))
 
-    if not os.path.isfile(deposit_file_path): 
-        deposit_df = util.create_empty_dataframe(deposit_schema)
-    else:
-        deposit_df = pd.read_csv(deposit_file_path)
-        
-    deposit_df['event_timestamp'] = pd.to_datetime(deposit_df['event_timestamp'], format='mixed')
-    deposit_df['user_id'] = deposit_df['user_id'].astype(str)
+    history_df = pandas_backend.concat([history_df[~is_updated], versions])
+    return history_df.sort_values(['user_id', 'valid_from'], kind='stable', ignore_index=True)
+
+def load_dim_user_history(date, new_df):
+    history_df = util.load_csv_to_dataframe(util.DIM_USER_HISTORY.name, 'curated')
+    history_df = merge_dim_user_history(date, backend.to_pandas(new_df), history_df)
+    util.write_csv(history_df, util.DIM_USER_HISTORY.file_path('curated'))
+    catalog.record(util.DIM_USER_HISTORY.name, 'curated', None, history_df)
+
+def load_dim_user(date, workers=1, increment=None):
+    
+    print('Loading Dim User for ' + date.strftime("%Y-%m-%d"))
+    
+    new_df = generate_dim_user(date, workers) if increment is None else increment
+    load_curated_table(date, util.DIM_USER, new_df, lambda date, source_df, destination_df: merge_dim_user(source_df, destination_df))
+
+    # dim_user keeps the current values, the history their changes
+    if dim_user_history:
+        load_dim_user_history(date, new_df)
 
-    return deposit_df
+
+def generate_fact_deposit(date, columns=None):
+    return backend.read(util.DEPOSIT.name, 'trusted', date, columns)
 
 def merge_fact_deposit(date, source_df, destination_df):
     # Convert the date parameter to a Timestamp for comparison
     load_date = pd.to_datetime(date)
 
     # Filter out rows in destination_df that match the specified date in event_timestamp, so the process is idempotent
-    destination_df = destination_df[
-        destination_df['event_timestamp'].dt.date != load_date.date()
-    ]
+    destination_df = backend.filter(destination_df, [('event_timestamp', 'date!=', load_date)])
     
     # Append new data from source_df to the updated destination_df
-    updated_destination_df = pd.concat([destination_df, source_df], ignore_index=True)
-
-    # Remove any duplicates by 'id', keeping the last occurrence (in case of retries)
-    updated_destination_df.drop_duplicates(subset='id', keep='last', inplace=True)
+    updated_destination_df = backend.concat([destination_df, source_df])
 
-    return updated_destination_df
+    # Remove any duplicates by 'id', keeping the last occurrence (in case of retries, or of ids loaded on another day
+    # before cleanup rejected them, see id_index.py)
+    return backend.dedupe(updated_destination_df, ['id'], keep='last')
 
-def load_fact_deposit(date):
+def load_fact_deposit(date, workers=1, increment=None):
     
     print('Loading Fact Deposit for ' + date.strftime("%Y-%m-%d"))
     
-    deposit_table_name = util.deposit_table_name()
-    deposit_schema = util.deposit_schema()
-    daily_deposit_df = generate_fact_deposit(date, deposit_table_name, deposit_schema)
-
-    destination_deposit_df_path = 'data-lake/curated/' + deposit_table_name + '.csv'
-
-    if os.path.isfile(destination_deposit_df_path): 
-        destination_deposit_df = pd.read_csv(destination_deposit_df_path)
-        destination_deposit_df['event_timestamp'] = pd.to_datetime(destination_deposit_df['event_timestamp'], format='mixed')
-        final_df = merge_fact_deposit(date, daily_deposit_df, destination_deposit_df)
-        final_df.to_csv(destination_deposit_df_path, index=False)
-    else:
-        # if dim data file doesn't exist yet (first processing)
-        daily_deposit_df.to_csv(destination_deposit_df_path, index=False)
-
+    daily_deposit_df = generate_fact_deposit(date) if increment is None else increment
+    load_curated_table(date, util.DEPOSIT, daily_deposit_df, merge_fact_deposit)
 
-def generate_fact_withdrawal(date, withdrawal_table_name, withdrawal_schema):
-    withdrawal_file_path = util.data_lake_file_path(withdrawal_table_name, 'trusted', date)
 
-    if not os.path.isfile(withdrawal_file_path): 
-        withdrawal_df = util.create_empty_dataframe(withdrawal_schema)
-    else:
-        withdrawal_df = pd.read_csv(withdrawal_file_path)
-    
-    withdrawal_df['event_timestamp'] = pd.to_datetime(withdrawal_df['event_timestamp'], format='mixed')
-    withdrawal_df['user_id'] = withdrawal_df['user_id'].astype(str)
-
-    return withdrawal_df
+def generate_fact_withdrawal(date, columns=None):
+    return backend.read(util.WITHDRAWAL.name, 'trusted', date, columns)
 
 def merge_fact_withdrawal(date, source_df, destination_df):
     # Convert the date parameter to a Timestamp for comparison
     load_date = pd.to_datetime(date)
 
     # Filter out rows in destination_df that match the specified date in event_timestamp, so the process is idempotent
-    destination_df = destination_df[
-        destination_df['event_timestamp'].dt.date != load_date.date()
-    ]
+    destination_df = backend.filter(destination_df, [('event_timestamp', 'date!=', load_date)])
     
     # Append new data from source_df to the updated destination_df
-    updated_destination_df = pd.concat([destination_df, source_df], ignore_index=True)
-
-    # Remove any duplicates by 'id', keeping the last occurrence (in case of retries)
-    updated_destination_df.drop_duplicates(subset='id', keep='last', inplace=True)
+    updated_destination_df = backend.concat([destination_df, source_df])
 
-    return updated_destination_df
+    # Remove any duplicates by 'id', keeping the last occurrence (in case of retries, or of ids loaded on another day
+    # before cleanup rejected them, see id_index.py)
+    return backend.dedupe(updated_destination_df, ['id'], keep='last')
 
-def load_fact_withdrawal(date):
+def load_fact_withdrawal(date, workers=1, increment=None):
     
     print('Loading Fact Withdrawal for ' + date.strftime("%Y-%m-%d"))
     
-    withdrawal_table_name = util.withdrawal_table_name()
-    withdrawal_schema = util.withdrawal_schema()
-    daily_withdrawal_df = generate_fact_withdrawal(date, withdrawal_table_name, withdrawal_schema)
-
-    destination_withdrawal_df_path = 'data-lake/curated/' + withdrawal_table_name + '.csv'
-
-    if os.path.isfile(destination_withdrawal_df_path): 
-        destination_withdrawal_df = pd.read_csv(destination_withdrawal_df_path)
-        destination_withdrawal_df['event_timestamp'] = pd.to_datetime(destination_withdrawal_df['event_timestamp'], format='mixed')
-        final_df = merge_fact_withdrawal(date, daily_withdrawal_df, destination_withdrawal_df)
-        final_df.to_csv(destination_withdrawal_df_path, index=False)
-    else:
-        # if dim data file doesn't exist yet (first processing)
-        daily_withdrawal_df.to_csv(destination_withdrawal_df_path, index=False)
+    daily_withdrawal_df = generate_fact_withdrawal(date) if increment is None else increment
+    load_curated_table(date, util.WITHDRAWAL, daily_withdrawal_df, merge_fact_withdrawal)
 
 
-def generate_fact_user_level(date):
+def generate_fact_user_level(date, workers=1):
 
     """
     Returns the most recent level for each user_id and jurisdiction based on the event_timestamp.
     """
     user_level_df = read_user_level_dataframe(date)
+
+    if workers > 1 and uses_pandas_backend():
+        return shard.run_by_user(compute_fact_user_level, [user_level_df], workers)
+    return compute_fact_user_level(user_level_df)
+
+def compute_fact_user_level(user_level_df):
     
     # Sort the DataFrame by event_timestamp in descending order
-    user_level_df_sorted = user_level_df.sort_values(by='event_timestamp', ascending=False)
+    user_level_df_sorted = backend.sort(user_level_df, by='event_timestamp', ascending=False)
 
     # Drop duplicates to keep only the most recent level for each user_id and jurisdiction
-    most_recent_levels = user_level_df_sorted.drop_duplicates(subset=['user_id', 'jurisdiction'])
+    most_recent_levels = backend.dedupe(user_level_df_sorted, ['user_id', 'jurisdiction'], keep='first')
 
-    return most_recent_levels.reset_index(drop=True)
+    return most_recent_levels
 
 def merge_fact_user_level(date, user_level_source_df, user_level_destination_df):
     """
@@ -228,99 +360,76 @@ def merge_fact_user_level(date, user_level_source_df, user_level_destination_df)
     removal_date = pd.to_datetime(date)
 
     # Remove records from the destination DataFrame that match the specified date
-    user_level_destination_cleaned = user_level_destination_df[
-        user_level_destination_df['event_timestamp'].dt.normalize() != removal_date
-    ]
+    user_level_destination_cleaned = backend.filter(user_level_destination_df, [('event_timestamp', 'date!=', removal_date)])
 
     # Merge the cleaned destination DataFrame with the source DataFrame
-    updated_destination_df = pd.concat([user_level_destination_cleaned, user_level_source_df])
+    return backend.concat([user_level_destination_cleaned, user_level_source_df])
 
-    return updated_destination_df.reset_index(drop=True)
-
-def load_user_level_fact(date):
+def load_user_level_fact(date, workers=1, increment=None):
 
     print('Loading Fact User Level for ' + date.strftime("%Y-%m-%d"))
     
-    user_level_table_name = util.user_level_table_name()
-    user_level_schema = util.user_level_schema()
-    user_level_df = generate_fact_user_level(date)
+    user_level_df = generate_fact_user_level(date, workers) if increment is None else increment
+    load_curated_table(date, util.USER_LEVEL, user_level_df, merge_fact_user_level)
 
-    destination_user_level_df_path = 'data-lake/curated/' + user_level_table_name + '.csv'
+def generate_fact_user_daily_snapshot(date, workers=1):
 
-    if os.path.isfile(destination_user_level_df_path): 
-        destination_user_level_df = pd.read_csv(destination_user_level_df_path)
-        destination_user_level_df['event_timestamp'] = pd.to_datetime(destination_user_level_df['event_timestamp'], format='mixed')
-        final_df = merge_fact_user_level(date, user_level_df, destination_user_level_df)
-        final_df.to_csv(destination_user_level_df_path, index=False)
-    else:
-        # if dim data file doesn't exist yet (first processing)
-        user_level_df.to_csv(destination_user_level_df_path, index=False)
+    user_df = read_user_id_dataframe(date)
+    deposit_df = generate_fact_deposit(date, columns=['event_timestamp', 'user_id'])
+    withdrawal_df = generate_fact_withdrawal(date, columns=['event_timestamp', 'user_id'])
+    event_df = read_event_dataframe(date, columns=['event_timestamp', 'user_id', 'event_name'])
 
-def generate_fact_user_daily_snapshot(date):
+    if not uses_pandas_backend():
+        return compute_fact_user_daily_snapshot(date, user_df, deposit_df, withdrawal_df, event_df)
 
-    user_df = read_user_id_dataframe(date)
-    deposit_df = generate_fact_deposit(date, util.deposit_table_name(), util.deposit_schema())
-    withdrawal_df = generate_fact_withdrawal(date, util.withdrawal_table_name(), util.withdrawal_schema())
-    event_df = read_event_dataframe(date)
+    compute = fused.compute_fact_user_daily_snapshot if aggregation_engine == 'fused' else compute_fact_user_daily_snapshot
+    if workers > 1:
+        return shard.run_by_user(compute, [user_df, deposit_df, withdrawal_df, event_df], workers, date)
+    return compute(date, user_df, deposit_df, withdrawal_df, event_df)
+
+def compute_fact_user_daily_snapshot(date, user_df, deposit_df, withdrawal_df, event_df):
     
     # Convert date parameter to a Timestamp for comparison
     snapshot_date = pd.to_datetime(date)
 
-    # Convert `event_timestamp` to date only for filtering
-    deposit_df['event_date'] = deposit_df['event_timestamp'].dt.normalize()
-    withdrawal_df['event_date'] = withdrawal_df['event_timestamp'].dt.normalize()
-    event_df['event_date'] = event_df['event_timestamp'].dt.normalize()
-
     # Filter dataframes for the given date
-    deposit_on_date = deposit_df[deposit_df['event_date'] == snapshot_date]
-    withdrawal_on_date = withdrawal_df[withdrawal_df['event_date'] == snapshot_date]
-    logins_on_date = event_df[(event_df['event_date'] == snapshot_date) & (event_df['event_name'].isin(['login', '2falogin', 'login_api']))]
+    deposit_on_date = backend.filter(deposit_df, [('event_timestamp', 'date==', snapshot_date)])
+    withdrawal_on_date = backend.filter(withdrawal_df, [('event_timestamp', 'date==', snapshot_date)])
+    logins_on_date = backend.filter(event_df, [('event_timestamp', 'date==', snapshot_date),
+                                               ('event_name', 'in', ['login', '2falogin', 'login_api'])])
 
     # Aggregate deposits by user
-    deposit_agg = deposit_on_date.groupby('user_id').size().reset_index(name='qty_deposits')
+    deposit_agg = backend.group_aggregate(deposit_on_date, ['user_id'], {'qty_deposits': ('user_id', 'size')})
     
     # Aggregate withdrawals by user
-    withdrawal_agg = withdrawal_on_date.groupby('user_id').size().reset_index(name='qty_withdrawals')
+    withdrawal_agg = backend.group_aggregate(withdrawal_on_date, ['user_id'], {'qty_withdrawals': ('user_id', 'size')})
     
     # Aggregate logins by user
-    logins_agg = logins_on_date.groupby('user_id').size().reset_index(name='qty_logins')
+    logins_agg = backend.group_aggregate(logins_on_date, ['user_id'], {'qty_logins': ('user_id', 'size')})
 
     # Mark as active if there is any deposit or withdrawal for the user on that date
     # Use `merge` on user_id to include only those who had deposits or withdrawals
-    activity_agg = pd.concat([deposit_agg[['user_id']], withdrawal_agg[['user_id']]]).drop_duplicates()
-    activity_agg['is_active'] = True
+    activity_agg = backend.dedupe(backend.concat([backend.select(deposit_agg, ['user_id']), backend.select(withdrawal_agg, ['user_id'])]),
+                                  ['user_id'], keep='first')
+    activity_agg = backend.with_column(activity_agg, 'is_active', True)
 
     # Merge all aggregations with the user_df to ensure all users are included
-    user_snapshot = user_df[['user_id']].copy()
-    user_snapshot['date'] = snapshot_date
+    user_snapshot = backend.with_column(backend.select(user_df, ['user_id']), 'date', snapshot_date)
 
     # Merge the aggregations into the user_snapshot DataFrame
-    user_snapshot = user_snapshot.merge(deposit_agg, on='user_id', how='left')
-    user_snapshot = user_snapshot.merge(withdrawal_agg, on='user_id', how='left')
-    user_snapshot = user_snapshot.merge(logins_agg[['user_id', 'qty_logins']], on='user_id', how='left')
-    user_snapshot = user_snapshot.merge(activity_agg[['user_id', 'is_active']], on='user_id', how='left')
+    for agg in [deposit_agg, withdrawal_agg, logins_agg, activity_agg]:
+        user_snapshot = backend.join(user_snapshot, agg, on='user_id', how='left')
 
     # Fill NaN values for quantity columns with 0 and for is_active with False
-    user_snapshot['qty_deposits'].fillna(0, inplace=True)
-    user_snapshot['qty_withdrawals'].fillna(0, inplace=True)
-    user_snapshot['qty_logins'].fillna(0, inplace=True)
-    user_snapshot['is_active'].fillna(False, inplace=True)
+    user_snapshot = backend.fill_null(user_snapshot, {'qty_deposits': 0, 'qty_withdrawals': 0, 'qty_logins': 0, 'is_active': False})
 
     # Convert qty columns to int for consistency with schema
-    user_snapshot['qty_deposits'] = user_snapshot['qty_deposits'].astype(int)
-    user_snapshot['qty_withdrawals'] = user_snapshot['qty_withdrawals'].astype(int)
-    user_snapshot['qty_logins'] = user_snapshot['qty_logins'].astype(int)
+    user_snapshot = backend.cast(user_snapshot, {'qty_deposits': 'int64', 'qty_withdrawals': 'int64', 'qty_logins': 'int64'})
 
     # Filter out users with no deposits, withdrawals, or logins
     # Improvement: this is being done to avoid huge files, but we can keep users with no activity in a day if we change the ETl
     #              to use more performant languages and file formats
-    user_snapshot = user_snapshot[
-        (user_snapshot['qty_deposits'] > 0) |
-        (user_snapshot['qty_withdrawals'] > 0) |
-        (user_snapshot['qty_logins'] > 0)
-    ]
-
-    return user_snapshot
+    return backend.filter(user_snapshot, [[('qty_deposits', '>', 0), ('qty_withdrawals', '>', 0), ('qty_logins', '>', 0)]])
 
 def merge_fact_user_daily_snapshot(date, source_df, destination_df):
     
@@ -328,151 +437,165 @@ def merge_fact_user_daily_snapshot(date, source_df, destination_df):
     load_date = pd.to_datetime(date)
 
     # Filter out rows in destination_df that match the specified date, so the process is idempotent
-    destination_df = destination_df[
-        destination_df['date'].dt.date != load_date.date()
-    ]
+    destination_df = backend.filter(destination_df, [('date', 'date!=', load_date)])
     
     # Append new data from source_df to the updated destination_df
-    updated_destination_df = pd.concat([destination_df, source_df], ignore_index=True)
+    updated_destination_df = backend.concat([destination_df, source_df])
 
     # Remove any duplicates by 'id' and 'date', keeping the last occurrence (in case of retries)
-    updated_destination_df.drop_duplicates(subset=['user_id', 'date'], keep='last', inplace=True)
+    return backend.dedupe(updated_destination_df, ['user_id', 'date'], keep='last')
 
-    return updated_destination_df
-
-def load_fact_user_daily_snapshot(date):
+def load_fact_user_daily_snapshot(date, workers=1, increment=None):
     
     print('Loading Fact User Daily Snapshot for ' + date.strftime("%Y-%m-%d"))
 
-    src_user_daily_snapshot_schema_df = generate_fact_user_daily_snapshot(date)
+    src_user_daily_snapshot_schema_df = generate_fact_user_daily_snapshot(date, workers) if increment is None else increment
+    destination_df = load_curated_table(date, util.FACT_USER_DAILY_SNAPSHOT, src_user_daily_snapshot_schema_df, merge_fact_user_daily_snapshot)
+    src_user_daily_snapshot_schema_df = backend.to_pandas(src_user_daily_snapshot_schema_df)
 
-    dest_user_daily_snapshot_df_path = 'data-lake/curated/' + util.fact_user_daily_snapshot_name() + '.csv'
+    # Update weekly and monthly rollups with the difference between the new and the previous rows of the day
+    old_day_df = destination_df[destination_df['date'].dt.date == pd.to_datetime(date).date()]
+    rollup.update_rollups(util.FACT_USER_DAILY_SNAPSHOT.name, old_day_df, src_user_daily_snapshot_schema_df, rollup.user_rollup_spec())
 
-    if os.path.isfile(dest_user_daily_snapshot_df_path): 
-        dest_user_daily_snapshot_df = pd.read_csv(dest_user_daily_snapshot_df_path)
-        dest_user_daily_snapshot_df['date'] = pd.to_datetime(dest_user_daily_snapshot_df['date'], format='mixed')
-        final_df = merge_fact_user_daily_snapshot(date, src_user_daily_snapshot_schema_df, dest_user_daily_snapshot_df)
-        final_df.to_csv(dest_user_daily_snapshot_df_path, index=False)
-    else:
-        # if fact data file doesn't exist yet (first processing)
-        src_user_daily_snapshot_schema_df.to_csv(dest_user_daily_snapshot_df_path, index=False)
+    # Per day activity bitmaps, used for DAU/WAU/MAU and retention queries (see activity_index)
+    activity_index.save_activity_bitmaps(date, src_user_daily_snapshot_schema_df)
 
 
-def generate_fact_daily_stats(date):
+def generate_fact_daily_stats(date, workers=1):
     # Convert the date parameter to a Timestamp and normalize to midnight
     snapshot_date = pd.to_datetime(date).normalize()
     
     # Fetch user_level, deposit, and withdrawal dataframes
-    user_level_df = read_fact_user_level_dataframe()  # Removed `date` from the function call
-    deposit_df = generate_fact_deposit(date, util.deposit_table_name(), util.deposit_schema())
-    withdrawal_df = generate_fact_withdrawal(date, util.withdrawal_table_name(), util.withdrawal_schema())
+    user_level_df = read_fact_user_level_dataframe(snapshot_date)
+    deposit_df = generate_fact_deposit(date, columns=['event_timestamp', 'user_id', 'amount', 'currency'])
+    withdrawal_df = generate_fact_withdrawal(date, columns=['event_timestamp', 'user_id', 'amount', 'currency'])
+
+    # Aggregations by user are computed per shard of users and combined before building the final rows
+    if not uses_pandas_backend():
+        partials = compute_daily_stats_partials(snapshot_date, user_level_df, deposit_df, withdrawal_df)
+    elif workers > 1:
+        shard_partials = shard.map_by_user(compute_daily_stats_partials, [user_level_df, deposit_df, withdrawal_df], workers, snapshot_date)
+        partials = shard.combine_daily_stats_partials(shard_partials)
+    elif aggregation_engine == 'fused':
+        return fused.compute_fact_daily_stats(snapshot_date, user_level_df, deposit_df, withdrawal_df)
+    else:
+        partials = compute_daily_stats_partials(snapshot_date, user_level_df, deposit_df, withdrawal_df)
+
+    return assemble_fact_daily_stats(snapshot_date, partials)
+
+def compute_daily_stats_partials(snapshot_date, user_level_df, deposit_df, withdrawal_df):
+    """
+    Computes the aggregations of daily_stats that depend on the users: amounts, distinct users and their sketches
+    by level, jurisdiction (and currency). Users are never split between shards, so distinct counts of different
+    shards can be summed (see shard.combine_daily_stats_partials).
+    """
+    keys = ['level', 'jurisdiction', 'currency']
 
     # Prepare the user_level dataframe to get the most recent level per user, jurisdiction
-    user_level_df['event_date'] = user_level_df['event_timestamp'].dt.normalize()
-    user_level_on_date = (
-        user_level_df[user_level_df['event_date'] <= snapshot_date]
-        .sort_values(by=['user_id', 'jurisdiction', 'event_date'], ascending=[True, True, False])
-        .drop_duplicates(subset=['user_id', 'jurisdiction'], keep='first')
+    user_level_df = backend.with_date(user_level_df, 'event_date', 'event_timestamp')
+    user_level_on_date = backend.dedupe(
+        backend.sort(backend.filter(user_level_df, [('event_date', '<=', snapshot_date)]),
+                     by=['user_id', 'jurisdiction', 'event_date'], ascending=[True, True, False]),
+        ['user_id', 'jurisdiction'], keep='first'
     )
+    user_levels = backend.select(user_level_on_date, ['user_id', 'level', 'jurisdiction'])
 
-    # Start with fact_daily_stats as the base, containing unique `level`, `jurisdiction` from `user_level_on_date`
-    fact_daily_stats = user_level_on_date[['level', 'jurisdiction']].drop_duplicates()
-    fact_daily_stats['date'] = snapshot_date  # Add date column
+    # Unique `level`, `jurisdiction` from `user_level_on_date`, the base of fact_daily_stats
+    levels = backend.dedupe(backend.select(user_level_on_date, ['level', 'jurisdiction']), ['level', 'jurisdiction'], keep='first')
 
     # Filter deposit and withdrawal data for the specified date
-    deposit_df['event_date'] = deposit_df['event_timestamp'].dt.normalize()
-    withdrawal_df['event_date'] = withdrawal_df['event_timestamp'].dt.normalize()
-    
-    deposits_on_date = deposit_df[deposit_df['event_date'] == snapshot_date]
-    withdrawals_on_date = withdrawal_df[withdrawal_df['event_date'] == snapshot_date]
-
-    # Join deposits with user level to ensure proper aggregation
-    deposits_joined = deposits_on_date.merge(
-        user_level_on_date[['user_id', 'level', 'jurisdiction']],
-        on='user_id',
-        how='inner'
-    )
+    deposits_on_date = backend.filter(deposit_df, [('event_timestamp', 'date==', snapshot_date)])
+    withdrawals_on_date = backend.filter(withdrawal_df, [('event_timestamp', 'date==', snapshot_date)])
+
+    # Join deposits and withdrawals with user level to ensure proper aggregation
+    deposits_joined = backend.join(deposits_on_date, user_levels, on='user_id', how='inner')
+    withdrawals_joined = backend.join(withdrawals_on_date, user_levels, on='user_id', how='inner')
+
+    # Aggregate deposits and withdrawals by level, jurisdiction, and currency
+    deposit_agg = backend.group_aggregate(deposits_joined, keys, {
+        'total_deposit_amount': ('amount', 'sum'),
+        'total_distinct_deposit_users': ('user_id', 'nunique')
+    })
+    withdrawal_agg = backend.group_aggregate(withdrawals_joined, keys, {
+        'total_withdrawal_amount': ('amount', 'sum'),
+        'total_distinct_withdrawal_users': ('user_id', 'nunique')
+    })
 
-    # Aggregate deposits by level, jurisdiction, and currency
-    deposit_agg = (
-        deposits_joined
-        .groupby(['level', 'jurisdiction', 'currency'], as_index=False)
-        .agg(
-            total_deposit_amount=('amount', 'sum'),
-            total_distinct_deposit_users=('user_id', 'nunique')
-        )
-    )
+    # Count distinct active users from deposits and withdrawals
+    active_users = backend.dedupe(backend.concat([
+        backend.select(deposits_joined, ['user_id', 'level', 'jurisdiction']),
+        backend.select(withdrawals_joined, ['user_id', 'level', 'jurisdiction'])
+    ]), ['user_id', 'level', 'jurisdiction'], keep='first')
 
-    # Join withdrawals with user level to ensure proper aggregation
-    withdrawals_joined = withdrawals_on_date.merge(
-        user_level_on_date[['user_id', 'level', 'jurisdiction']],
-        on='user_id',
-        how='inner'
-    )
+    # Aggregate the count of total active users by level and jurisdiction
+    total_active_users = backend.group_aggregate(active_users, ['level', 'jurisdiction'], {'total_active_users': ('user_id', 'nunique')})
 
-    # Aggregate withdrawals by level, jurisdiction, and currency
-    withdrawal_agg = (
-        withdrawals_joined
-        .groupby(['level', 'jurisdiction', 'currency'], as_index=False)
-        .agg(
-            total_withdrawal_amount=('amount', 'sum'),
-            total_distinct_withdrawal_users=('user_id', 'nunique')
-        )
-    )
+    # Sketches of distinct users, so distinct counts can be rolled up over several days (see sketch.rollup_daily_stats)
+    def sketches(table, sketch_keys, sketch_column):
+        return backend.from_pandas(sketch.sketch_by_group(backend.to_pandas(table), sketch_keys, 'user_id', sketch_column))
 
-    # Count distinct active users from deposits and withdrawals
-    active_users = pd.concat([
-        deposits_joined[['user_id', 'level', 'jurisdiction']],
-        withdrawals_joined[['user_id', 'level', 'jurisdiction']]
-    ]).drop_duplicates()
+    return {
+        'levels': levels,
+        'deposit_agg': backend.join(deposit_agg, sketches(deposits_joined, keys, 'deposit_users_sketch'), on=keys, how='left'),
+        'withdrawal_agg': backend.join(withdrawal_agg, sketches(withdrawals_joined, keys, 'withdrawal_users_sketch'), on=keys, how='left'),
+        'total_active_users': backend.join(total_active_users, sketches(active_users, ['level', 'jurisdiction'], 'active_users_sketch'),
+                                           on=['level', 'jurisdiction'], how='left')
+    }
 
-    # Aggregate the count of total active users by level and jurisdiction
-    total_active_users = (
-        active_users
-        .groupby(['level', 'jurisdiction'], as_index=False)
-        .agg(total_active_users=('user_id', 'nunique'))
-    )
+def assemble_fact_daily_stats(snapshot_date, partials):
+    """
+    Builds the daily_stats rows from the aggregations by user level (see compute_daily_stats_partials).
+    """
+    keys = ['level', 'jurisdiction', 'currency']
+    deposit_agg = partials['deposit_agg']
+    withdrawal_agg = partials['withdrawal_agg']
+
+    # Start with fact_daily_stats as the base, containing unique `level`, `jurisdiction` from user levels
+    fact_daily_stats = backend.with_column(partials['levels'], 'date', snapshot_date)
 
     # Create a base DataFrame with all unique combinations of keys from user levels, deposits, and withdrawals
-    base_keys = pd.concat([
-        deposit_agg[['level', 'jurisdiction', 'currency']],
-        withdrawal_agg[['level', 'jurisdiction', 'currency']]
-    ]).drop_duplicates()
+    base_keys = backend.dedupe(backend.concat([backend.select(deposit_agg, keys), backend.select(withdrawal_agg, keys)]), keys, keep='first')
 
     # Add date column to the base keys
-    base_keys['date'] = snapshot_date
+    base_keys = backend.with_column(base_keys, 'date', snapshot_date)
 
     # Merge deposit and withdrawal aggregations with base_keys to ensure all combinations are included
-    fact_daily_stats = fact_daily_stats.merge(base_keys, on=['level', 'jurisdiction', 'date'], how='left')
-    fact_daily_stats = fact_daily_stats.merge(deposit_agg, on=['level', 'jurisdiction', 'currency'], how='left')
-    fact_daily_stats = fact_daily_stats.merge(withdrawal_agg, on=['level', 'jurisdiction', 'currency'], how='left')
-    fact_daily_stats = fact_daily_stats.merge(total_active_users, on=['level', 'jurisdiction'], how='left')
+    fact_daily_stats = backend.join(fact_daily_stats, base_keys, on=['level', 'jurisdiction', 'date'], how='left')
+    fact_daily_stats = backend.join(fact_daily_stats, deposit_agg, on=keys, how='left')
+    fact_daily_stats = backend.join(fact_daily_stats, withdrawal_agg, on=keys, how='left')
+    fact_daily_stats = backend.join(fact_daily_stats, partials['total_active_users'], on=['level', 'jurisdiction'], how='left')
 
     # Fill NaN values for amounts with 0 and for user counts with 0
-    fact_daily_stats.fillna({
+    fact_daily_stats = backend.fill_null(fact_daily_stats, {
         'total_deposit_amount': 0.0,
         'total_withdrawal_amount': 0.0,
         'total_distinct_deposit_users': 0,
         'total_distinct_withdrawal_users': 0,
-        'total_active_users': 0
-    }, inplace=True)
+        'total_active_users': 0,
+        'active_users_sketch': '',
+        'withdrawal_users_sketch': '',
+        'deposit_users_sketch': ''
+    })
+
+    # Convert user counts to int for consistency with schema
+    fact_daily_stats = backend.cast(fact_daily_stats, {'total_active_users': 'int64', 'total_distinct_withdrawal_users': 'int64',
+                                                       'total_distinct_deposit_users': 'int64'})
 
     # Select the final columns according to the desired output schema
-    fact_daily_stats = fact_daily_stats[['date', 'currency', 'level', 'jurisdiction', 
-                                         'total_active_users', 'total_distinct_withdrawal_users', 
-                                         'total_distinct_deposit_users', 
-                                         'total_withdrawal_amount', 'total_deposit_amount']]
+    fact_daily_stats = backend.select(fact_daily_stats, ['date', 'currency', 'level', 'jurisdiction', 
+                                                         'total_active_users', 'total_distinct_withdrawal_users', 
+                                                         'total_distinct_deposit_users', 
+                                                         'total_withdrawal_amount', 'total_deposit_amount',
+                                                         'active_users_sketch', 'withdrawal_users_sketch', 'deposit_users_sketch'])
     
     # Filter rows to keep only those where at least one measure is greater than zero
-    fact_daily_stats = fact_daily_stats[
-        (fact_daily_stats['total_active_users'] > 0) |
-        (fact_daily_stats['total_distinct_withdrawal_users'] > 0) |
-        (fact_daily_stats['total_distinct_deposit_users'] > 0) |
-        (fact_daily_stats['total_withdrawal_amount'] > 0) |
-        (fact_daily_stats['total_deposit_amount'] > 0)
-    ]
-
-    return fact_daily_stats
+    return backend.filter(fact_daily_stats, [[
+        ('total_active_users', '>', 0),
+        ('total_distinct_withdrawal_users', '>', 0),
+        ('total_distinct_deposit_users', '>', 0),
+        ('total_withdrawal_amount', '>', 0),
+        ('total_deposit_amount', '>', 0)
+    ]])
 
 
 def merge_fact_daily_stats(date, source_df, destination_df):
@@ -481,37 +604,126 @@ def merge_fact_daily_stats(date, source_df, destination_df):
     load_date = pd.to_datetime(date)
 
     # Filter out rows in destination_df that match the specified date, so the process is idempotent
-    destination_df = destination_df[
-        destination_df['date'].dt.date != load_date.date()
-    ]
+    destination_df = backend.filter(destination_df, [('date', 'date!=', load_date)])
     
     # Append new data from source_df to the updated destination_df
-    updated_destination_df = pd.concat([destination_df, source_df], ignore_index=True)
+    updated_destination_df = backend.concat([destination_df, source_df])
 
     # Remove any duplicates by 'id' and 'date', keeping the last occurrence (in case of retries)
-    updated_destination_df.drop_duplicates(subset=['date', 'currency', 'level', 'jurisdiction'], keep='last', inplace=True)
+    return backend.dedupe(updated_destination_df, ['date', 'currency', 'level', 'jurisdiction'], keep='last')
 
-    return updated_destination_df
-
-def load_fact_daily_stats(date):
+def load_fact_daily_stats(date, workers=1, increment=None):
     
     print('Loading Fact Daily Stats for ' + date.strftime("%Y-%m-%d"))
 
-    src_fact_daily_stats_df = generate_fact_daily_stats(date)
+    src_fact_daily_stats_df = generate_fact_daily_stats(date, workers) if increment is None else increment
+    destination_df = load_curated_table(date, util.FACT_DAILY_STATS, src_fact_daily_stats_df, merge_fact_daily_stats)
+    src_fact_daily_stats_df = backend.to_pandas(src_fact_daily_stats_df)
+
+    # Update weekly and monthly rollups with the difference between the new and the previous rows of the day
+    old_day_df = destination_df[destination_df['date'].dt.date == pd.to_datetime(date).date()]
+    rollup.update_rollups(util.FACT_DAILY_STATS.name, old_day_df, src_fact_daily_stats_df, rollup.stats_rollup_spec())
+
+
+# written when load() finishes a date, services reading the curated layer reload on it (see lookup_service)
+LOAD_MARKER_PATH = 'data-lake/curated/_last_load.txt'
+
+def write_load_marker(date):
+    os.makedirs(os.path.dirname(LOAD_MARKER_PATH), exist_ok=True)
+    temporary_path = LOAD_MARKER_PATH + '.tmp'
+    with open(temporary_path, 'w') as marker:
+        marker.write(date.strftime('%Y-%m-%d') + '\n')
+    os.replace(temporary_path, LOAD_MARKER_PATH)
+
+
+def load_steps():
+    # curated load steps, in the order they run
+    return [load_dim_user, load_fact_deposit, load_fact_withdrawal, load_fact_user_daily_snapshot,
+            load_user_level_fact, load_fact_daily_stats]
+
+def load_step_tables():
+    # curated table loaded by each step and the trusted tables it reads
+    return {
+        load_dim_user: (util.DIM_USER.name, [util.USER_ID.name, util.EVENT.name]),
+        load_fact_deposit: (util.DEPOSIT.name, [util.DEPOSIT.name]),
+        load_fact_withdrawal: (util.WITHDRAWAL.name, [util.WITHDRAWAL.name]),
+        load_fact_user_daily_snapshot: (util.FACT_USER_DAILY_SNAPSHOT.name, [util.USER_ID.name, util.DEPOSIT.name, util.WITHDRAWAL.name, util.EVENT.name]),
+        load_user_level_fact: (util.USER_LEVEL.name, [util.USER_LEVEL.name]),
+        load_fact_daily_stats: (util.FACT_DAILY_STATS.name, [util.DEPOSIT.name, util.WITHDRAWAL.name])
+    }
+
+def load_step_curated_inputs():
+    # curated tables read by a step besides the one it loads (daily_stats reads the levels of user_level)
+    return {load_fact_daily_stats: [util.USER_LEVEL.name]}
+
+def load_step_generators():
+    # function generating the increment of each step, an increment generated apart (e.g. by another process, see
+    # work_queue) is passed to the step as increment= and only merged
+    return {
+        load_dim_user: generate_dim_user,
+        load_fact_deposit: generate_fact_deposit,
+        load_fact_withdrawal: generate_fact_withdrawal,
+        load_fact_user_daily_snapshot: generate_fact_user_daily_snapshot,
+        load_user_level_fact: generate_fact_user_level,
+        load_fact_daily_stats: generate_fact_daily_stats
+    }
+
+def selected_load_steps(tables=None):
+    # load steps of the given curated tables (all by default), in the order they run
+    return [step for step in load_steps() if tables is None or load_step_tables()[step][0] in tables]
+
+def late_arrival_load_steps():
+    """
+    Load steps that must be recomputed for an event date when rows of a table arrive late.
+    Steps are listed in the same order they run in load().
+    """
+    return {
+        util.EVENT.name: [load_dim_user, load_fact_user_daily_snapshot],
+        util.DEPOSIT.name: [load_fact_deposit, load_fact_user_daily_snapshot, load_fact_daily_stats],
+        util.WITHDRAWAL.name: [load_fact_withdrawal, load_fact_user_daily_snapshot, load_fact_daily_stats],
+        util.USER_LEVEL.name: [load_user_level_fact, load_fact_daily_stats]
+    }
+
+def plan_late_arrivals_recomputation(batch_date, late_arrivals):
+    """
+    Returns, for each affected date, the load steps to recompute, given the late arriving event dates of each table.
+    A late user level changes the level of the user in every daily_stats until the batch date, so those days are
+    recomputed as well. The batch date itself is left out, since it's loaded by the regular load.
+    """
+    steps_by_table = late_arrival_load_steps()
 
-    dest_fact_daily_stats_df_path = 'data-lake/curated/' + util.fact_daily_stats_name() + '.csv'
+    plan = {}
+    for table_name, dates in late_arrivals.items():
+        for date in dates:
+            plan.setdefault(date, set()).update(steps_by_table.get(table_name, []))
 
-    if os.path.isfile(dest_fact_daily_stats_df_path): 
-        dest_fact_daily_snapshot_df = pd.read_csv(dest_fact_daily_stats_df_path)
-        dest_fact_daily_snapshot_df['date'] = pd.to_datetime(dest_fact_daily_snapshot_df['date'], format='mixed')
-        final_df = merge_fact_daily_stats(date, src_fact_daily_stats_df, dest_fact_daily_snapshot_df)
-        final_df.to_csv(dest_fact_daily_stats_df_path, index=False)
-    else:
-        # if fact data file doesn't exist yet (first processing)
-        src_fact_daily_stats_df.to_csv(dest_fact_daily_stats_df_path, index=False)
+            if table_name == util.USER_LEVEL.name:
+                following_date = date + timedelta(days=1)
+                while following_date < batch_date:
+                    plan.setdefault(following_date, set()).add(load_fact_daily_stats)
+                    following_date += timedelta(days=1)
 
+    return {date: [step for step in load_steps() if step in steps] for date, steps in sorted(plan.items())}
 
-def load(date):
+def load_late_arrivals(batch_date, workers=1, tables=None):
+    """
+    Recomputes the curated rows of earlier days that received late arriving data in the batch (see cleanup.route_late_arriving_rows),
+    so facts are correct without reprocessing a whole date range.
+    """
+    plan = plan_late_arrivals_recomputation(batch_date, util.read_late_arrivals(batch_date))
+    selected_steps = selected_load_steps(tables)
+
+    for date, steps in plan.items():
+        steps = [step for step in steps if step in selected_steps]
+        if not steps:
+            continue
+        print('Recomputing ' + date.strftime("%Y-%m-%d") + ' due to late arriving data in ' + batch_date.strftime("%Y-%m-%d"))
+        for step in steps:
+            with profiling.profile_stage(step.__name__, date, batch_date):
+                step(date, workers)
+
+
+def load(date, workers=1, tables=None):
     """
     This method will load the curated layer (which simulates our DataWarehouse) with all dimensions and fact tables
     Another approach would be to load a real datawarehouse like Google BigQuery or Amazon Redshift, or to create federated
@@ -525,14 +737,22 @@ def load(date):
     Generate -> Read all required input data, apply calculations and transformations to match the destination data model
     Merge -> Gets the result from Generate method and the destination table/dataframe and merge it applying the right method
              It takes care of idempotent load and/or updates to dimension tables following specific business rules.
+
+    Before loading the date, days that received late arriving data in this batch are recomputed.
+
+    With workers > 1 the generate steps that aggregate by user run on shards of users in a pool of processes
+    (see shard), merges into the curated tables still run once in this process.
+    When tables is given, only the steps that load those curated tables run.
     """
         
-    load_dim_user(date)
-    load_fact_deposit(date)
-    load_fact_withdrawal(date)
-    load_fact_user_daily_snapshot(date)
-    load_user_level_fact(date)
-    load_fact_daily_stats(date)
+    load_late_arrivals(date, workers, tables)
+
+    for step in selected_load_steps(tables):
+        with profiling.profile_stage(step.__name__, date):
+            step(date, workers)
+
+    write_load_marker(date)
+
 
 
 
@@ -0,0 +1,259 @@
+import argparse
+import json
+import numpy as np
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+import pandas as pd
+import util
+import load as l
+
+# Local read service for point lookups by user: last login (dim_user), current level per jurisdiction (user_level)
+# and activity totals between two dates (user_daily_snapshot). Tables are loaded into compact in-memory indexes:
+# user ids as sorted byte strings searched with binary search, rows of each user contiguous, and cumulative sums of
+# the daily measures so the totals of any date range are a subtraction. A lookup takes microseconds.
+# With the type 2 history of dim_user (load.set_dim_user_history), last logins as of a date are looked up in an
+# interval index: the versions of each user sorted by valid_from, each one valid until the next.
+# The service reloads the indexes when load.load finishes a date (it writes l.LOAD_MARKER_PATH). New indexes are
+# built aside and swapped in a single assignment, so readers are never blocked and always see a consistent version.
+ACTIVITY_MEASURES = ['qty_deposits', 'qty_withdrawals', 'qty_logins', 'is_active']
+
+_indexes = None
+_reload_lock = threading.Lock()
+
+
+def encode_user_ids(user_ids):
+    # fixed width byte strings: a 32 chars id takes 32 bytes (numpy unicode strings take 4 bytes per char)
+    return np.array(pd.Series(user_ids, dtype=object).fillna('').str.encode('utf-8').tolist(), dtype='S')
+
+def user_rows(user_ids, user_id):
+    # rows of a user in an index sorted by user id
+    key = user_id.encode('utf-8')
+    return np.searchsorted(user_ids, key, side='left'), np.searchsorted(user_ids, key, side='right')
+
+def build_dim_user_index():
+    df = util.load_csv_to_dataframe(util.DIM_USER.name, 'curated').sort_values('user_id', kind='stable')
+    return {'user_ids': encode_user_ids(df['user_id']), 'last_login': df['last_login'].to_numpy()}
+
+def build_dim_user_history_index():
+    # None when the history isn't kept
+    if util.resolve_file_path(util.DIM_USER_HISTORY.file_path('curated')) is None:
+        return None
+    df = util.load_csv_to_dataframe(util.DIM_USER_HISTORY.name, 'curated', columns=['user_id', 'last_login', 'valid_from'])
+    df = df.sort_values(['user_id', 'valid_from'], kind='stable')
+    return {'user_ids': encode_user_ids(df['user_id']), 'valid_from': df['valid_from'].to_numpy(), 'last_login': df['last_login'].to_numpy()}
+
+def build_user_level_index():
+    # latest level of each user and jurisdiction
+    df = util.load_csv_to_dataframe(util.USER_LEVEL.name, 'curated')
+    df = df.sort_values('event_timestamp', ascending=False).drop_duplicates(subset=['user_id', 'jurisdiction'])
+    df = df.sort_values(['user_id', 'jurisdiction'], kind='stable')
+    return {
+        'user_ids': encode_user_ids(df['user_id']),
+        'jurisdictions': df['jurisdiction'].to_numpy(dtype=object),
+        'levels': df['level'].to_numpy(),
+        'event_timestamps': df['event_timestamp'].to_numpy()
+    }
+
+def build_activity_index():
+    columns = ['user_id', 'date'] + ACTIVITY_MEASURES
+    df = util.load_csv_to_dataframe(util.FACT_USER_DAILY_SNAPSHOT.name, 'curated', columns=columns).sort_values(['user_id', 'date'], kind='stable')
+    index = {'user_ids': encode_user_ids(df['user_id']), 'dates': df['date'].to_numpy()}
+    for measure in ACTIVITY_MEASURES:
+        # cumulative sums with a leading 0: totals of rows [i, j) are cumulative[j] - cumulative[i]
+        index[measure] = np.concatenate([[0], np.cumsum(df[measure].to_numpy(dtype='int64'))])
+    return index
+
+def read_load_marker():
+    path = l.LOAD_MARKER_PATH
+    if not os.path.isfile(path):
+        return None
+    with open(path) as marker:
+        return marker.read().strip()
+
+def load_marker_version():
+    try:
+        stat = os.stat(l.LOAD_MARKER_PATH)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_ino)
+
+def build_indexes():
+    started = time.perf_counter()
+    indexes = {
+        # read before the tables, so a load finishing meanwhile triggers another reload
+        'marker_version': load_marker_version(),
+        'loaded_date': read_load_marker(),
+        'dim_user': build_dim_user_index(),
+        'dim_user_history': build_dim_user_history_index(),
+        'user_level': build_user_level_index(),
+        'activity': build_activity_index()
+    }
+    indexes['build_seconds'] = round(time.perf_counter() - started, 3)
+    return indexes
+
+def reload():
+    """
+    Builds new indexes from the curated layer and swaps them in. Lookups running meanwhile use the previous ones.
+    """
+    global _indexes
+    with _reload_lock:
+        indexes = build_indexes()
+        _indexes = indexes
+    print(f"Loaded lookup indexes for {indexes['loaded_date']} in {indexes['build_seconds']}s")
+    return indexes
+
+def current_indexes():
+    return _indexes if _indexes is not None else reload()
+
+def timestamp_str(value):
+    return None if pd.isnull(value) else pd.Timestamp(value).isoformat(sep=' ')
+
+def last_login(user_id, indexes=None):
+    """
+    Last login of the user, None if the user never logged in, KeyError if the user is unknown.
+    """
+    index = (indexes or current_indexes())['dim_user']
+    start, end = user_rows(index['user_ids'], user_id)
+    if start == end:
+        raise KeyError(user_id)
+    return timestamp_str(index['last_login'][start])
+
+def last_login_as_of(user_id, date, indexes=None):
+    """
+    Last login of the user as loaded on the date, None if the user never logged in until then, KeyError if the user
+    wasn't loaded yet on the date. Binary search of the version valid on the date.
+    """
+    index = (indexes or current_indexes())['dim_user_history']
+    if index is None:
+        raise ValueError('dim_user history is not kept, see load.set_dim_user_history')
+    start, end = user_rows(index['user_ids'], user_id)
+    position = start + np.searchsorted(index['valid_from'][start:end], np.datetime64(pd.Timestamp(date).normalize()), side='right') - 1
+    if position < start:
+        raise KeyError(user_id)
+    return timestamp_str(index['last_login'][position])
+
+def user_levels(user_id, indexes=None):
+    # current level of the user in each jurisdiction
+    index = (indexes or current_indexes())['user_level']
+    start, end = user_rows(index['user_ids'], user_id)
+    return [{'jurisdiction': index['jurisdictions'][i], 'level': int(index['levels'][i]), 'event_timestamp': timestamp_str(index['event_timestamps'][i])}
+            for i in range(start, end)]
+
+def activity_totals(user_id, start_date=None, end_date=None, indexes=None):
+    """
+    Deposits, withdrawals, logins and active days of the user between two dates (inclusive, all dates by default).
+    """
+    index = (indexes or current_indexes())['activity']
+    first, last = user_rows(index['user_ids'], user_id)
+
+    # rows of each user are sorted by date
+    dates = index['dates'][first:last]
+    start = first + (np.searchsorted(dates, np.datetime64(pd.Timestamp(start_date)), side='left') if start_date is not None else 0)
+    end = first + (np.searchsorted(dates, np.datetime64(pd.Timestamp(end_date)), side='right') if end_date is not None else len(dates))
+    end = max(start, end)
+
+    totals = {measure: int(index[measure][end] - index[measure][start]) for measure in ACTIVITY_MEASURES}
+    totals['active_days'] = totals.pop('is_active')
+    return totals
+
+def status():
+    indexes = current_indexes()
+    return {
+        'loaded_date': indexes['loaded_date'],
+        'build_seconds': indexes['build_seconds'],
+        'users': len(indexes['dim_user']['user_ids']),
+        'user_levels': len(indexes['user_level']['user_ids']),
+        'activity_rows': len(indexes['activity']['user_ids'])
+    }
+
+def watch_load_marker(stop, interval):
+    # reloads the indexes when the load marks a new date as loaded
+    while not stop.wait(interval):
+        try:
+            if load_marker_version() != current_indexes()['marker_version']:
+                reload()
+        except Exception as error:
+            # e.g. a table being rewritten by the load, lookups keep the previous indexes until the next interval
+            print(f"Reloading lookup indexes failed, retrying in {interval}s: {error!r}")
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    """
+    GET /users/<user_id>/last_login[?as_of=YYYY-MM-DD]
+    GET /users/<user_id>/levels
+    GET /users/<user_id>/activity?from=YYYY-MM-DD&to=YYYY-MM-DD
+    GET /status
+    POST /reload
+    """
+
+    def send_json(self, status_code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if parts == ['status']:
+                return self.send_json(200, status())
+            if len(parts) == 3 and parts[0] == 'users':
+                user_id, lookup = parts[1], parts[2]
+                if lookup == 'last_login' and 'as_of' in params:
+                    return self.send_json(200, {'user_id': user_id, 'as_of': params['as_of'], 'last_login': last_login_as_of(user_id, params['as_of'])})
+                if lookup == 'last_login':
+                    return self.send_json(200, {'user_id': user_id, 'last_login': last_login(user_id)})
+                if lookup == 'levels':
+                    return self.send_json(200, {'user_id': user_id, 'levels': user_levels(user_id)})
+                if lookup == 'activity':
+                    return self.send_json(200, dict(user_id=user_id, **activity_totals(user_id, params.get('from'), params.get('to'))))
+        except KeyError:
+            return self.send_json(404, {'error': 'unknown user'})
+        except ValueError as error:
+            return self.send_json(400, {'error': str(error)})
+        self.send_json(404, {'error': 'unknown path'})
+
+    def do_POST(self):
+        if urlparse(self.path).path.strip('/') == 'reload':
+            reload()
+            return self.send_json(200, status())
+        self.send_json(404, {'error': 'unknown path'})
+
+    def log_message(self, format, *args):
+        # no access log, lookups are too frequent
+        pass
+
+def serve(host='127.0.0.1', port=8765, watch_interval=1.0):
+    """
+    Serves lookups over HTTP until interrupted, reloading the indexes when the load finishes a date.
+    """
+    server, stop = start(host, port, watch_interval)
+    print(f"Serving lookups on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+        server.server_close()
+
+def start(host='127.0.0.1', port=8765, watch_interval=1.0):
+    # builds the indexes and starts the load marker watcher, the caller runs server.serve_forever
+    reload()
+    stop = threading.Event()
+    threading.Thread(target=watch_load_marker, args=(stop, watch_interval), daemon=True).start()
+    return ThreadingHTTPServer((host, port), LookupHandler), stop
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves point lookups by user_id over the curated layer.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--watch-interval', type=float, default=1.0, help='seconds between checks of a finished load')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.watch_interval)
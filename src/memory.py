@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+import os
+import resource
+from contextlib import contextmanager
+
+# Memory budget of cleanup and load (None for no budget). With a budget:
+# - typed readers downcast numeric columns: integers (ids, level, qty_*) to the smallest integer type holding their
+#   values, floats (amounts) to float32 when every value is exactly the same in float32,
+# - operations whose input is estimated above the budget switch to chunked versions that keep intermediates on disk
+#   (cleanup of a raw partition, merge of a curated fact table, the user levels read by daily_stats),
+# - the peak memory of each stage is printed next to the budget.
+# Sizes in memory are estimated from the size of the files: parsed csv data takes a few times its size on disk.
+budget = None
+
+IN_MEMORY_FACTOR = 4
+# assumed compression ratio of gzip/zstd csv files, to estimate their size once decompressed
+COMPRESSION_RATIO = 5
+# fraction of the budget taken by a chunk, the rest is left to what the operation keeps between chunks
+CHUNK_FRACTION = 0.1
+MIN_CHUNK_ROWS = 1000
+
+peaks = []
+
+
+def set_budget(budget_bytes):
+    # starts the peaks of a new run
+    global budget
+    budget = budget_bytes
+    peaks.clear()
+
+def parse_size(value):
+    # e.g. 512MB, 2GB, 1048576
+    units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+    value = value.strip().upper()
+    for unit, multiplier in units.items():
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * multiplier)
+    return int(value)
+
+def format_size(size):
+    return f"{size / 1024 ** 2:.1f} MB"
+
+def estimate_bytes(path):
+    # memory taken by the parsed file, 0 if it doesn't exist
+    if path is None or not os.path.isfile(path):
+        return 0
+    compressed = path.endswith('.gz') or path.endswith('.zst')
+    return os.path.getsize(path) * IN_MEMORY_FACTOR * (COMPRESSION_RATIO if compressed else 1)
+
+def exceeds_budget(path):
+    return budget is not None and estimate_bytes(path) > budget
+
+def chunk_rows(row_bytes):
+    """
+    Rows of the chunks of a file whose lines take row_bytes (see util.sample_row_bytes), so each parsed chunk takes
+    CHUNK_FRACTION of the budget.
+    """
+    return max(MIN_CHUNK_ROWS, int(budget * CHUNK_FRACTION / (row_bytes * IN_MEMORY_FACTOR)))
+
+def downcast(df):
+    """
+    Smallest numeric types holding the values of df (ints always, floats when float32 keeps every value).
+    """
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_bool_dtype(values):
+            continue
+        if pd.api.types.is_integer_dtype(values):
+            df[col] = pd.to_numeric(values, downcast='integer')
+        elif pd.api.types.is_float_dtype(values) and values.dtype != np.float32:
+            as_float32 = values.astype(np.float32)
+            if ((as_float32.astype(np.float64) == values) | values.isna()).all():
+                df[col] = as_float32
+    return df
+
+def fit(df):
+    # downcast when there's a memory budget
+    return downcast(df) if budget is not None else df
+
+def status_bytes(field):
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def peak_bytes():
+    # peak resident memory of the process since the last reset, ru_maxrss (kilobytes on linux) can't be reset
+    peak = status_bytes('VmHWM')
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def current_bytes():
+    current = status_bytes('VmRSS')
+    return current if current is not None else 0
+
+def reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+def report():
+    # largest stage peak of the run, after the peaks of each stage
+    if budget is not None and peaks:
+        peak = max(peaks, key=lambda stage_peak: stage_peak['used_bytes'])
+        print(f"Peak memory of the run: {format_size(peak['used_bytes'])} of {format_size(budget)} budget "
+              f"({peak['stage']}, {format_size(peak['peak_bytes'])} resident)")
+
+@contextmanager
+def track(stage, date=None):
+    """
+    Prints the peak memory of the stage against the budget, when there's a budget. The budget is compared to the
+    memory the stage takes above what the process held when it started (the interpreter and its libraries).
+    """
+    if budget is None:
+        yield
+        return
+    reset_peak()
+    start = current_bytes()
+    try:
+        yield
+    finally:
+        peak = peak_bytes()
+        used = max(0, peak - start)
+        peaks.append({'stage': stage, 'date': date, 'peak_bytes': peak, 'used_bytes': used})
+        date_str = ' ' + date.strftime('%Y-%m-%d') if date is not None else ''
+        over = ' OVER BUDGET' if used > budget else ''
+        print(f"Peak memory of {stage}{date_str}: {format_size(used)} of {format_size(budget)} budget "
+              f"({format_size(peak)} resident){over}")
@@ -0,0 +1,138 @@
+import pandas as pd
+import util
+import block_index
+import catalog
+
+# Execution backend of the load steps on pandas DataFrames (the default). Every backend module exposes the same
+# functions, so the generate and merge logic of load.py runs on any of them (see arrow_backend.py):
+#   read, write, filter, join, group_aggregate, dedupe, sort, concat
+#   and small helpers to select, add, fill and cast columns and to convert from/to pandas.
+# Filter predicates are (column, op, value) tuples, AND-ed; a list of predicates inside them is OR-ed.
+# Ops: '==', '!=', '<=', '>', '>=', 'in', and 'date==', 'date!=', 'date<=' to compare the date of a timestamp column.
+# Readers take predicates too, applied while reading: partitions whose catalog statistics can't match are not opened
+# (see catalog.py), blocks of curated tables whose statistics can't match are not read (see block_index), other files
+# are filtered by chunks.
+NAME = 'pandas'
+
+
+def read(table_name, layer, date=None, columns=None, predicates=None):
+    if not predicates:
+        return util.load_csv_to_dataframe(table_name, layer, date, columns)
+
+    columns = columns or list(util.table_spec(table_name).schema.keys())
+    read_columns = columns + [col for col in util.predicate_columns(predicates) if col not in columns]
+
+    def matching_rows(df):
+        return filter(df, predicates)[columns]
+
+    if not catalog.may_match(table_name, layer, date, predicates):
+        return matching_rows(util.empty_table_dataframe(table_name, read_columns))
+    if layer == 'curated':
+        return block_index.read(table_name, read_columns, predicates, matching_rows)
+    chunks = [matching_rows(chunk) for chunk in util.load_csv_chunks(table_name, layer, date, read_columns)]
+    return pd.concat(chunks, ignore_index=True) if chunks else util.load_csv_to_dataframe(table_name, layer, date, columns)
+
+def write(table, path):
+    # in blocks with statistics, so later reads and merges skip the blocks they don't need
+    block_index.write([table], path)
+
+def from_pandas(df):
+    return df
+
+def to_pandas(table):
+    return table
+
+def num_rows(table):
+    return len(table)
+
+def empty_like(table):
+    return table.iloc[0:0]
+
+def predicate_mask(table, predicate):
+    if isinstance(predicate, list):
+        mask = pd.Series(False, index=table.index)
+        for alternative in predicate:
+            mask |= predicate_mask(table, alternative)
+        return mask
+
+    column, op, value = predicate
+    values = table[column]
+    if op.startswith('date'):
+        values = values.dt.normalize()
+        value = pd.Timestamp(value).normalize()
+        op = op[len('date'):]
+
+    if op == '==':
+        return values == value
+    if op == '!=':
+        return values != value
+    if op == '<=':
+        return values <= value
+    if op == '>':
+        return values > value
+    if op == '>=':
+        return values >= value
+    if op == 'in':
+        return values.isin(value)
+    raise ValueError(f"Unsupported filter op: {op}")
+
+def filter(table, predicates):
+    mask = pd.Series(True, index=table.index)
+    for predicate in predicates:
+        mask &= predicate_mask(table, predicate)
+    return table[mask]
+
+def select(table, columns):
+    return table[columns]
+
+def with_column(table, name, value):
+    # value is a scalar, repeated in every row
+    table = table.copy()
+    table[name] = value
+    return table
+
+def with_date(table, name, column):
+    # date of a timestamp column
+    table = table.copy()
+    table[name] = table[column].dt.normalize()
+    return table
+
+def row_max(table, name, columns):
+    table = table.copy()
+    table[name] = table[columns].max(axis=1)
+    return table
+
+def fill_null(table, values):
+    values = {name: value for name, value in values.items() if name in table.columns}
+    objects = [name for name in values if table[name].dtype == object]
+    table = table.fillna({name: value for name, value in values.items() if name not in objects})
+    for name in objects:
+        # filled in numpy and typed from the values after, fillna no longer downcasts object columns (e.g.
+        # is_active after a left join)
+        filled = table[name].to_numpy(copy=True)
+        filled[table[name].isna().to_numpy()] = values[name]
+        table[name] = pd.Series(filled, index=table.index, name=name).infer_objects()
+    return table
+
+def cast(table, types):
+    return table.astype(types)
+
+def join(left, right, on, how='inner', suffixes=('_x', '_y')):
+    return left.merge(right, on=on, how=how, suffixes=suffixes)
+
+def group_aggregate(table, keys, aggregations):
+    """
+    aggregations: output column -> (input column, function), functions are 'sum', 'max', 'size' and 'nunique'.
+    Groups come sorted by the keys, rows with empty keys are left out.
+    """
+    return table.groupby(keys, as_index=False).agg(**aggregations)
+
+def dedupe(table, keys, keep='last'):
+    return table.drop_duplicates(subset=keys, keep=keep)
+
+def sort(table, by, ascending=True):
+    return table.sort_values(by=by, ascending=ascending)
+
+def concat(tables):
+    # empty tables don't take part in the dtypes of the result (deprecated in pandas, merges of blocks concat them)
+    return pd.concat([table for table in tables if len(table)] or tables, ignore_index=True)
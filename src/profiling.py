@@ -0,0 +1,122 @@
+import cProfile
+import tracemalloc
+import threading
+import sys
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Optional per stage profiling of the pipeline. When enabled, each profiled run of a stage (extract_events,
+# cleanup_<table>, load_<step>) writes to <output_dir>/<stage>/:
+#   <date>.prof       -> cProfile statistics, open with pstats or snakeviz
+#   <date>.collapsed  -> sampled call stacks in collapsed format, input of flamegraph.pl or speedscope
+#   <date>.memory.txt -> peak traced memory and top allocations by line (tracemalloc)
+# Recomputations of a day for late arriving data of a later batch are named <date>.late-<batch date>, so they don't
+# overwrite the profile of the day.
+# sample_rate is the fraction of the runs of each stage that are profiled (e.g. 0.05 profiles one day in 20 of a
+# backfill), so the overhead of a long run stays bounded. Runs are picked evenly, not randomly.
+settings = {
+    'enabled': False,
+    'output_dir': 'profiles',
+    'sample_rate': 1.0,
+    'top_allocations': 20,
+    'stack_interval': 0.005
+}
+
+_stage_runs = Counter()
+
+
+def enable(output_dir='profiles', sample_rate=1.0, top_allocations=20):
+    if not 0 < sample_rate <= 1:
+        raise ValueError(f"Sample rate must be in (0, 1]: {sample_rate}")
+    settings.update(enabled=True, output_dir=output_dir, sample_rate=sample_rate, top_allocations=top_allocations)
+    _stage_runs.clear()
+
+def disable():
+    settings['enabled'] = False
+
+def is_sampled(stage):
+    """
+    True for the runs of a stage that should be profiled: run i is profiled when floor((i + 1) * rate) increases,
+    so with rate 0.25 the 4th, 8th, ... runs are profiled.
+    """
+    run = _stage_runs[stage]
+    _stage_runs[stage] += 1
+    rate = settings['sample_rate']
+    return int((run + 1) * rate) > int(run * rate)
+
+def stage_file_path(stage, date, suffix, batch_date=None):
+    name = date.strftime('%Y-%m-%d') if date is not None else 'run'
+    if batch_date is not None and batch_date != date:
+        name += '.late-' + batch_date.strftime('%Y-%m-%d')
+    return os.path.join(settings['output_dir'], stage, name + suffix)
+
+def frame_stack(frame):
+    # collapsed format: frames from the outermost call, separated by ';'
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+def sample_stacks(thread_id, stacks, stop, interval):
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[frame_stack(frame)] += 1
+
+def write_memory_report(path, snapshot, peak):
+    # leave out the allocations of the profiler itself
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)])
+    top = snapshot.statistics('lineno')[:settings['top_allocations']]
+    with open(path, 'w') as report:
+        report.write(f"peak traced memory: {peak / (1024 * 1024):.1f} MB\n")
+        for statistic in top:
+            report.write(str(statistic) + '\n')
+
+@contextmanager
+def profile_stage(stage, date=None, batch_date=None):
+    """
+    Profiles the code run inside the block as a run of stage, if profiling is enabled and the run is sampled.
+    batch_date is the batch a run of an earlier date is part of (late arriving data).
+    """
+    if not settings['enabled'] or not is_sampled(stage):
+        yield
+        return
+
+    os.makedirs(os.path.join(settings['output_dir'], stage), exist_ok=True)
+
+    stacks = Counter()
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), stacks, stop, settings['stack_interval']), daemon=True)
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        stop.set()
+        sampler.join()
+        seconds = time.perf_counter() - start
+
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+
+        profiler.dump_stats(stage_file_path(stage, date, '.prof', batch_date))
+        with open(stage_file_path(stage, date, '.collapsed', batch_date), 'w') as collapsed:
+            for stack, samples in stacks.items():
+                collapsed.write(f"{stack} {samples}\n")
+        write_memory_report(stage_file_path(stage, date, '.memory.txt', batch_date), snapshot, peak)
+        print(f"Profiled {stage} in {seconds:.2f}s, peak traced memory {peak / (1024 * 1024):.1f} MB")
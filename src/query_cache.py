@@ -0,0 +1,188 @@
+import pandas as pd
+import sys
+import os
+import time
+from collections import OrderedDict, Counter
+from datetime import timedelta
+import util
+import activity_index
+import pandas_backend
+import catalog
+import clustering
+
+# Cache of the results of the dashboard queries (queries/queries.sql) over the curated layer. Results are keyed by
+# query and parameters and stored with the version of every partition the query read: a curated table file, or the
+# activity bitmap file of a day. The version of a partition is taken from its file (path, modification time, size
+# and inode), so it changes only when the load rewrites it, and a cached result is served while all the partitions
+# it read are unchanged, without scanning them. Loading a day rewrites the curated tables and the bitmap of that day,
+# so e.g. the daily active users of the other days stay cached.
+# File timestamps are coarse (a few milliseconds), so results of partitions modified in the last RACY_SECONDS are
+# not cached: a second rewrite within the same timestamp could go unnoticed.
+# The cache is bounded by number of entries and by the size of the results, the least recently used are evicted.
+RACY_SECONDS = 1
+
+settings = {
+    'max_entries': 256,
+    'max_bytes': 64 * 1024 * 1024
+}
+
+stats = Counter()
+
+# query name -> (function, function returning the partitions read for some parameters)
+QUERIES = {}
+
+_cache = OrderedDict()
+
+
+def configure(max_entries=256, max_bytes=64 * 1024 * 1024):
+    settings.update(max_entries=max_entries, max_bytes=max_bytes)
+    evict()
+
+def clear():
+    _cache.clear()
+    stats.clear()
+
+def query(tables=(), partitions=None):
+    """
+    Registers a cached query reading the given curated tables, or the partitions returned by partitions(**params).
+    """
+    def register(function):
+        QUERIES[function.__name__] = (function, partitions or (lambda **params: [util.curated_file_path(table_name) for table_name in tables]))
+        return function
+    return register
+
+def partition_version(path):
+    path = util.resolve_file_path(path)
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def result_size(result):
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return int(result.memory_usage(deep=True).sum())
+    return sys.getsizeof(result)
+
+def copy_result(result):
+    # cached DataFrames are never handed out, so callers can't modify them
+    return result.copy() if isinstance(result, (pd.DataFrame, pd.Series)) else result
+
+def is_racy(versions, now_ns):
+    return any(version is not None and version[1] > now_ns - RACY_SECONDS * 1e9 for _, version in versions)
+
+def cached_bytes():
+    return sum(entry['size'] for entry in _cache.values())
+
+def evict():
+    while _cache and (len(_cache) > settings['max_entries'] or cached_bytes() > settings['max_bytes']):
+        _cache.popitem(last=False)
+        stats['evictions'] += 1
+
+def run_query(name, **params):
+    """
+    Returns the result of a registered query, from the cache if none of the partitions it read changed since.
+    """
+    function, partitions = QUERIES[name]
+    key = (name, tuple(sorted(params.items())))
+
+    # versions are read before running the query, so a partition rewritten while it runs is detected on the next call
+    now_ns = time.time_ns()
+    versions = tuple((path, partition_version(path)) for path in partitions(**params))
+
+    entry = _cache.get(key)
+    if entry is not None and entry['versions'] == versions:
+        _cache.move_to_end(key)
+        stats['hits'] += 1
+        return copy_result(entry['result'])
+
+    stats['misses'] += 1
+    if entry is not None:
+        del _cache[key]
+        stats['invalidations'] += 1
+
+    result = function(**params)
+    size = result_size(result)
+    if size <= settings['max_bytes'] and not is_racy(versions, now_ns):
+        _cache[key] = {'versions': versions, 'result': result, 'size': size}
+        evict()
+    return copy_result(result)
+
+
+@query(tables=[util.FACT_USER_DAILY_SNAPSHOT.name])
+def active_users_by_date(date=None):
+    # users in user_daily_snapshot of a date, or of every date
+    if date is not None:
+        predicates = [('date', '==', pd.to_datetime(date))]
+        return len(pandas_backend.read(util.FACT_USER_DAILY_SNAPSHOT.name, 'curated', columns=['user_id'], predicates=predicates))
+    df = util.load_csv_to_dataframe(util.FACT_USER_DAILY_SNAPSHOT.name, 'curated', columns=['user_id', 'date'])
+    return df.groupby('date').size().reset_index(name='total_active_users').sort_values('date', ignore_index=True)
+
+@query(tables=[util.DIM_USER.name, util.DEPOSIT.name])
+def users_without_deposit():
+    dim_user_df = util.load_csv_to_dataframe(util.DIM_USER.name, 'curated')
+    deposit_df = util.load_csv_to_dataframe(util.DEPOSIT.name, 'curated', columns=['user_id'])
+    return dim_user_df[~dim_user_df['user_id'].isin(deposit_df['user_id'])].reset_index(drop=True)
+
+@query(tables=[util.USER_LEVEL.name])
+def latest_user_levels():
+    # latest level of each user within each jurisdiction
+    df = util.load_csv_to_dataframe(util.USER_LEVEL.name, 'curated')
+    df = df.sort_values('event_timestamp', ascending=False).drop_duplicates(subset=['user_id', 'jurisdiction'])
+    return df.rename(columns={'level': 'current_level'})[['user_id', 'jurisdiction', 'current_level']].reset_index(drop=True)
+
+@query(tables=[util.DEPOSIT.name])
+def users_with_deposits_until(date, min_deposits=5):
+    # users with more than min_deposits deposits until the date
+    df = pandas_backend.read(util.DEPOSIT.name, 'curated', columns=['user_id'], predicates=[('event_timestamp', '<=', pd.to_datetime(date))])
+    counts = df.groupby('user_id').size().reset_index(name='qty_deposits')
+    return counts[counts['qty_deposits'] > min_deposits].reset_index(drop=True)
+
+@query(partitions=lambda table_name, user_id: [util.curated_file_path(table_name)])
+def user_history(table_name, user_id):
+    # rows of a user in a curated fact table, in date order (e.g. the deposits of the user)
+    spec = util.table_spec(table_name)
+    df = clustering.read_user_rows(table_name, user_id)
+    return df.sort_values(spec.date_column, kind='stable', ignore_index=True)
+
+@query(tables=[util.DIM_USER.name])
+def last_login(user_id=None):
+    # users not in the Bloom filter of dim_user are unknown, without reading it
+    if user_id is not None and not catalog.may_contain_user(util.DIM_USER.name, 'curated', user_id):
+        return util.empty_table_dataframe(util.DIM_USER.name)
+    df = util.load_csv_to_dataframe(util.DIM_USER.name, 'curated')
+    return df[df['user_id'] == user_id].reset_index(drop=True) if user_id is not None else df
+
+@query(tables=[util.DIM_USER_HISTORY.name])
+def last_logins_as_of(date):
+    # last login of every user as loaded on the date, from the versions valid on it
+    as_of = pd.to_datetime(date).normalize()
+    df = util.load_csv_to_dataframe(util.DIM_USER_HISTORY.name, 'curated')
+    is_valid = (df['valid_from'] <= as_of) & (df['valid_to'].isna() | (df['valid_to'] > as_of))
+    return df.loc[is_valid, ['user_id', 'last_login']].reset_index(drop=True)
+
+@query(tables=[util.FACT_USER_DAILY_SNAPSHOT.name])
+def logins_between(start_date, end_date):
+    predicates = [('date', '>=', pd.to_datetime(start_date)), ('date', '<=', pd.to_datetime(end_date))]
+    df = pandas_backend.read(util.FACT_USER_DAILY_SNAPSHOT.name, 'curated', columns=['user_id', 'qty_logins'], predicates=predicates)
+    return df.groupby('user_id', as_index=False)['qty_logins'].sum()
+
+def currencies_on_date(date, amount_column):
+    predicates = [('date', '==', pd.to_datetime(date)), (amount_column, '>', 0)]
+    df = pandas_backend.read(util.FACT_DAILY_STATS.name, 'curated', columns=['currency'], predicates=predicates)
+    return int(df['currency'].nunique())
+
+@query(tables=[util.FACT_DAILY_STATS.name])
+def currencies_deposited(date):
+    return currencies_on_date(date, 'total_deposit_amount')
+
+@query(tables=[util.FACT_DAILY_STATS.name])
+def currencies_withdrawn(date):
+    return currencies_on_date(date, 'total_withdrawal_amount')
+
+@query(partitions=lambda date, kind='active': [activity_index.bitmap_file_path(pd.to_datetime(date))])
+def daily_active_users(date, kind='active'):
+    return activity_index.daily_active_users(pd.to_datetime(date), kind)
+
+@query(partitions=lambda date, kind='active': [activity_index.bitmap_file_path(pd.to_datetime(date) - timedelta(days=days)) for days in range(7)])
+def weekly_active_users(date, kind='active'):
+    return activity_index.weekly_active_users(pd.to_datetime(date), kind)
@@ -0,0 +1,102 @@
+import pandas as pd
+import util
+
+# Weekly and monthly rollups of user_daily_snapshot and daily_stats, kept in the curated layer.
+# They are updated incrementally for each loaded day: the previous contribution of the day (if it's being reprocessed)
+# is subtracted and the new one is added, so they never need to be recomputed from the daily facts.
+GRAINS = ['week', 'month']
+
+
+def period_start(dates, grain):
+    """
+    Returns the first day of the week (monday) or month of each date.
+    """
+    dates = pd.to_datetime(dates, format='mixed').dt.normalize()
+    if grain == 'week':
+        return dates - pd.to_timedelta(dates.dt.dayofweek, unit='D')
+    if grain == 'month':
+        return dates - pd.to_timedelta(dates.dt.day - 1, unit='D')
+    raise ValueError(f"Unsupported rollup grain: {grain}")
+
+def user_rollup_spec():
+    # rollup of user_daily_snapshot: keys, measures (destination column -> daily column) and date column
+    return {
+        'keys': ['user_id'],
+        'measures': {
+            'qty_deposits': 'qty_deposits',
+            'qty_withdrawals': 'qty_withdrawals',
+            'qty_logins': 'qty_logins',
+            'active_days': 'is_active'
+        },
+        'date_column': 'date'
+    }
+
+def stats_rollup_spec():
+    # rollup of daily_stats. Distinct users are not additive, use sketch.rollup_daily_stats for them.
+    return {
+        'keys': ['currency', 'level', 'jurisdiction'],
+        'measures': {
+            'total_withdrawal_amount': 'total_withdrawal_amount',
+            'total_deposit_amount': 'total_deposit_amount'
+        },
+        'date_column': 'date'
+    }
+
+def day_contribution(day_df, grain, spec):
+    """
+    Aggregates the rows of a day at the rollup grain.
+    """
+    keys = ['period_start'] + spec['keys']
+    measures = spec['measures']
+
+    contribution_df = day_df[spec['keys']].copy()
+    contribution_df['period_start'] = period_start(day_df[spec['date_column']], grain)
+    for rollup_column, daily_column in measures.items():
+        contribution_df[rollup_column] = day_df[daily_column].astype(float)
+
+    return contribution_df.groupby(keys)[list(measures.keys())].sum()
+
+def apply_day_contribution(rollup_df, old_day_df, new_day_df, grain, spec):
+    """
+    Subtracts the old contribution of a day from the rollup and adds the new one.
+    Groups left with all measures equal to zero are removed, as the daily facts do with rows without activity.
+    """
+    keys = ['period_start'] + spec['keys']
+    measures = list(spec['measures'].keys())
+
+    delta = day_contribution(new_day_df, grain, spec).sub(day_contribution(old_day_df, grain, spec), fill_value=0)
+
+    if rollup_df is None or rollup_df.empty:
+        updated = delta
+    else:
+        rollup_df = rollup_df.copy()
+        rollup_df['period_start'] = pd.to_datetime(rollup_df['period_start'], format='mixed')
+        updated = rollup_df.set_index(keys)[measures].add(delta, fill_value=0)
+
+    # rounding avoids floating point residues from subtractions piling up over reprocessings
+    updated = updated.round(8)
+    updated = updated[(updated != 0).any(axis=1)].reset_index()
+
+    for column, daily_column in spec['measures'].items():
+        if daily_column.startswith('qty_') or daily_column.startswith('is_'):
+            updated[column] = updated[column].astype(int)
+
+    return updated.sort_values(keys).reset_index(drop=True)
+
+def rollup_table_name(table_name, grain):
+    # e.g. user_daily_snapshot -> user_weekly_snapshot, daily_stats -> monthly_stats
+    return table_name.replace('daily', grain + 'ly')
+
+def update_rollups(table_name, old_day_df, new_day_df, spec):
+    """
+    Updates the weekly and monthly rollups of a daily fact table with the rows generated for a day.
+    old_day_df contains the rows of the day the fact table had before the load (empty on the first load).
+    """
+    for grain in GRAINS:
+        rollup_path = util.curated_file_path(rollup_table_name(table_name, grain))
+        rollup_df = None
+        if util.resolve_file_path(rollup_path) is not None:
+            rollup_df = util.read_csv(rollup_path, dtype={'user_id': str})
+
+        updated_df = apply_day_contribution(rollup_df, old_day_df, new_day_df, grain, spec)
+        util.write_csv(updated_df, rollup_path)
@@ -0,0 +1,126 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import util
+import sketch
+
+# Sampling of users for development runs: with a fraction, extract only keeps the rows of the users whose user_id
+# hash falls in that fraction of the hash space, in every table (user_id, event, deposit, withdrawal, user_level), so
+# the rest of the pipeline runs unchanged on complete histories of fewer users and joins by user stay consistent.
+# The hash is deterministic (see sketch.hash_values), the same users are sampled on every run, and a larger fraction
+# keeps the users of a smaller one. The upper 32 bits of the hash are used, the lower ones pick the shard of a user
+# (see shard.py), so every shard keeps the same fraction of its users.
+# Extract writes data-lake/_sample.json with the fraction and the rows of each table before and after sampling.
+# Facts summed over users are extrapolated to the whole population with extrapolate(), dividing by the fraction of
+# users actually sampled. A data lake can't mix sampled and full extractions, extract refuses a fraction other than
+# the one in the manifest.
+MANIFEST_PATH = 'data-lake/_sample.json'
+HASH_SPACE = 1 << 32
+
+# measures of daily_stats and of its rollups that sum over users
+EXTRAPOLATED_COLUMNS = [
+    'total_active_users',
+    'total_distinct_withdrawal_users',
+    'total_distinct_deposit_users',
+    'total_withdrawal_amount',
+    'total_deposit_amount'
+]
+
+# fraction of the users extracted, None for all of them
+fraction = None
+
+
+def set_fraction(value):
+    global fraction
+    if value is not None and not 0 < value <= 1:
+        raise ValueError(f"Sample fraction must be in (0, 1]: {value}")
+    fraction = value
+
+def threshold(sample_fraction):
+    return int(round(sample_fraction * HASH_SPACE))
+
+def is_sampled(user_ids, sample_fraction=None):
+    """
+    Boolean mask of the users in the sample. Empty user ids are kept, cleanup quarantines them as in a full run.
+    """
+    sample_fraction = sample_fraction or fraction
+    user_ids = pd.Series(user_ids)
+    if sample_fraction is None:
+        return np.ones(len(user_ids), dtype=bool)
+    buckets = sketch.hash_values(user_ids.fillna('')) >> np.uint64(32)
+    return (buckets < np.uint64(threshold(sample_fraction))) | user_ids.isna().to_numpy()
+
+def sample(df):
+    # rows of the sampled users
+    if fraction is None:
+        return df
+    return df[is_sampled(df['user_id'])]
+
+def read_manifest():
+    # None for a data lake extracted in full
+    if not os.path.isfile(MANIFEST_PATH):
+        return None
+    with open(MANIFEST_PATH) as manifest_file:
+        return json.load(manifest_file)
+
+def prepare_data_lake():
+    """
+    Raises ValueError when the data lake was extracted with another fraction than the current one, creates the
+    manifest of a new sampled data lake otherwise.
+    """
+    with util.file_lock('sample'):
+        manifest = read_manifest()
+        lake_fraction = manifest['fraction'] if manifest is not None else None
+        if manifest is None and fraction is not None:
+            if os.path.isdir('data-lake/raw') and os.listdir('data-lake/raw'):
+                raise ValueError("The data lake was extracted without sampling, run the sample in another directory")
+            write_manifest({'fraction': fraction, 'hash_threshold': threshold(fraction), 'tables': {}})
+        elif lake_fraction != fraction:
+            raise ValueError(f"The data lake was extracted with a sample of {lake_fraction} of the users, not {fraction}")
+
+def write_manifest(manifest):
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    with open(MANIFEST_PATH + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(MANIFEST_PATH + '.tmp', MANIFEST_PATH)
+
+def record_table(table_name, landing_rows, sampled_rows, users=None):
+    """
+    Records the rows of a table before and after sampling in the manifest, users is (total, sampled) for user_id.
+    Extract units of different tables may run at once (see work_queue.py), so the manifest is updated under a lock.
+    """
+    if fraction is None:
+        return None
+    with util.file_lock('sample'):
+        manifest = read_manifest()
+        manifest['tables'][table_name] = {'landing_rows': int(landing_rows), 'sampled_rows': int(sampled_rows)}
+        if users is not None:
+            manifest['users'] = {'total': int(users[0]), 'sampled': int(users[1])}
+        write_manifest(manifest)
+    return manifest
+
+def scale_factor(manifest=None):
+    """
+    Factor from the sample to the whole population: total users over sampled users when user_id was extracted, the
+    inverse of the fraction otherwise. 1 for a data lake extracted in full.
+    """
+    manifest = manifest or read_manifest()
+    if manifest is None:
+        return 1.0
+    users = manifest.get('users')
+    if users is not None and users['sampled'] > 0:
+        return users['total'] / users['sampled']
+    return 1 / manifest['fraction']
+
+def extrapolate(df, columns=None):
+    """
+    Copy of df (e.g. daily_stats or its rollups) with the measures summed over users scaled to the whole population.
+    Counts are rounded to integers. Per user facts (user_daily_snapshot, dim_user) need no scaling, their row counts do.
+    """
+    factor = scale_factor()
+    df = df.copy()
+    for col in columns or [col for col in EXTRAPOLATED_COLUMNS if col in df.columns]:
+        scaled = df[col] * factor
+        df[col] = scaled.round().astype(df[col].dtype) if pd.api.types.is_integer_dtype(df[col]) else scaled
+    return df
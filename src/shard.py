@@ -0,0 +1,85 @@
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import sketch
+
+# Sharded execution of the load steps that aggregate by user. Rows of every input are partitioned by a hash of
+# user_id, so all rows of a user land in the same shard and aggregations by user can be computed independently.
+# Shards run in a pool of processes, which is kept between calls to avoid paying the start up on every step.
+_executor = None
+_executor_workers = 0
+
+
+def shard_numbers(user_ids, num_shards):
+    # pandas hashing is deterministic across processes and runs, so a user is always in the same shard
+    return pd.util.hash_array(np.asarray(user_ids, dtype=object)) % np.uint64(num_shards)
+
+def partition_by_user(df, num_shards):
+    """
+    Splits df in num_shards DataFrames by a hash of the user_id column.
+    """
+    shards = shard_numbers(df['user_id'].to_numpy(), num_shards)
+    return [df[shards == shard] for shard in range(num_shards)]
+
+def executor(workers):
+    global _executor, _executor_workers
+    if _executor is None or _executor_workers != workers:
+        shutdown()
+        _executor = ProcessPoolExecutor(max_workers=workers)
+        _executor_workers = workers
+    return _executor
+
+def shutdown():
+    global _executor, _executor_workers
+    if _executor is not None:
+        _executor.shutdown()
+    _executor = None
+    _executor_workers = 0
+
+def map_by_user(function, dfs, workers, *args):
+    """
+    Runs function(*args, *shard_dfs) for each shard of users of the DataFrames in dfs, in a pool of workers
+    processes. Returns the results of the shards in a list.
+    """
+    partitioned = [partition_by_user(df, workers) for df in dfs]
+    futures = [
+        executor(workers).submit(function, *args, *[partitions[shard] for partitions in partitioned])
+        for shard in range(workers)
+    ]
+    return [future.result() for future in futures]
+
+def run_by_user(function, dfs, workers, *args):
+    """
+    Same as map_by_user for functions that return rows by user, concatenating the rows of all shards.
+    """
+    return pd.concat(map_by_user(function, dfs, workers, *args), ignore_index=True)
+
+def combine_aggregations(dfs, keys, sum_columns, sketch_columns):
+    """
+    Combines aggregations of different shards: counts and amounts are summed, since a user is in a single shard,
+    and sketches of distinct users are merged.
+    """
+    combined = pd.concat(dfs, ignore_index=True)
+    aggregations = {column: 'sum' for column in sum_columns}
+    aggregations.update({column: sketch.merge_serialized_sketches for column in sketch_columns})
+    return combined.groupby(keys, as_index=False).agg(aggregations)
+
+def combine_daily_stats_partials(partials):
+    """
+    Combines the aggregations of daily_stats computed for each shard (see load.compute_daily_stats_partials).
+    """
+    return {
+        'levels': pd.concat([partial['levels'] for partial in partials]).drop_duplicates(),
+        'deposit_agg': combine_aggregations(
+            [partial['deposit_agg'] for partial in partials], ['level', 'jurisdiction', 'currency'],
+            ['total_deposit_amount', 'total_distinct_deposit_users'], ['deposit_users_sketch']
+        ),
+        'withdrawal_agg': combine_aggregations(
+            [partial['withdrawal_agg'] for partial in partials], ['level', 'jurisdiction', 'currency'],
+            ['total_withdrawal_amount', 'total_distinct_withdrawal_users'], ['withdrawal_users_sketch']
+        ),
+        'total_active_users': combine_aggregations(
+            [partial['total_active_users'] for partial in partials], ['level', 'jurisdiction'],
+            ['total_active_users'], ['active_users_sketch']
+        )
+    }
@@ -0,0 +1,173 @@
+import pandas as pd
+import numpy as np
+import base64
+import zlib
+import util
+
+# HyperLogLog sketches used to store distinct users in daily_stats, so distinct counts can be merged across days.
+# With 2^12 registers the relative standard error of the estimate is 1.04 / sqrt(4096) ~= 1.6%.
+PRECISION = 12
+NUM_REGISTERS = 1 << PRECISION
+MAX_RANK = 64 - PRECISION + 1
+
+
+def relative_standard_error():
+    return 1.04 / np.sqrt(NUM_REGISTERS)
+
+def hash_values(values):
+    # pandas hashing is deterministic across processes and runs (fixed hash key), unlike python's hash()
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+def bit_length(values):
+    """
+    Vectorized bit length of uint64 values. Each 32 bits half is converted to float64 separately, which is exact.
+    """
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    high_length = np.frexp(high)[1]
+    low_length = np.frexp(low)[1]
+    return np.where(high > 0, high_length + 32, low_length)
+
+def register_ranks(hashes):
+    """
+    Returns the register index and rank (position of the first set bit after the index bits) of each hash.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    registers = (hashes >> np.uint64(64 - PRECISION)).astype(np.int64)
+    remaining = hashes << np.uint64(PRECISION)
+    ranks = np.minimum(64 - bit_length(remaining) + 1, MAX_RANK).astype(np.uint8)
+    return registers, ranks
+
+def empty_sketch():
+    return np.zeros(NUM_REGISTERS, dtype=np.uint8)
+
+def build_sketch(values):
+    sketch = empty_sketch()
+    registers, ranks = register_ranks(hash_values(values))
+    np.maximum.at(sketch, registers, ranks)
+    return sketch
+
+def merge_sketches(sketches):
+    merged = empty_sketch()
+    for sketch in sketches:
+        np.maximum(merged, sketch, out=merged)
+    return merged
+
+def merge_serialized_sketches(values):
+    return serialize_sketch(merge_sketches([deserialize_sketch(value) for value in values]))
+
+def estimate(sketch):
+    """
+    HyperLogLog estimate, with linear counting for small cardinalities.
+    """
+    alpha = 0.7213 / (1 + 1.079 / NUM_REGISTERS)
+    raw_estimate = alpha * NUM_REGISTERS ** 2 / np.sum(np.power(2.0, -sketch.astype(np.float64)))
+
+    empty_registers = np.count_nonzero(sketch == 0)
+    if raw_estimate <= 2.5 * NUM_REGISTERS and empty_registers > 0:
+        return NUM_REGISTERS * np.log(NUM_REGISTERS / empty_registers)
+    return raw_estimate
+
+def serialize_sketch(sketch):
+    """
+    Serializes a sketch to a compact string to be stored in csv files. Sketches with few users (the common case
+    in a single day) are stored as sparse (register, rank) pairs, others as the full array of registers.
+    Empty sketches are serialized as an empty string.
+    """
+    non_empty = np.flatnonzero(sketch)
+    if len(non_empty) == 0:
+        return ''
+    if len(non_empty) * 3 < NUM_REGISTERS:
+        payload = b'S' + non_empty.astype('<u2').tobytes() + sketch[non_empty].tobytes()
+    else:
+        payload = b'D' + sketch.tobytes()
+    return base64.b64encode(zlib.compress(payload)).decode('ascii')
+
+def deserialize_sketch(value):
+    sketch = empty_sketch()
+    if not isinstance(value, str) or value == '':
+        return sketch
+
+    payload = zlib.decompress(base64.b64decode(value))
+    if payload[:1] == b'D':
+        sketch[:] = np.frombuffer(payload[1:], dtype=np.uint8)
+    else:
+        size = (len(payload) - 1) // 3
+        registers = np.frombuffer(payload[1:1 + 2 * size], dtype='<u2')
+        sketch[registers] = np.frombuffer(payload[1 + 2 * size:], dtype=np.uint8)
+    return sketch
+
+def sketch_by_group(df, keys, value_column, sketch_column):
+    """
+    Builds one serialized sketch of value_column for each group of keys, in a single vectorized pass.
+    Returns a DataFrame with the keys and the sketch_column.
+    """
+    registers, ranks = register_ranks(hash_values(df[value_column].to_numpy()))
+    return sketch_by_group_from_ranks(df[keys], registers, ranks, sketch_column)
+
+def sketch_by_group_from_ranks(keys_df, registers, ranks, sketch_column):
+    """
+    Same as sketch_by_group, from the registers and ranks of the values (see register_ranks), so values hashed
+    once can be sketched by different groups.
+    """
+    keys = list(keys_df.columns)
+    ranked = keys_df.copy()
+    ranked['register'] = registers
+    ranked['rank'] = ranks
+
+    # keep only the max rank of each register in each group, before building the sketches
+    max_ranks = ranked.groupby(keys + ['register'], as_index=False, sort=False)['rank'].max()
+
+    sketches = []
+    for _, group_df in max_ranks.groupby(keys, sort=False):
+        sketch = empty_sketch()
+        sketch[group_df['register'].to_numpy()] = group_df['rank'].to_numpy()
+        sketches.append(serialize_sketch(sketch))
+
+    # groups come in order of first appearance, same as drop_duplicates, which also keeps the key dtypes
+    result_df = max_ranks[keys].drop_duplicates().reset_index(drop=True)
+    result_df[sketch_column] = pd.Series(sketches, dtype=object)
+    return result_df
+
+
+def rollup_daily_stats(daily_stats_df, start_date, end_date, group_by=('currency', 'level', 'jurisdiction')):
+    """
+    Rolls daily_stats up over a date range, merging the sketches of each group to estimate distinct users
+    (relative standard error given by relative_standard_error()) and summing the amounts.
+    Note that active users are tracked by level and jurisdiction, as in total_active_users, so grouping
+    active users by currency gives the active users of the level and jurisdiction.
+    """
+    # a list, pandas groups by a tuple as a single key
+    group_by = list(group_by)
+    start_date = pd.to_datetime(start_date).normalize()
+    end_date = pd.to_datetime(end_date).normalize()
+    dates = pd.to_datetime(daily_stats_df['date'], format='mixed')
+    in_range = daily_stats_df[(dates >= start_date) & (dates <= end_date)]
+
+    rows = []
+    for group, group_df in in_range.groupby(group_by):
+        row = dict(zip(group_by, group if isinstance(group, tuple) else (group,)))
+        for sketch_column, count_column in distinct_users_columns().items():
+            sketches = [deserialize_sketch(value) for value in group_df[sketch_column].unique()]
+            row[count_column] = int(round(estimate(merge_sketches(sketches))))
+        row['total_withdrawal_amount'] = group_df['total_withdrawal_amount'].sum()
+        row['total_deposit_amount'] = group_df['total_deposit_amount'].sum()
+        rows.append(row)
+
+    columns = group_by + list(distinct_users_columns().values()) + ['total_withdrawal_amount', 'total_deposit_amount']
+    return pd.DataFrame(rows, columns=columns)
+
+def rollup_curated_daily_stats(start_date, end_date, group_by=('currency', 'level', 'jurisdiction')):
+    """
+    Same as rollup_daily_stats, reading daily_stats from the curated layer.
+    """
+    daily_stats_df = util.load_csv_to_dataframe(util.FACT_DAILY_STATS.name, 'curated')
+    return rollup_daily_stats(daily_stats_df, start_date, end_date, group_by)
+
+def distinct_users_columns():
+    # sketch column in daily_stats -> distinct count it estimates
+    return {
+        'active_users_sketch': 'total_active_users',
+        'withdrawal_users_sketch': 'total_distinct_withdrawal_users',
+        'deposit_users_sketch': 'total_distinct_deposit_users'
+    }
@@ -0,0 +1,89 @@
+import pandas as pd
+import numpy as np
+import os
+from datetime import datetime
+
+
+def generate_landing_data(num_users=1000, start_date=datetime(2023, 1, 1), num_days=10, events_per_day=2000, seed=42):
+    """
+    Generates synthetic data with the same layout as the landing layer sample files, so benchmarks and tests
+    can run without the real exercise data. The output is deterministic for a given seed.
+    It also adds a few dirty rows (duplicates and empty primary keys) like the real samples.
+    """
+    rng = np.random.RandomState(seed)
+
+    user_ids = np.array(['%032x' % rng.randint(0, 2**62) for _ in range(num_users)])
+    jurisdictions = np.array(['mx', 'ar', 'br', 'co'])
+    currencies = np.array(['mxn', 'btc', 'eth', 'usd', 'ars'])
+    event_names = np.array(['login', '2falogin', 'login_api', 'logout', 'view_balance'])
+    interfaces = np.array(['web', 'app', 'api'])
+    statuses = np.array(['complete', 'pending', 'failed'])
+
+    def random_timestamps(n):
+        days = rng.randint(0, num_days, n)
+        seconds = rng.randint(0, 24 * 60 * 60, n)
+        timestamps = pd.Timestamp(start_date) + pd.to_timedelta(days, unit='D') + pd.to_timedelta(seconds, unit='s')
+        return timestamps.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    total_events = events_per_day * num_days
+    num_deposits = total_events // 4
+    num_withdrawals = total_events // 8
+    num_levels = max(num_users // 2, 1) + num_days * 10
+
+    event_df = pd.DataFrame({
+        'id': np.arange(1, total_events + 1),
+        'event_timestamp': random_timestamps(total_events),
+        'user_id': user_ids[rng.randint(0, num_users, total_events)],
+        'event_name': event_names[rng.randint(0, len(event_names), total_events)]
+    })
+
+    deposit_df = pd.DataFrame({
+        'id': np.arange(1, num_deposits + 1),
+        'event_timestamp': random_timestamps(num_deposits),
+        'user_id': user_ids[rng.randint(0, num_users, num_deposits)],
+        'amount': np.round(rng.exponential(500.0, num_deposits), 2),
+        'currency': currencies[rng.randint(0, len(currencies), num_deposits)],
+        'tx_status': statuses[rng.randint(0, len(statuses), num_deposits)]
+    })
+
+    withdrawal_df = pd.DataFrame({
+        'id': np.arange(1, num_withdrawals + 1),
+        'event_timestamp': random_timestamps(num_withdrawals),
+        'user_id': user_ids[rng.randint(0, num_users, num_withdrawals)],
+        'amount': np.round(rng.exponential(300.0, num_withdrawals), 2),
+        'interface': interfaces[rng.randint(0, len(interfaces), num_withdrawals)],
+        'currency': currencies[rng.randint(0, len(currencies), num_withdrawals)],
+        'tx_status': statuses[rng.randint(0, len(statuses), num_withdrawals)]
+    })
+
+    user_level_df = pd.DataFrame({
+        'user_id': user_ids[rng.randint(0, num_users, num_levels)],
+        'jurisdiction': jurisdictions[rng.randint(0, len(jurisdictions), num_levels)],
+        'level': rng.randint(0, 5, num_levels),
+        'event_timestamp': random_timestamps(num_levels)
+    })
+
+    user_id_df = pd.DataFrame({'user_id': user_ids})
+
+    # dirty rows, to simulate what we have in the real sample data
+    deposit_df = pd.concat([deposit_df, deposit_df.tail(5)], ignore_index=True)
+    event_df = pd.concat([event_df, event_df.head(5)], ignore_index=True)
+    user_level_df.loc[user_level_df.index[:3], 'user_id'] = None
+
+    return {
+        'user_id': user_id_df,
+        'event': event_df,
+        'deposit': deposit_df,
+        'withdrawal': withdrawal_df,
+        'user_level': user_level_df
+    }
+
+
+def write_landing_data(data, landing_dir='data-lake/landing/'):
+    """
+    Writes the synthetic tables in the same structure of the landing layer: <table>/<table>_sample_data.csv
+    """
+    for table_name, df in data.items():
+        table_dir = os.path.join(landing_dir, table_name)
+        os.makedirs(table_dir, exist_ok=True)
+        df.to_csv(os.path.join(table_dir, table_name + '_sample_data.csv'), index=False)
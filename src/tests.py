@@ -1,8 +1,38 @@
 import unittest
+import os
+import tempfile
+import time
+import threading
 import pandas as pd
 from pandas.testing import assert_frame_equal
 
 import load as l
+import cleanup as c
+import util
+import sketch
+import rollup
+import activity_index
+import shard
+import id_index
+import profiling
+import etl
+import fused
+import benchmark_aggregation
+import differential
+import query_cache
+import lookup_service
+import work_queue
+import block_index
+import pandas_backend
+import memory
+import catalog
+import bloom
+import clustering
+import synthetic
+import sampling
+import extract_daily_batches
+import compaction
+from datetime import datetime
 
 class TestMergeDimUser(unittest.TestCase):
     
@@ -409,5 +439,1307 @@ class TestMergeFactDailyStats(unittest.TestCase):
                            expected_df.sort_values(by=['date', 'currency', 'level', 'jurisdiction']).reset_index(drop=True))
 
 
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.df = pd.DataFrame({
+            'id': [1, 2, 3],
+            'user_id': ['user1', 'user2', 'user3'],
+            'amount': [10.5, 20.0, 30.25]
+        })
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip_per_codec(self):
+        for codec in ['gzip', 'zstd', None]:
+            path = os.path.join(self.directory.name, 'table.csv' + util.compression_extensions[codec])
+            util.write_csv(self.df, path)
+            assert_frame_equal(util.read_csv(path), self.df)
+
+    def test_reader_detects_codec_of_existing_file(self):
+        gzip_path = os.path.join(self.directory.name, 'table.csv.gz')
+        util.write_csv(self.df, gzip_path)
+
+        plain_path = os.path.join(self.directory.name, 'table.csv')
+        self.assertEqual(util.resolve_file_path(plain_path), gzip_path)
+        assert_frame_equal(util.read_csv(plain_path), self.df)
+
+    def test_write_removes_copies_with_other_codec(self):
+        plain_path = os.path.join(self.directory.name, 'table.csv')
+        zstd_path = plain_path + '.zst'
+        util.write_csv(self.df, plain_path)
+        util.write_csv(self.df.head(1), zstd_path)
+
+        self.assertFalse(os.path.isfile(plain_path))
+        assert_frame_equal(util.read_csv(plain_path), self.df.head(1))
+
+    def test_layer_extension(self):
+        util.set_layer_compression('trusted', 'gzip')
+        try:
+            path = util.data_lake_file_path('deposit', 'trusted', pd.Timestamp('2023-01-02'))
+            self.assertEqual(path, 'data-lake/trusted/deposit/2023-01-02/deposit.csv.gz')
+        finally:
+            util.set_layer_compression('trusted', None)
+        self.assertRaises(ValueError, util.set_layer_compression, 'trusted', 'lz4')
+
+
+class TestLateArrivals(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_route_late_rows_to_event_date_partition(self):
+        existing_df = pd.DataFrame({
+            'id': [1, 2],
+            'event_timestamp': ['2023-01-02 08:00:00', '2023-01-02 09:00:00'],
+            'user_id': ['user1', 'user2'],
+            'amount': [100.0, 200.0],
+            'currency': ['USD', 'USD'],
+            'tx_status': ['completed', 'completed']
+        })
+        util.write_csv(existing_df, util.data_lake_file_path('deposit', 'trusted', datetime(2023, 1, 2)))
+
+        batch_df = pd.DataFrame({
+            'id': [2, 3, 4],
+            'event_timestamp': ['2023-01-02 09:00:00', '2023-01-02 10:00:00', '2023-01-04 10:00:00'],
+            'user_id': ['user2', 'user3', 'user4'],
+            'amount': [250.0, 300.0, 400.0],
+            'currency': ['USD', 'USD', 'USD'],
+            'tx_status': ['completed', 'completed', 'completed']
+        })
+
+        on_time_df, late_dates = c.route_late_arriving_rows(batch_df, datetime(2023, 1, 4), 'deposit', ['id'])
+
+        self.assertEqual(on_time_df['id'].tolist(), [4])
+        self.assertEqual(late_dates, [datetime(2023, 1, 2)])
+
+        partition_df = util.read_csv(util.data_lake_file_path('deposit', 'trusted', datetime(2023, 1, 2)))
+        self.assertEqual(partition_df['id'].tolist(), [1, 2, 3])
+        self.assertEqual(partition_df['amount'].tolist(), [100.0, 250.0, 300.0])
+        self.assertEqual(util.read_late_arrivals(datetime(2023, 1, 4)), {'deposit': [datetime(2023, 1, 2)]})
+
+        # reprocessing the batch without late rows clears the manifest for the table
+        c.route_late_arriving_rows(batch_df.tail(1), datetime(2023, 1, 4), 'deposit', ['id'])
+        self.assertEqual(util.read_late_arrivals(datetime(2023, 1, 4)), {})
+
+    def test_recleaning_keeps_rows_routed_by_later_batches(self):
+        def raw_deposits(day, ids, event_days):
+            df = pd.DataFrame({
+                'id': ids,
+                'event_timestamp': [f'2023-01-{event_day:02d} 10:00:00' for event_day in event_days],
+                'user_id': ['user' + str(i) for i in ids],
+                'amount': [10.0] * len(ids),
+                'currency': ['usd'] * len(ids),
+                'tx_status': ['complete'] * len(ids)
+            })
+            util.write_csv(df, util.data_lake_file_path('deposit', 'raw', datetime(2023, 1, day)))
+
+        raw_deposits(1, [1], [1])
+        raw_deposits(2, [2, 3], [2, 1])
+        c.cleanup(datetime(2023, 1, 1), datetime(2023, 1, 2), ['deposit'])
+        self.assertEqual(util.load_csv_to_dataframe('deposit', 'trusted', datetime(2023, 1, 1))['id'].tolist(), [1, 3])
+
+        c.cleanup(datetime(2023, 1, 1), datetime(2023, 1, 1), ['deposit'])
+        self.assertEqual(util.load_csv_to_dataframe('deposit', 'trusted', datetime(2023, 1, 1))['id'].tolist(), [1, 3])
+
+        # by chunks too
+        memory.set_budget(1)
+        try:
+            c.cleanup(datetime(2023, 1, 1), datetime(2023, 1, 1), ['deposit'])
+        finally:
+            memory.set_budget(None)
+        self.assertEqual(util.load_csv_to_dataframe('deposit', 'trusted', datetime(2023, 1, 1))['id'].tolist(), [1, 3])
+
+    def test_plan_recomputes_only_affected_days(self):
+        late_arrivals = {
+            'deposit': [datetime(2023, 1, 2)],
+            'user_level': [datetime(2023, 1, 3)]
+        }
+
+        plan = l.plan_late_arrivals_recomputation(datetime(2023, 1, 5), late_arrivals)
+
+        self.assertEqual(list(plan.keys()), [datetime(2023, 1, 2), datetime(2023, 1, 3), datetime(2023, 1, 4)])
+        self.assertEqual(plan[datetime(2023, 1, 2)], [l.load_fact_deposit, l.load_fact_user_daily_snapshot, l.load_fact_daily_stats])
+        self.assertEqual(plan[datetime(2023, 1, 3)], [l.load_user_level_fact, l.load_fact_daily_stats])
+        self.assertEqual(plan[datetime(2023, 1, 4)], [l.load_fact_daily_stats])
+
+
+class TestSketch(unittest.TestCase):
+
+    def test_estimate_within_error_bounds(self):
+        for cardinality in [10, 1000, 50000]:
+            values = ['user' + str(i) for i in range(cardinality)]
+            estimate = sketch.estimate(sketch.build_sketch(values))
+            self.assertLess(abs(estimate - cardinality) / cardinality, 4 * sketch.relative_standard_error())
+
+    def test_merge_equals_sketch_of_union(self):
+        first = ['user' + str(i) for i in range(0, 3000)]
+        second = ['user' + str(i) for i in range(2000, 6000)]
+        merged = sketch.merge_sketches([sketch.build_sketch(first), sketch.build_sketch(second)])
+        self.assertTrue((merged == sketch.build_sketch(first + second)).all())
+
+    def test_serialize_round_trip(self):
+        for cardinality in [0, 5, 20000]:
+            registers = sketch.build_sketch(['user' + str(i) for i in range(cardinality)])
+            self.assertTrue((sketch.deserialize_sketch(sketch.serialize_sketch(registers)) == registers).all())
+
+    def test_rollup_merges_days(self):
+        deposits_df = pd.DataFrame({
+            'date': ['2023-01-01', '2023-01-01', '2023-01-02', '2023-01-02', '2023-01-02'],
+            'currency': ['USD', 'USD', 'USD', 'USD', 'MXN'],
+            'user_id': ['user1', 'user2', 'user1', 'user3', 'user4'],
+        })
+        daily_stats_df = sketch.sketch_by_group(deposits_df, ['date', 'currency'], 'user_id', 'deposit_users_sketch')
+        daily_stats_df['active_users_sketch'] = daily_stats_df['deposit_users_sketch']
+        daily_stats_df['withdrawal_users_sketch'] = ''
+        daily_stats_df['total_withdrawal_amount'] = 0.0
+        daily_stats_df['total_deposit_amount'] = 1.0
+
+        result_df = sketch.rollup_daily_stats(daily_stats_df, '2023-01-01', '2023-01-02', ['currency'])
+
+        self.assertEqual(result_df['currency'].tolist(), ['MXN', 'USD'])
+        self.assertEqual(result_df['total_distinct_deposit_users'].tolist(), [1, 3])
+        self.assertEqual(result_df['total_distinct_withdrawal_users'].tolist(), [0, 0])
+        self.assertEqual(result_df['total_deposit_amount'].tolist(), [1.0, 2.0])
+
+
+class TestRollup(unittest.TestCase):
+
+    def test_period_start(self):
+        dates = pd.Series(['2023-01-01', '2023-01-02', '2023-01-08', '2023-02-15'])
+        self.assertEqual(rollup.period_start(dates, 'week').dt.strftime('%Y-%m-%d').tolist(),
+                         ['2022-12-26', '2023-01-02', '2023-01-02', '2023-02-13'])
+        self.assertEqual(rollup.period_start(dates, 'month').dt.strftime('%Y-%m-%d').tolist(),
+                         ['2023-01-01', '2023-01-01', '2023-01-01', '2023-02-01'])
+
+    def test_reprocessing_replaces_day_contribution(self):
+        spec = rollup.user_rollup_spec()
+        first_day_df = pd.DataFrame({
+            'user_id': ['user1', 'user2'],
+            'date': [pd.Timestamp('2023-01-02'), pd.Timestamp('2023-01-02')],
+            'qty_deposits': [2, 1],
+            'qty_withdrawals': [0, 1],
+            'qty_logins': [1, 1],
+            'is_active': [True, True]
+        })
+        second_day_df = pd.DataFrame({
+            'user_id': ['user1'],
+            'date': [pd.Timestamp('2023-01-03')],
+            'qty_deposits': [1],
+            'qty_withdrawals': [0],
+            'qty_logins': [3],
+            'is_active': [True]
+        })
+        rollup_df = rollup.apply_day_contribution(None, first_day_df.iloc[0:0], first_day_df, 'week', spec)
+        rollup_df = rollup.apply_day_contribution(rollup_df, second_day_df.iloc[0:0], second_day_df, 'week', spec)
+
+        # reprocessing the first day, user2 is gone and user1 has one deposit less
+        reprocessed_day_df = first_day_df.head(1).assign(qty_deposits=1)
+        rollup_df = rollup.apply_day_contribution(rollup_df, first_day_df, reprocessed_day_df, 'week', spec)
+
+        expected_df = pd.DataFrame({
+            'period_start': [pd.Timestamp('2023-01-02')],
+            'user_id': ['user1'],
+            'qty_deposits': [2],
+            'qty_withdrawals': [0],
+            'qty_logins': [4],
+            'active_days': [2]
+        })
+        assert_frame_equal(rollup_df, expected_df)
+
+
+class TestActivityIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+
+        activity_index.save_activity_bitmaps(datetime(2023, 1, 1), pd.DataFrame({
+            'user_id': ['user1', 'user2', 'user3'],
+            'qty_deposits': [1, 0, 0],
+            'qty_withdrawals': [0, 1, 0],
+            'qty_logins': [1, 1, 2],
+            'is_active': [True, True, False]
+        }))
+        activity_index.save_activity_bitmaps(datetime(2023, 1, 2), pd.DataFrame({
+            'user_id': ['user4', 'user2'],
+            'qty_deposits': [1, 1],
+            'qty_withdrawals': [0, 0],
+            'qty_logins': [0, 1],
+            'is_active': [True, True]
+        }))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_daily_and_period_counts(self):
+        self.assertEqual(activity_index.daily_active_users(datetime(2023, 1, 1)), 2)
+        self.assertEqual(activity_index.daily_active_users(datetime(2023, 1, 1), 'logged_in'), 3)
+        self.assertEqual(activity_index.daily_active_users(datetime(2023, 1, 3)), 0)
+        self.assertEqual(activity_index.weekly_active_users(datetime(2023, 1, 2)), 3)
+        self.assertEqual(activity_index.monthly_active_users(datetime(2023, 1, 2), 'deposited'), 3)
+
+    def test_retention_and_intersection(self):
+        self.assertEqual(activity_index.retention(datetime(2023, 1, 1), datetime(2023, 1, 2)), 0.5)
+        self.assertEqual(activity_index.active_on_both(datetime(2023, 1, 1), datetime(2023, 1, 2)), ['user2'])
+        self.assertEqual(activity_index.active_on_both(datetime(2023, 1, 1), datetime(2023, 1, 2), 'logged_in'), ['user2'])
+
+
+class TestTableRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_source_tables_in_cleanup_order(self):
+        self.assertEqual([spec.name for spec in util.source_tables()], ['user_level', 'withdrawal', 'user_id', 'event', 'deposit'])
+
+    def test_typed_read_with_column_pruning(self):
+        date = datetime(2023, 1, 2)
+        util.write_csv(pd.DataFrame({
+            'id': [1, 2],
+            'event_timestamp': ['2023-01-02 08:00:00', '2023-01-02 09:00:00'],
+            'user_id': ['001', '002'],
+            'event_name': ['login', 'logout']
+        }), util.EVENT.file_path('trusted', date))
+
+        event_df = util.load_csv_to_dataframe('event', 'trusted', date, columns=['user_id', 'event_name', 'event_timestamp'])
+
+        self.assertEqual(list(event_df.columns), ['user_id', 'event_name', 'event_timestamp'])
+        self.assertEqual(event_df['user_id'].tolist(), ['001', '002'])
+        self.assertEqual(str(event_df['event_name'].dtype), 'category')
+        self.assertEqual(str(event_df['event_timestamp'].dtype), 'datetime64[ns]')
+
+    def test_missing_file_returns_empty_typed_dataframe(self):
+        deposit_df = util.load_csv_to_dataframe('deposit', 'trusted', datetime(2023, 1, 2), columns=['id', 'amount', 'event_timestamp'])
+
+        self.assertTrue(deposit_df.empty)
+        self.assertEqual([str(dtype) for dtype in deposit_df.dtypes], ['int64', 'float64', 'datetime64[ns]'])
+
+
+class TestQuarantine(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+
+        self.raw_df = pd.DataFrame({
+            'id': [1, 2, 2, 3, 4],
+            'event_timestamp': ['2023-01-02 08:00:00', '2023-01-02 09:00:00', '2023-01-02 09:30:00', '2023-01-02 10:00:00', 'invalid'],
+            'user_id': ['user1', 'user2', 'user2', None, 'user4'],
+            'event_name': ['login', 'login', 'logout', 'login', 'login']
+        })
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_rejection_reasons(self):
+        reasons = c.rejection_reasons(self.raw_df, ['id'], util.EVENT.schema)
+        self.assertEqual(reasons.tolist(), [None, 'duplicate_primary_key', None, 'invalid_schema', 'invalid_schema'])
+
+    def test_cleanup_saves_quarantine_and_counters(self):
+        date = datetime(2023, 1, 2)
+        raw_path = util.data_lake_file_path('event', 'raw', date)
+        trusted_path = util.data_lake_file_path('event', 'trusted', date)
+        util.write_csv(self.raw_df, raw_path)
+
+        c.cleanup_and_save(raw_path, trusted_path, ['id'], util.EVENT.schema, 'event', date)
+
+        self.assertEqual(util.read_csv(trusted_path)['id'].tolist(), [1, 2])
+        quarantine_df = util.read_csv(util.data_lake_file_path('event', 'quarantine', date))
+        self.assertEqual(quarantine_df['id'].tolist(), [2, 3, 4])
+        self.assertEqual(quarantine_df['reason'].tolist(), ['duplicate_primary_key', 'invalid_schema', 'invalid_schema'])
+
+        counters_df = util.read_quarantine_counters(date).set_index('reason')
+        self.assertEqual(counters_df['rows'].to_dict(), {'invalid_schema': 2, 'duplicate_primary_key': 1})
+
+        # reprocessing with valid data clears the quarantine of the batch
+        util.write_csv(self.raw_df.head(1), raw_path)
+        c.cleanup_and_save(raw_path, trusted_path, ['id'], util.EVENT.schema, 'event', date)
+        self.assertIsNone(util.resolve_file_path(util.data_lake_file_path('event', 'quarantine', date)))
+        self.assertTrue(util.read_quarantine_counters(date).empty)
+
+
+class TestShard(unittest.TestCase):
+
+    def setUp(self):
+        self.user_level_df = pd.DataFrame({
+            'user_id': ['user1', 'user2', 'user3', 'user4', 'user1'],
+            'jurisdiction': ['mx', 'mx', 'ar', 'mx', 'mx'],
+            'level': [1, 1, 2, 1, 2],
+            'event_timestamp': pd.to_datetime(['2023-01-01', '2023-01-01', '2023-01-01', '2023-01-01', '2023-01-02'])
+        })
+        self.deposit_df = pd.DataFrame({
+            'user_id': ['user1', 'user2', 'user3', 'user4', 'user2'],
+            'event_timestamp': pd.to_datetime(['2023-01-02 10:00', '2023-01-02 11:00', '2023-01-02 12:00', '2023-01-01 12:00', '2023-01-02 13:00']),
+            'amount': [10.0, 20.0, 30.0, 40.0, 5.0],
+            'currency': ['mxn', 'mxn', 'btc', 'mxn', 'mxn']
+        })
+        self.withdrawal_df = pd.DataFrame({
+            'user_id': ['user4'],
+            'event_timestamp': pd.to_datetime(['2023-01-02 10:00']),
+            'amount': [15.0],
+            'currency': ['mxn']
+        })
+
+    def tearDown(self):
+        shard.shutdown()
+
+    def test_partition_by_user(self):
+        shards = shard.partition_by_user(self.deposit_df, 3)
+        self.assertEqual(sum(len(shard_df) for shard_df in shards), len(self.deposit_df))
+        # all rows of a user are in the same shard
+        for shard_df in shards:
+            others = pd.concat([other for other in shards if other is not shard_df])
+            self.assertFalse(shard_df['user_id'].isin(others['user_id']).any())
+
+    def test_sharded_daily_stats_equal_unsharded(self):
+        snapshot_date = pd.Timestamp('2023-01-02')
+        expected_df = l.assemble_fact_daily_stats(snapshot_date, l.compute_daily_stats_partials(
+            snapshot_date, self.user_level_df.copy(), self.deposit_df.copy(), self.withdrawal_df.copy()))
+
+        # each user in its own shard, combined as generate_fact_daily_stats does with workers > 1
+        partials = [
+            l.compute_daily_stats_partials(snapshot_date, *[df[df['user_id'] == user_id].copy()
+                                                            for df in [self.user_level_df, self.deposit_df, self.withdrawal_df]])
+            for user_id in ['user1', 'user2', 'user3', 'user4']
+        ]
+        result_df = l.assemble_fact_daily_stats(snapshot_date, shard.combine_daily_stats_partials(partials))
+
+        keys = ['currency', 'level', 'jurisdiction']
+        assert_frame_equal(result_df.sort_values(keys).reset_index(drop=True),
+                           expected_df.sort_values(keys).reset_index(drop=True), check_dtype=False)
+
+    def test_run_by_user(self):
+        expected_df = l.compute_fact_user_level(self.user_level_df.copy())
+        result_df = shard.run_by_user(l.compute_fact_user_level, [self.user_level_df], 2)
+        assert_frame_equal(result_df.sort_values('user_id').reset_index(drop=True),
+                           expected_df.sort_values('user_id').reset_index(drop=True))
+
+
+class TestChunkedMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+
+        self.destination_df = pd.DataFrame({
+            'id': [1, 2, 3, 4, 5],
+            'event_timestamp': pd.to_datetime(['2023-01-01 10:00:00', '2023-01-01 11:00:00', '2023-01-02 10:00:00',
+                                               '2023-01-02 11:00:00', '2023-01-03 09:00:00']),
+            'user_id': ['user1', 'user2', 'user1', 'user3', 'user2'],
+            'amount': [10.0, 20.0, 30.0, 40.0, 50.0],
+            'currency': ['mxn', 'mxn', 'btc', 'mxn', 'usd'],
+            'tx_status': ['complete', 'complete', 'failed', 'complete', 'complete']
+        })
+        # reloads 2023-01-02, id 5 is re-sent with a new timestamp
+        self.source_df = pd.DataFrame({
+            'id': [3, 5, 6],
+            'event_timestamp': pd.to_datetime(['2023-01-02 10:00:00', '2023-01-02 12:00:00', '2023-01-02 13:00:00']),
+            'user_id': ['user1', 'user2', 'user4'],
+            'amount': [35.0, 50.0, 60.0],
+            'currency': ['btc', 'usd', 'mxn'],
+            'tx_status': ['complete', 'complete', 'complete']
+        })
+
+    def tearDown(self):
+        util.set_merge_chunk_rows(None)
+        util.set_layer_compression('curated', None)
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_chunked_merge_equals_in_memory_merge(self):
+        date = datetime(2023, 1, 2)
+        expected_df = l.merge_fact_deposit(date, self.source_df, self.destination_df).reset_index(drop=True)
+
+        util.set_layer_compression('curated', 'zstd')
+        util.set_merge_chunk_rows(2)
+        util.write_csv(self.destination_df, util.DEPOSIT.file_path('curated'))
+        old_day_df = l.load_curated_table(date, util.DEPOSIT, self.source_df, l.merge_fact_deposit)
+
+        result_df = util.load_csv_to_dataframe(util.DEPOSIT.name, 'curated')
+        assert_frame_equal(result_df, expected_df[result_df.columns], check_dtype=False)
+        # returns the rows the destination had for the date
+        self.assertEqual(old_day_df['id'].tolist(), [3, 4])
+
+    def test_merges_agree_on_ids_resent_from_another_date(self):
+        date = datetime(2023, 1, 2)
+        path = util.DEPOSIT.file_path('curated')
+        # id 5 and a later one in a full last block, without rows of the date
+        destination_df = pd.concat([self.destination_df, self.destination_df.tail(1).assign(id=7)], ignore_index=True)
+        original_block_rows = block_index.BLOCK_ROWS
+        block_index.BLOCK_ROWS = 2
+        results = []
+        try:
+            for merge_chunk_rows, blocks in [(None, False), (2, False), (None, True)]:
+                util.set_merge_chunk_rows(merge_chunk_rows)
+                if blocks:
+                    block_index.write([destination_df], path)
+                else:
+                    util.write_csv(destination_df, path)
+                l.load_curated_table(date, util.DEPOSIT, self.source_df, l.merge_fact_deposit)
+                results.append(util.load_csv_to_dataframe(util.DEPOSIT.name, 'curated').sort_values('id').reset_index(drop=True))
+        finally:
+            block_index.BLOCK_ROWS = original_block_rows
+
+        # id 5 only keeps its row of 2023-01-02
+        self.assertEqual(results[0]['id'].tolist(), [1, 2, 3, 5, 6, 7])
+        self.assertEqual(results[0].loc[results[0]['id'] == 5, 'event_timestamp'].tolist(), [pd.Timestamp('2023-01-02 12:00:00')])
+        for result_df in results[1:]:
+            assert_frame_equal(result_df, results[0])
+
+
+class TestIdIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        id_index.use_bloom_filter = True
+        id_index.BLOOM_MIN_IDS = 1024
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_lookup(self):
+        id_index.update_id_index('deposit', datetime(2023, 1, 1), [5, 1, 3])
+        id_index.update_id_index('deposit', datetime(2023, 1, 2), [4, 2])
+        index = id_index.read_id_index('deposit')
+        # the second batch is appended as a segment
+        self.assertEqual([segment['ids'].tolist() for segment in index['segments']], [[1, 3, 5], [2, 4]])
+
+        days = id_index.lookup(index, [3, 4, 6])
+        self.assertEqual(days.tolist(), [id_index.batch_day(datetime(2023, 1, 1)), id_index.batch_day(datetime(2023, 1, 2)), id_index.NOT_FOUND])
+
+        id_index.use_bloom_filter = False
+        self.assertEqual(id_index.lookup(index, [3, 4, 6]).tolist(), days.tolist())
+
+    def test_segments_are_merged_and_reprocessed_batches_replaced(self):
+        # the Bloom filter is resized as the ids grow
+        id_index.BLOOM_MIN_IDS = 2
+        for day in range(1, 5):
+            id_index.update_id_index('deposit', datetime(2023, 1, day), [day * 10 + 1, day * 10 + 2])
+        index = id_index.read_id_index('deposit')
+        self.assertEqual([segment['ids'].tolist() for segment in index['segments']], [[11, 12, 21, 22, 31, 32, 41, 42]])
+
+        id_index.update_id_index('deposit', datetime(2023, 1, 2), [21, 23])
+        index = id_index.read_id_index('deposit')
+        self.assertEqual([len(segment['ids']) for segment in index['segments']], [6, 2])
+        days = id_index.lookup(index, [11, 21, 22, 23, 42])
+        self.assertEqual(days.tolist(), [id_index.batch_day(datetime(2023, 1, day)) if day else id_index.NOT_FOUND for day in [1, 2, None, 2, 4]])
+        # only the files of the manifest are left
+        self.assertEqual(len(os.listdir(id_index.id_index_dir('deposit'))), 2 * 2 + 2)
+
+    def test_cleanup_rejects_ids_from_other_days(self):
+        raw_df = pd.DataFrame({
+            'id': [1, 2],
+            'event_timestamp': ['2023-01-01 08:00:00', '2023-01-01 09:00:00'],
+            'user_id': ['user1', 'user2'],
+            'amount': [10.0, 20.0],
+            'currency': ['mxn', 'mxn'],
+            'tx_status': ['complete', 'complete']
+        })
+        for date, df in [(datetime(2023, 1, 1), raw_df), (datetime(2023, 1, 2), raw_df.assign(id=[2, 3], event_timestamp='2023-01-02 08:00:00'))]:
+            raw_path = util.data_lake_file_path('deposit', 'raw', date)
+            util.write_csv(df, raw_path)
+            c.cleanup_and_save(raw_path, util.data_lake_file_path('deposit', 'trusted', date), ['id'], util.DEPOSIT.schema, 'deposit', date)
+
+        trusted_df = util.read_csv(util.data_lake_file_path('deposit', 'trusted', datetime(2023, 1, 2)))
+        self.assertEqual(trusted_df['id'].tolist(), [3])
+        quarantine_df = util.read_csv(util.data_lake_file_path('deposit', 'quarantine', datetime(2023, 1, 2)))
+        self.assertEqual(quarantine_df['reason'].tolist(), ['duplicate_id_across_days'])
+
+        # reprocessing the first day doesn't reject its own ids
+        date = datetime(2023, 1, 1)
+        c.cleanup_and_save(util.data_lake_file_path('deposit', 'raw', date), util.data_lake_file_path('deposit', 'trusted', date),
+                           ['id'], util.DEPOSIT.schema, 'deposit', date)
+        self.assertEqual(util.read_csv(util.data_lake_file_path('deposit', 'trusted', date))['id'].tolist(), [1, 2])
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        profiling.disable()
+        self.directory.cleanup()
+
+    def test_sampled_runs_write_profiles(self):
+        profiling.enable(self.directory.name, sample_rate=0.5)
+        for day in range(1, 5):
+            with profiling.profile_stage('load_dim_user', datetime(2023, 1, day)):
+                sorted(range(10000), reverse=True)
+
+        files = sorted(os.listdir(os.path.join(self.directory.name, 'load_dim_user')))
+        self.assertEqual(files, [
+            '2023-01-02.collapsed', '2023-01-02.memory.txt', '2023-01-02.prof',
+            '2023-01-04.collapsed', '2023-01-04.memory.txt', '2023-01-04.prof'
+        ])
+
+    def test_late_arrival_recomputations_keep_the_profile_of_the_day(self):
+        profiling.enable(self.directory.name)
+        with profiling.profile_stage('load_dim_user', datetime(2023, 1, 1), datetime(2023, 1, 1)):
+            pass
+        with profiling.profile_stage('load_dim_user', datetime(2023, 1, 1), datetime(2023, 1, 3)):
+            pass
+
+        files = sorted(os.listdir(os.path.join(self.directory.name, 'load_dim_user')))
+        self.assertEqual([name for name in files if name.endswith('.prof')], ['2023-01-01.late-2023-01-03.prof', '2023-01-01.prof'])
+
+    def test_disabled(self):
+        with profiling.profile_stage('load_dim_user', datetime(2023, 1, 1)):
+            pass
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+class TestEtlCommandLine(unittest.TestCase):
+
+    def test_plan_work_units(self):
+        units = etl.plan_work_units(datetime(2023, 1, 1), datetime(2023, 1, 2), tables=['deposit', 'daily_stats'], stages=['cleanup', 'load'])
+        self.assertEqual(units, [
+            ('cleanup', 'deposit', datetime(2023, 1, 1)),
+            ('load', 'deposit', datetime(2023, 1, 1)),
+            ('load', 'daily_stats', datetime(2023, 1, 1)),
+            ('cleanup', 'deposit', datetime(2023, 1, 2)),
+            ('load', 'deposit', datetime(2023, 1, 2)),
+            ('load', 'daily_stats', datetime(2023, 1, 2))
+        ])
+
+    def test_parse_args(self):
+        args = etl.parse_args(['--from', '2023-01-01', '--to', '2023-01-07', '--tables', 'event,dim_user', '--stages', 'load', '--workers', '4'])
+        self.assertEqual((args.start_date, args.end_date), (datetime(2023, 1, 1), datetime(2023, 1, 7)))
+        self.assertEqual(args.tables, ['event', 'dim_user'])
+        self.assertEqual(args.stages, ['load'])
+        self.assertEqual(args.workers, 4)
+        self.assertFalse(args.dry_run)
+
+        with self.assertRaises(SystemExit):
+            etl.parse_args(['--stages', 'transform'])
+
+    def test_daily_stats_estimates_include_user_level(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                user_level_df = pd.DataFrame({'user_id': ['a', 'b'], 'jurisdiction': ['br', 'co'], 'level': [1, 2],
+                                              'event_timestamp': pd.to_datetime(['2023-01-01 10:00:00', '2023-01-01 11:00:00'])})
+                util.write_csv(user_level_df, util.USER_LEVEL.file_path('curated'))
+                catalog.record(util.USER_LEVEL.name, 'curated', None, user_level_df)
+
+                date = datetime(2023, 1, 1)
+                self.assertEqual(etl.estimate_input_bytes('load', 'daily_stats', date), os.path.getsize(util.USER_LEVEL.file_path('curated')))
+                self.assertEqual(etl.estimate_input_rows('load', 'daily_stats', date), 2)
+            finally:
+                os.chdir(cwd)
+
+
+class TestFusedAggregation(unittest.TestCase):
+
+    def setUp(self):
+        self.date = datetime(2023, 1, 1)
+        self.data = benchmark_aggregation.typed_inputs(num_users=300, events_per_day=3000)
+
+    def test_user_daily_snapshot(self):
+        inputs = [self.data[table].copy() for table in ['user_id', 'deposit', 'withdrawal', 'event']]
+        expected_df = l.compute_fact_user_daily_snapshot(self.date, *[df.copy() for df in inputs])
+        result_df = fused.compute_fact_user_daily_snapshot(self.date, *inputs)
+        assert_frame_equal(result_df.reset_index(drop=True), expected_df.reset_index(drop=True), check_dtype=False)
+
+    def test_daily_stats(self):
+        inputs = [self.data[table].copy() for table in ['user_level', 'deposit', 'withdrawal']]
+        snapshot_date = pd.Timestamp(self.date)
+        expected_df = l.assemble_fact_daily_stats(snapshot_date, l.compute_daily_stats_partials(snapshot_date, *[df.copy() for df in inputs]))
+        result_df = fused.compute_fact_daily_stats(self.date, *inputs)
+        # same rows in the same order, amounts summed in the same order
+        assert_frame_equal(result_df.reset_index(drop=True), expected_df.reset_index(drop=True), check_dtype=False, check_exact=True)
+
+
+class TestBackend(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        self.date = datetime(2023, 1, 1)
+        self.data = benchmark_aggregation.typed_inputs(num_users=300, events_per_day=3000)
+
+    def tearDown(self):
+        l.set_backend('pandas')
+
+    def compute_with(self, backend, function, tables):
+        l.set_backend(backend)
+        result = function(*[l.backend.from_pandas(self.data[table].copy()) for table in tables])
+        df = l.backend.to_pandas(result)
+        return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+    def assert_same_rows(self, function, tables):
+        expected_df = self.compute_with('pandas', function, tables)
+        result_df = self.compute_with('arrow', function, tables)
+        assert_frame_equal(result_df, expected_df, check_dtype=False)
+
+    def test_user_daily_snapshot(self):
+        self.assert_same_rows(lambda *tables: l.compute_fact_user_daily_snapshot(self.date, *tables), ['user_id', 'deposit', 'withdrawal', 'event'])
+
+    def test_daily_stats(self):
+        snapshot_date = pd.Timestamp(self.date)
+        self.assert_same_rows(lambda *tables: l.assemble_fact_daily_stats(snapshot_date, l.compute_daily_stats_partials(snapshot_date, *tables)),
+                              ['user_level', 'deposit', 'withdrawal'])
+
+    def test_dim_user_and_merges(self):
+        self.assert_same_rows(l.compute_dim_user, ['user_id', 'event'])
+        self.assert_same_rows(lambda source, destination: l.merge_fact_deposit(self.date, source, destination), ['deposit', 'deposit'])
+        self.assert_same_rows(lambda source, destination: l.merge_fact_user_level(self.date, l.compute_fact_user_level(source), destination),
+                              ['user_level', 'user_level'])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            l.set_backend('spark')
+
+
+class TestDifferential(unittest.TestCase):
+
+    def test_diff_table(self):
+        reference_df = pd.DataFrame({'id': [1, 2, 3], 'amount': [10.0, 20.0, 30.0], 'currency': ['usd', 'eur', 'brl']})
+        mode_df = pd.DataFrame({'id': [4, 2, 1], 'amount': [40.0, 20.0 + 1e-12, 10.0], 'currency': ['usd', 'usd', 'usd']})
+
+        diff = differential.diff_table(reference_df, mode_df, ['id'])
+        self.assertEqual(diff['missing'], [(3,)])
+        self.assertEqual(diff['extra'], [(4,)])
+        # amounts within the float tolerance don't count as changes
+        self.assertEqual(diff['changed'], [(2,)])
+        self.assertFalse(differential.is_match(diff))
+        self.assertTrue(differential.is_match(differential.diff_table(reference_df, reference_df.iloc[::-1], ['id'])))
+
+    def test_modes_match_reference(self):
+        timings, results = differential.run(['chunked'], num_users=100, num_days=2, events_per_day=200)
+        self.assertEqual(timings['mode'].tolist(), ['reference', 'chunked'])
+        self.assertTrue(results['match'].all())
+        self.assertEqual(set(results['table']), set(differential.curated_table_keys()) | {differential.ACTIVITY_BITMAP})
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+        query_cache.clear()
+        query_cache.configure()
+
+        self.dim_user_df = pd.DataFrame({'user_id': ['a', 'b', 'c'], 'last_login': pd.to_datetime(['2023-01-01', None, '2023-01-02'])})
+        self.deposit_df = pd.DataFrame({'id': [1], 'event_timestamp': pd.to_datetime(['2023-01-01 10:00:00']), 'user_id': ['a'],
+                                        'amount': [10.0], 'currency': ['usd'], 'tx_status': ['complete']})
+        self.write(util.DIM_USER, self.dim_user_df)
+        self.write(util.DEPOSIT, self.deposit_df)
+
+    def tearDown(self):
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+        query_cache.clear()
+        query_cache.configure()
+
+    def backdate(self, path):
+        # files written a minute ago, so results over them are not racy
+        past = time.time() - 60
+        os.utime(path, (past, past))
+
+    def write(self, spec, df):
+        util.write_csv(df, spec.file_path('curated'))
+        self.backdate(spec.file_path('curated'))
+
+    def save_bitmaps(self, date, user_ids):
+        snapshot_df = pd.DataFrame({'user_id': user_ids, 'date': date, 'qty_deposits': 1, 'qty_withdrawals': 0, 'qty_logins': 0, 'is_active': True})
+        activity_index.save_activity_bitmaps(date, snapshot_df)
+        self.backdate(activity_index.bitmap_file_path(date))
+
+    def test_cached_until_partition_is_rewritten(self):
+        self.assertEqual(query_cache.run_query('users_without_deposit')['user_id'].tolist(), ['b', 'c'])
+        self.assertEqual(query_cache.run_query('users_without_deposit')['user_id'].tolist(), ['b', 'c'])
+        self.assertEqual((query_cache.stats['misses'], query_cache.stats['hits']), (1, 1))
+
+        # a load rewrites deposit, the next run scans again
+        self.write(util.DEPOSIT, pd.concat([self.deposit_df, self.deposit_df.assign(id=2, user_id='b')]))
+        self.assertEqual(query_cache.run_query('users_without_deposit')['user_id'].tolist(), ['c'])
+        self.assertEqual(query_cache.stats['invalidations'], 1)
+
+    def test_only_rewritten_days_are_invalidated(self):
+        self.save_bitmaps(datetime(2023, 1, 1), ['a', 'b'])
+        self.save_bitmaps(datetime(2023, 1, 2), ['a'])
+        self.assertEqual(query_cache.run_query('daily_active_users', date='2023-01-01'), 2)
+        self.assertEqual(query_cache.run_query('daily_active_users', date='2023-01-02'), 1)
+
+        self.save_bitmaps(datetime(2023, 1, 2), ['a', 'b', 'c'])
+        self.assertEqual(query_cache.run_query('daily_active_users', date='2023-01-01'), 2)
+        self.assertEqual(query_cache.run_query('daily_active_users', date='2023-01-02'), 3)
+        self.assertEqual((query_cache.stats['hits'], query_cache.stats['invalidations']), (1, 1))
+
+    def test_recently_written_partitions_are_not_cached(self):
+        util.write_csv(self.dim_user_df, util.DIM_USER.file_path('curated'))
+        query_cache.run_query('last_login', user_id='a')
+        query_cache.run_query('last_login', user_id='a')
+        self.assertEqual(query_cache.stats['hits'], 0)
+
+    def test_least_recently_used_are_evicted(self):
+        query_cache.configure(max_entries=2)
+        query_cache.run_query('last_login', user_id='a')
+        query_cache.run_query('last_login', user_id='b')
+        query_cache.run_query('last_login', user_id='a')
+        query_cache.run_query('last_login', user_id='c')
+
+        # 'b' was the least recently used
+        query_cache.run_query('last_login', user_id='a')
+        query_cache.run_query('last_login', user_id='b')
+        self.assertEqual(query_cache.stats['evictions'], 2)
+        self.assertEqual((query_cache.stats['hits'], query_cache.stats['misses']), (2, 4))
+
+        query_cache.configure(max_bytes=0)
+        self.assertEqual(query_cache.cached_bytes(), 0)
+
+
+class TestLookupService(unittest.TestCase):
+
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+
+        util.write_csv(pd.DataFrame({'user_id': ['b', 'a', 'c'], 'last_login': ['2023-01-02 10:00:00', '2023-01-03 08:00:00', None]}),
+                       util.DIM_USER.file_path('curated'))
+        util.write_csv(pd.DataFrame({'user_id': ['a', 'a', 'a', 'b'], 'jurisdiction': ['br', 'br', 'co', 'br'], 'level': [1, 2, 0, 3],
+                                     'event_timestamp': ['2023-01-01 10:00:00', '2023-01-02 10:00:00', '2023-01-01 11:00:00', '2023-01-01 12:00:00']}),
+                       util.USER_LEVEL.file_path('curated'))
+        util.write_csv(pd.DataFrame({'user_id': ['a', 'b', 'a', 'a'], 'date': ['2023-01-03', '2023-01-01', '2023-01-01', '2023-01-02'],
+                                     'qty_deposits': [1, 1, 2, 0], 'qty_withdrawals': [0, 1, 1, 0], 'qty_logins': [3, 0, 1, 1],
+                                     'is_active': [True, True, True, False]}),
+                       util.FACT_USER_DAILY_SNAPSHOT.file_path('curated'))
+        l.write_load_marker(datetime(2023, 1, 3))
+        self.indexes = lookup_service.reload()
+
+    def tearDown(self):
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+        lookup_service._indexes = None
+
+    def test_point_lookups(self):
+        self.assertEqual(lookup_service.last_login('a'), '2023-01-03 08:00:00')
+        self.assertIsNone(lookup_service.last_login('c'))
+        with self.assertRaises(KeyError):
+            lookup_service.last_login('d')
+
+        self.assertEqual([(row['jurisdiction'], row['level']) for row in lookup_service.user_levels('a')], [('br', 2), ('co', 0)])
+        self.assertEqual(lookup_service.user_levels('d'), [])
+
+    def test_activity_totals(self):
+        self.assertEqual(lookup_service.activity_totals('a'), {'qty_deposits': 3, 'qty_withdrawals': 1, 'qty_logins': 5, 'active_days': 2})
+        self.assertEqual(lookup_service.activity_totals('a', '2023-01-02', '2023-01-03'),
+                         {'qty_deposits': 1, 'qty_withdrawals': 0, 'qty_logins': 4, 'active_days': 1})
+        self.assertEqual(lookup_service.activity_totals('b', '2023-01-02')['qty_deposits'], 0)
+        self.assertEqual(lookup_service.activity_totals('a', '2023-01-03', '2023-01-01')['qty_logins'], 0)
+
+    def test_reload_swaps_indexes(self):
+        self.assertEqual(lookup_service.status()['loaded_date'], '2023-01-03')
+        util.write_csv(pd.DataFrame({'user_id': ['d'], 'last_login': ['2023-01-04 09:00:00']}), util.DIM_USER.file_path('curated'))
+        l.write_load_marker(datetime(2023, 1, 4))
+
+        # lookups holding the previous indexes keep answering from them
+        self.assertNotEqual(lookup_service.load_marker_version(), self.indexes['marker_version'])
+        lookup_service.reload()
+        self.assertEqual(lookup_service.last_login('d'), '2023-01-04 09:00:00')
+        self.assertEqual(lookup_service.last_login('a', self.indexes), '2023-01-03 08:00:00')
+        self.assertEqual(lookup_service.status()['loaded_date'], '2023-01-04')
+
+    def test_watcher_retries_failed_reloads(self):
+        calls = []
+        original_reload = lookup_service.reload
+
+        def failing_reload():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                raise pd.errors.EmptyDataError('No columns to parse from file')
+            return original_reload()
+
+        l.write_load_marker(datetime(2023, 1, 4))
+        stop = threading.Event()
+        lookup_service.reload = failing_reload
+        try:
+            watcher = threading.Thread(target=lookup_service.watch_load_marker, args=(stop, 0.01))
+            watcher.start()
+            deadline = time.time() + 5
+            while lookup_service.status()['loaded_date'] != '2023-01-04' and time.time() < deadline:
+                time.sleep(0.01)
+            stop.set()
+            watcher.join()
+        finally:
+            lookup_service.reload = original_reload
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(lookup_service.status()['loaded_date'], '2023-01-04')
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+        work_queue.create_queue(work_queue.QUEUE_DIR, {})
+
+    def tearDown(self):
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def test_expired_lease_is_requeued(self):
+        queue_dir = work_queue.QUEUE_DIR
+        unit_id = work_queue.enqueue(queue_dir, 1, 'cleanup', 'deposit', datetime(2023, 1, 1))
+
+        unit = work_queue.claim(queue_dir)
+        self.assertEqual(unit['id'], unit_id)
+        self.assertIsNone(work_queue.claim(queue_dir))
+        self.assertEqual(work_queue.requeue_expired(queue_dir, lease_seconds=60), [])
+
+        # a worker that stopped sending heartbeats loses the unit
+        lease_path = work_queue.unit_path(queue_dir, 'leased', unit_id)
+        os.utime(lease_path, (time.time() - 120, time.time() - 120))
+        self.assertEqual(work_queue.requeue_expired(queue_dir, lease_seconds=60), [unit_id])
+        self.assertFalse(work_queue.heartbeat(queue_dir, unit_id))
+        self.assertFalse(work_queue.release(queue_dir, unit_id))
+
+        self.assertEqual(work_queue.claim(queue_dir)['id'], unit_id)
+        self.assertTrue(work_queue.release(queue_dir, unit_id))
+        self.assertEqual(work_queue.unit_state(queue_dir, unit_id), 'done')
+
+    def test_matches_serial_run(self):
+        _, results = differential.run(['queue'], num_users=100, num_days=2, events_per_day=200)
+        self.assertTrue(results['match'].all())
+
+
+class TestBlockIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+        self.deposit_df = pd.DataFrame({
+            'id': [1, 2, 3, 4, 5, 6],
+            'event_timestamp': pd.to_datetime(['2023-01-01 10:00:00', '2023-01-01 11:00:00', '2023-01-02 10:00:00',
+                                               '2023-01-02 12:00:00', '2023-01-03 09:00:00', '2023-01-03 10:00:00']),
+            'user_id': ['a', 'b', 'a', 'c', 'b', 'c'],
+            'amount': [10.0, 20.0, 30.0, 40.0, 50.0, 60.0],
+            'currency': ['USD', 'USD', 'EUR', 'USD', 'USD', 'EUR'],
+            'tx_status': ['complete'] * 6
+        })
+        self.path = util.DEPOSIT.file_path('curated')
+        block_index.write([self.deposit_df], self.path, block_rows=2)
+
+    def tearDown(self):
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def test_predicates_skip_blocks(self):
+        index = block_index.read_index(self.path)
+        self.assertEqual([block['rows'] for block in index['blocks']], [2, 2, 2])
+        self.assertEqual(block_index.selected_blocks(index, [('event_timestamp', 'date==', datetime(2023, 1, 2))], util.DEPOSIT), [1])
+        self.assertEqual(block_index.selected_blocks(index, [('id', '>', 4)], util.DEPOSIT), [2])
+        self.assertEqual(block_index.selected_blocks(index, [[('id', '==', 1), ('user_id', 'in', ['c'])]], util.DEPOSIT), [0, 1, 2])
+
+        df = pandas_backend.read('deposit', 'curated', columns=['id'], predicates=[('event_timestamp', 'date<=', datetime(2023, 1, 2)), ('currency', '==', 'USD')])
+        self.assertEqual(df.columns.tolist(), ['id'])
+        self.assertEqual(df['id'].tolist(), [1, 2, 4])
+
+        # the file is still a regular csv
+        assert_frame_equal(util.load_csv_to_dataframe('deposit', 'curated'), self.deposit_df)
+
+    def test_file_rewritten_without_index_is_read_whole(self):
+        util.write_csv(self.deposit_df.iloc[::-1], self.path)
+        self.assertIsNone(block_index.read_index(self.path))
+        df = pandas_backend.read('deposit', 'curated', predicates=[('event_timestamp', 'date==', datetime(2023, 1, 3))])
+        self.assertEqual(df['id'].tolist(), [6, 5])
+
+    def test_merge_reads_only_blocks_of_the_date(self):
+        source_df = pd.DataFrame({
+            'id': [7], 'event_timestamp': pd.to_datetime(['2023-01-02 15:00:00']), 'user_id': ['d'],
+            'amount': [70.0], 'currency': ['USD'], 'tx_status': ['complete']
+        })
+        original_block_rows = block_index.BLOCK_ROWS
+        block_index.BLOCK_ROWS = 2
+        try:
+            old_df = l.load_curated_table(datetime(2023, 1, 2), util.DEPOSIT, source_df, l.merge_fact_deposit)
+        finally:
+            block_index.BLOCK_ROWS = original_block_rows
+
+        # block of 2023-01-02 only, the last block is full
+        self.assertEqual(old_df['id'].tolist(), [3, 4])
+        self.assertEqual(util.load_csv_to_dataframe('deposit', 'curated')['id'].tolist(), [1, 2, 5, 6, 7])
+        self.assertIsNotNone(block_index.read_index(self.path))
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+
+    def tearDown(self):
+        memory.set_budget(None)
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def test_downcast(self):
+        df = memory.downcast(pd.DataFrame({'level': [1, 5], 'id': [1, 70000], 'amount': [1.5, 2.25], 'rate': [0.1, 0.2]}))
+        self.assertEqual(df.dtypes.astype(str).tolist(), ['int8', 'int32', 'float32', 'float64'])
+        self.assertEqual(memory.parse_size('1.5KB'), 1536)
+        self.assertEqual(memory.parse_size('512mb'), 512 * 1024 ** 2)
+
+    def cleanup_run(self, directory, raw_df, date):
+        os.makedirs(directory)
+        os.chdir(directory)
+        raw_path = util.data_lake_file_path('deposit', 'raw', date)
+        trusted_path = util.data_lake_file_path('deposit', 'trusted', date)
+        util.write_csv(raw_df, raw_path)
+        late_dates = c.cleanup_and_save(raw_path, trusted_path, ['id'], util.DEPOSIT.schema, 'deposit', date)
+        return {
+            'late_dates': late_dates,
+            'trusted': util.read_csv(trusted_path),
+            'late': util.read_csv(util.data_lake_file_path('deposit', 'trusted', datetime(2023, 1, 1))),
+            'quarantine': util.read_csv(util.data_lake_file_path('deposit', 'quarantine', date))
+        }
+
+    def test_chunked_cleanup_matches_cleanup(self):
+        rows = 3000
+        raw_df = pd.DataFrame({
+            'id': range(rows),
+            'event_timestamp': ['2023-01-02 10:00:00'] * rows,
+            'user_id': [f'user{i % 50}' for i in range(rows)],
+            'amount': [str(i) for i in range(rows)],
+            'currency': ['USD'] * rows,
+            'tx_status': ['complete'] * rows
+        })
+        # a duplicate in another chunk, late rows, and an empty amount in the last chunk only (a float column there)
+        raw_df.loc[2500, 'id'] = 10
+        raw_df.loc[[5, 1500], 'event_timestamp'] = '2023-01-01 23:00:00'
+        raw_df.loc[2900, 'amount'] = None
+        date = datetime(2023, 1, 2)
+
+        expected = self.cleanup_run(os.path.join(self.temp_dir.name, 'whole'), raw_df, date)
+        memory.set_budget(64 * 1024)
+        result = self.cleanup_run(os.path.join(self.temp_dir.name, 'chunked'), raw_df, date)
+
+        self.assertGreater(memory.estimate_bytes(util.data_lake_file_path('deposit', 'raw', date)), memory.budget)
+        self.assertEqual(result['late_dates'], expected['late_dates'])
+        for name in ['trusted', 'late', 'quarantine']:
+            assert_frame_equal(result[name], expected[name])
+        self.assertEqual(expected['quarantine']['id'].tolist(), [10])
+        self.assertEqual(len(expected['late']), 2)
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+        self.date = datetime(2023, 1, 2)
+        self.raw_df = pd.DataFrame({
+            'id': [1, 2, 3, 4],
+            'event_timestamp': ['2023-01-02 08:00:00', '2023-01-02 09:00:00', '2023-01-02 10:00:00', '2023-01-01 23:00:00'],
+            'user_id': ['user1', 'user2', 'user1', 'user3'],
+            'event_name': ['login', 'login', 'logout', 'login']
+        })
+
+    def tearDown(self):
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def test_cleanup_records_partitions(self):
+        raw_path = util.data_lake_file_path('event', 'raw', self.date)
+        trusted_path = util.data_lake_file_path('event', 'trusted', self.date)
+        util.write_csv(self.raw_df, raw_path)
+        c.cleanup_and_save(raw_path, trusted_path, ['id'], util.EVENT.schema, 'event', self.date)
+
+        entry = catalog.entry('event', 'trusted', self.date)
+        self.assertEqual((entry['rows'], entry['distinct_users']), (3, 2))
+        self.assertEqual(entry['stats']['event_timestamp']['min'], '2023-01-02 08:00:00')
+        self.assertEqual(entry['stats']['id']['max'], 3)
+        self.assertTrue(catalog.may_contain_user('event', 'trusted', 'user2', self.date))
+        self.assertFalse(catalog.may_contain_user('event', 'trusted', 'user3', self.date))
+        # the late row is recorded in the partition of its date
+        self.assertEqual(catalog.partition_rows('event', 'trusted', datetime(2023, 1, 1)), 1)
+
+        self.assertFalse(catalog.may_match('event', 'trusted', self.date, [('event_timestamp', 'date==', datetime(2023, 1, 3))]))
+        df = pandas_backend.read('event', 'trusted', self.date, predicates=[('id', '>', 3)])
+        self.assertEqual(df.columns.tolist(), list(util.EVENT.schema))
+        self.assertEqual(len(df), 0)
+
+        # a partition rewritten without the catalog has no entry
+        util.write_csv(self.raw_df, trusted_path)
+        self.assertIsNone(catalog.entry('event', 'trusted', self.date))
+        self.assertTrue(catalog.may_match('event', 'trusted', self.date, [('id', '>', 3)]))
+
+    def test_block_merge_updates_distinct_users(self):
+        deposit_df = pd.DataFrame({
+            'id': [1, 2, 3, 4],
+            'event_timestamp': pd.to_datetime(['2023-01-01 10:00:00', '2023-01-01 11:00:00', '2023-01-02 10:00:00', '2023-01-02 12:00:00']),
+            'user_id': ['a', 'b', 'c', 'c'],
+            'amount': [10.0, 20.0, 30.0, 40.0],
+            'currency': ['USD'] * 4,
+            'tx_status': ['complete'] * 4
+        })
+        block_index.write([deposit_df], util.DEPOSIT.file_path('curated'), block_rows=2)
+        catalog.record('deposit', 'curated', None, deposit_df)
+
+        # the rows of 2023-01-02 are replaced, user c leaves the table
+        source_df = deposit_df.iloc[2:].assign(id=[5, 6], user_id=['d', 'a'])
+        l.load_curated_table(self.date, util.DEPOSIT, source_df, l.merge_fact_deposit)
+
+        entry = catalog.entry('deposit', 'curated')
+        self.assertEqual((entry['rows'], entry['distinct_users']), (4, 3))
+        self.assertEqual(entry['stats']['id'], {'min': 1, 'max': 6, 'nulls': 0})
+        self.assertEqual(entry['stats']['event_timestamp']['max'], '2023-01-02 12:00:00')
+
+    def test_bloom_filter_bits_are_packed(self):
+        hashes = sketch.hash_values(['user' + str(i) for i in range(100)])
+        bits = bloom.new_filter(1000)
+        bloom.add(bits, hashes[:50], 1000, 7)
+        # bit i is the bit 7 - i % 8 of byte i // 8, as np.packbits
+        for position in bloom.positions(hashes[:1], 1000, 7)[0]:
+            self.assertTrue(bits[position // 8] & (128 >> position % 8))
+
+        contained = bloom.contains(bits, hashes, 1000, 7)
+        self.assertTrue(contained[:50].all())
+        self.assertLess(contained[50:].sum(), 5)
+
+class TestClustering(unittest.TestCase):
+
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+        self.deposit_df = pd.DataFrame({
+            'id': [1, 2, 3, 4, 5, 6],
+            'event_timestamp': pd.to_datetime(['2023-01-01 10:00:00', '2023-01-01 11:00:00', '2023-01-02 10:00:00',
+                                               '2023-01-02 12:00:00', '2023-01-03 09:00:00', '2023-01-03 10:00:00']),
+            'user_id': ['c', 'b', 'a', 'c', 'b', 'a'],
+            'amount': [10.0, 20.0, 30.0, 40.0, 50.0, 60.0],
+            'currency': ['USD'] * 6,
+            'tx_status': ['complete'] * 6
+        })
+        util.write_csv(self.deposit_df, util.DEPOSIT.file_path('curated'))
+        self.original_block_rows = block_index.BLOCK_ROWS
+        block_index.BLOCK_ROWS = 2
+
+    def tearDown(self):
+        block_index.BLOCK_ROWS = self.original_block_rows
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def test_compact_clusters_by_user(self):
+        self.assertEqual(clustering.compact('deposit'), {'rows': 6, 'blocks': 3})
+        df = util.load_csv_to_dataframe('deposit', 'curated')
+        self.assertEqual(df['id'].tolist(), [3, 6, 2, 5, 1, 4])
+
+        index = block_index.read_index(util.DEPOSIT.file_path('curated'))
+        self.assertEqual(index['clustered'], {'blocks': 3, 'until': '2023-01-03'})
+        self.assertEqual(block_index.selected_blocks(index, [('user_id', 'in', ['b'])], util.DEPOSIT), [1])
+        self.assertEqual(clustering.read_user_rows('deposit', 'b')['id'].tolist(), [2, 5])
+        self.assertEqual(len(clustering.read_user_rows('deposit', ['unknown'])), 0)
+
+    def test_later_dates_are_merged_after_the_clustered_blocks(self):
+        clustering.compact('deposit')
+        source_df = self.deposit_df.iloc[:1].assign(id=7, event_timestamp=pd.Timestamp('2023-01-04 10:00:00'), user_id='b')
+        old_df = l.load_curated_table(datetime(2023, 1, 4), util.DEPOSIT, source_df, l.merge_fact_deposit)
+        self.assertEqual(len(old_df), 0)
+
+        index = block_index.read_index(util.DEPOSIT.file_path('curated'))
+        self.assertEqual(index['clustered']['blocks'], 3)
+        self.assertEqual(util.load_csv_to_dataframe('deposit', 'curated')['id'].tolist(), [3, 6, 2, 5, 1, 4, 7])
+        history = query_cache.run_query('user_history', table_name='deposit', user_id='b')
+        self.assertEqual(history['id'].tolist(), [2, 5, 7])
+
+class TestDimUserHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+        l.set_dim_user_history(True)
+
+    def tearDown(self):
+        l.set_dim_user_history(False)
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def logins(self, rows):
+        return pd.DataFrame({'user_id': [user_id for user_id, _ in rows], 'last_login': pd.to_datetime([login for _, login in rows])})
+
+    def load(self, day, rows):
+        l.load_dim_user(datetime(2023, 1, day), increment=self.logins(rows))
+
+    def test_versions_are_added_on_change(self):
+        self.load(1, [('a', '2023-01-01 10:00:00'), ('b', None)])
+        self.load(3, [('a', '2023-01-03 10:00:00'), ('b', None)])
+        self.load(4, [('a', None), ('b', '2023-01-04 09:00:00')])
+        # an earlier date loaded later (late arriving logins), twice
+        self.load(2, [('a', '2023-01-02 10:00:00'), ('b', '2023-01-02 08:00:00')])
+        self.load(2, [('a', '2023-01-02 10:00:00'), ('b', '2023-01-02 08:00:00')])
+
+        history_df = util.load_csv_to_dataframe('dim_user_history', 'curated')
+        self.assertEqual(history_df['user_id'].tolist(), ['a', 'a', 'a', 'b', 'b', 'b'])
+        self.assertEqual(history_df['valid_from'].dt.day.tolist(), [1, 2, 3, 1, 2, 4])
+        self.assertEqual(history_df['valid_to'].dt.day.fillna(0).tolist(), [2, 3, 0, 2, 4, 0])
+
+        # the current versions are dim_user
+        current_df = history_df[history_df['valid_to'].isna()][['user_id', 'last_login']].reset_index(drop=True)
+        assert_frame_equal(current_df, util.load_csv_to_dataframe('dim_user', 'curated').sort_values('user_id', ignore_index=True))
+
+    def test_as_of_lookups(self):
+        self.load(1, [('a', '2023-01-01 10:00:00'), ('b', None)])
+        self.load(3, [('a', '2023-01-03 10:00:00'), ('b', '2023-01-03 11:00:00')])
+        indexes = {'dim_user_history': lookup_service.build_dim_user_history_index()}
+
+        self.assertEqual(lookup_service.last_login_as_of('a', '2023-01-02', indexes), '2023-01-01 10:00:00')
+        self.assertEqual(lookup_service.last_login_as_of('a', '2023-01-05', indexes), '2023-01-03 10:00:00')
+        self.assertIsNone(lookup_service.last_login_as_of('b', '2023-01-02', indexes))
+        with self.assertRaises(KeyError):
+            lookup_service.last_login_as_of('a', '2022-12-31', indexes)
+
+        as_of_df = query_cache.last_logins_as_of('2023-01-02')
+        self.assertEqual(as_of_df['user_id'].tolist(), ['a', 'b'])
+        self.assertTrue(as_of_df['last_login'].isna().tolist()[1])
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+        synthetic.write_landing_data(synthetic.generate_landing_data(num_users=400, num_days=2, events_per_day=500))
+
+    def tearDown(self):
+        sampling.set_fraction(None)
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def test_same_users_in_every_table(self):
+        user_ids = pd.Series(['%032x' % i for i in range(10000)])
+        self.assertTrue((sampling.is_sampled(user_ids, 0.1) == sampling.is_sampled(user_ids, 0.1)).all())
+        self.assertTrue((sampling.is_sampled(user_ids, 0.1) <= sampling.is_sampled(user_ids, 0.2)).all())
+        self.assertAlmostEqual(sampling.is_sampled(user_ids, 0.1).mean(), 0.1, delta=0.01)
+
+        sampling.set_fraction(0.25)
+        extract_daily_batches.extract(datetime(2023, 1, 1), datetime(2023, 1, 2))
+        sampled_users = set(util.read_csv(util.data_lake_file_path('user_id', 'raw', datetime(2023, 1, 1)))['user_id'])
+        for table_name in ['event', 'deposit', 'withdrawal', 'user_level']:
+            df = util.read_csv(util.data_lake_file_path(table_name, 'raw', datetime(2023, 1, 2)))
+            self.assertTrue(set(df['user_id'].dropna()) <= sampled_users)
+
+        manifest = sampling.read_manifest()
+        self.assertEqual(manifest['fraction'], 0.25)
+        self.assertEqual(manifest['users'], {'total': 400, 'sampled': len(sampled_users)})
+        self.assertEqual(set(manifest['tables']), {'user_id', 'event', 'deposit', 'withdrawal', 'user_level'})
+
+        # a data lake sampled with another fraction isn't extracted over
+        sampling.set_fraction(0.5)
+        with self.assertRaises(ValueError):
+            extract_daily_batches.extract(datetime(2023, 1, 1), datetime(2023, 1, 2))
+
+    def test_extrapolate(self):
+        df = pd.DataFrame({'total_active_users': [3, 5], 'total_deposit_amount': [10.0, 2.5], 'level': [1, 2]})
+        assert_frame_equal(sampling.extrapolate(df), df)
+
+        sampling.set_fraction(0.1)
+        extract_daily_batches.extract(datetime(2023, 1, 1), datetime(2023, 1, 1), tables=['deposit'])
+        extrapolated_df = sampling.extrapolate(df)
+        self.assertEqual(extrapolated_df['total_active_users'].tolist(), [30, 50])
+        self.assertEqual(extrapolated_df['total_deposit_amount'].tolist(), [100.0, 25.0])
+        self.assertEqual(extrapolated_df['level'].tolist(), [1, 2])
+
+
+class TestCompaction(unittest.TestCase):
+
+    def setUp(self):
+        self.original_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+
+    def tearDown(self):
+        util.set_layer_compression('trusted', None)
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def write_deposits(self, day, ids):
+        df = pd.DataFrame({
+            'id': ids,
+            'event_timestamp': [f'2023-01-{day:02d} 10:00:00'] * len(ids),
+            'user_id': ['user' + str(i) for i in ids],
+            'amount': [10.0 * i for i in ids],
+            'currency': ['usd'] * len(ids),
+            'tx_status': ['complete'] * len(ids)
+        })
+        util.write_csv(df, util.data_lake_file_path('deposit', 'trusted', datetime(2023, 1, day)))
+
+    def deposit_ids(self, day):
+        return util.load_csv_to_dataframe('deposit', 'trusted', datetime(2023, 1, day))['id'].tolist()
+
+    def test_days_are_read_from_the_monthly_file(self):
+        util.set_layer_compression('trusted', 'gzip')
+        for day, ids in [(1, [1, 2]), (2, []), (3, [3, 4, 5])]:
+            self.write_deposits(day, ids)
+        util.write_csv(pd.DataFrame({'id': [9]}), 'data-lake/trusted/deposit/2023-02-01/deposit.csv')
+
+        # february is still open
+        self.assertEqual(compaction.closed_months('deposit', 'trusted'), ['2023-01'])
+        results = compaction.compact(layers=['trusted'], tables=['deposit'])
+        self.assertEqual(results, {('trusted', 'deposit', '2023-01'): {'days': 3, 'rows': 5}})
+        self.assertFalse(os.path.exists('data-lake/trusted/deposit/2023-01-03'))
+        self.assertTrue(os.path.isfile('data-lake/trusted/deposit/2023-01.csv.gz'))
+
+        self.assertEqual([self.deposit_ids(day) for day in [1, 2, 3, 4]], [[1, 2], [], [3, 4, 5], []])
+        self.assertEqual(util.compacted_day(util.data_lake_file_path('deposit', 'trusted', datetime(2023, 1, 3)))['first_row'], 2)
+        self.assertEqual(compaction.read_range('deposit', 'trusted', '2023-01-02', '2023-01-05')['id'].tolist(), [3, 4, 5])
+
+        # nothing to do the second time
+        self.assertEqual(compaction.compact(layers=['trusted'], tables=['deposit']), {})
+        self.assertIsNone(compaction.compact_month('deposit', 'trusted', '2023-01'))
+
+    def test_daily_files_written_later_win(self):
+        for day, ids in [(1, [1, 2]), (2, [3])]:
+            self.write_deposits(day, ids)
+        compaction.compact_month('deposit', 'trusted', '2023-01')
+
+        # late arriving rows are merged into the compacted day, in a new daily file
+        late_df = pd.DataFrame({
+            'id': [4], 'event_timestamp': ['2023-01-01 11:00:00'], 'user_id': ['user4'], 'amount': [40.0],
+            'currency': ['usd'], 'tx_status': ['complete']
+        })
+        c.route_late_arriving_rows(late_df, datetime(2023, 1, 2), 'deposit', ['id'])
+        self.assertEqual(self.deposit_ids(1), [1, 2, 4])
+        self.assertEqual(compaction.read_range('deposit', 'trusted', '2023-01-01', '2023-01-02')['id'].tolist(), [1, 2, 4, 3])
+
+        self.assertEqual(compaction.compact_month('deposit', 'trusted', '2023-01'), {'days': 2, 'rows': 4})
+        self.assertFalse(os.path.exists('data-lake/trusted/deposit/2023-01-01'))
+        self.assertEqual(self.deposit_ids(1), [1, 2, 4])
+        self.assertEqual(self.deposit_ids(2), [3])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,125 +1,399 @@
 import pandas as pd
+import io
+import os
+import json
+import time
+import fcntl
+import gzip
+from contextlib import contextmanager
+import memory
+from dataclasses import dataclass, field
 from datetime import datetime
 
+# Compression codec applied when writing files to each data lake layer: 'gzip', 'zstd' or None (plain csv).
+# 'zstd' requires the zstandard package. Readers don't depend on this setting, the codec of an existing
+# file is detected from its extension, so a layer can be switched without rewriting old partitions.
+layer_compression = {
+    'raw': None,
+    'trusted': None,
+    'curated': None,
+    'quarantine': None
+}
+
+compression_extensions = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst'
+}
+
+# Number of rows of the destination table read at a time when merging a daily increment into a curated fact table.
+# None merges in memory, reading the whole table. With a chunk size, memory is bounded by the chunk plus the increment
+# (see load.merge_curated_table_in_chunks), for facts that don't fit in memory.
+merge_chunk_rows = None
+
+def set_merge_chunk_rows(rows):
+    global merge_chunk_rows
+    merge_chunk_rows = rows
+
+def set_layer_compression(layer, codec):
+    if codec not in compression_extensions:
+        raise ValueError(f"Unsupported compression codec: {codec}")
+    layer_compression[layer] = codec
+
+def layer_file_extension(layer):
+    return compression_extensions[layer_compression.get(layer)]
 
 def data_lake_file_path(table_name, layer, date):
     date_str = date.strftime('%Y-%m-%d')
-    return 'data-lake/' + layer + '/' + table_name + '/' + date_str + '/' + table_name + '.csv'
+    return 'data-lake/' + layer + '/' + table_name + '/' + date_str + '/' + table_name + '.csv' + layer_file_extension(layer)
 
-def load_csv_to_dataframe(table_name, layer, date, schema):
-    path = data_lake_file_path(table_name, layer, date)
+def curated_file_path(table_name):
+    return 'data-lake/curated/' + table_name + '.csv' + layer_file_extension('curated')
 
-def create_empty_dataframe(schema):
-    # Initialize an empty DataFrame with the specified column names and types
-    schema = {col: ('datetime64[ns]' if col_type == pd.Timestamp else col_type) for col, col_type in schema.items()}
-    df = pd.DataFrame({col: pd.Series(dtype=col_type) for col, col_type in schema.items()})
-    return df
+def uncompressed_file_path(path):
+    for extension in compression_extensions.values():
+        if extension and path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+def resolve_file_path(path):
+    """
+    Returns the existing file for path, regardless of the codec it was written with, or None if there is no file.
+    The path given is tried first, so files written with the current layer codec win over older copies.
+    """
+    if os.path.isfile(path):
+        return path
+    base_path = uncompressed_file_path(path)
+    for extension in compression_extensions.values():
+        if os.path.isfile(base_path + extension):
+            return base_path + extension
+    return None
+
+def read_csv(path, **kwargs):
+    # pandas infers the compression from the file extension, days of compacted partitions are read from their month
+    resolved_path = resolve_file_path(path)
+    try:
+        if resolved_path is not None or compacted_day(path) is None:
+            return pd.read_csv(resolved_path or path, **kwargs)
+    except FileNotFoundError:
+        # removed by a compaction since it was resolved
+        if compacted_day(path) is None:
+            raise
+    return pd.read_csv(io.BytesIO(read_compacted_days(path, path)), **kwargs)
+
+# Compacted partitions (see compaction.py): the daily files of a month of a raw or trusted table can be merged into
+# <layer>/<table>/<YYYY-MM>.csv, the header and then the rows of each day in date order, compressed on their own like
+# the blocks of block_index.py. A sidecar index (<YYYY-MM>.csv.days.json) records the byte and row range of each day
+# and the version of the file. A daily file written after the compaction (a reprocessed day, late arriving rows)
+# wins over the day in the monthly file, until the next compaction folds it in.
+
+def partition_date(path):
+    # date string of a daily partition path of the raw or trusted layer, None for other paths
+    date_str = os.path.basename(os.path.dirname(path))
+    try:
+        datetime.strptime(date_str, '%Y-%m-%d')
+    except ValueError:
+        return None
+    return date_str
+
+def monthly_file_path(path):
+    # monthly file (without codec extension, see resolve_file_path) of the daily partition at path
+    table_dir = os.path.dirname(os.path.dirname(path))
+    return table_dir + '/' + partition_date(path)[:7] + '.csv'
+
+def compacted_index_path(month_path):
+    return uncompressed_file_path(month_path) + '.days.json'
+
+def read_compacted_index(month_path):
+    # index of a monthly file, None if the month wasn't compacted
+    index_path = compacted_index_path(month_path)
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path) as index_file:
+        return json.load(index_file)
+
+def compacted_day(path):
+    """
+    Index entry (byte and row range) of the day of a daily partition in its monthly file, None if it isn't there.
+    """
+    if partition_date(path) is None:
+        return None
+    index = read_compacted_index(monthly_file_path(path))
+    return index['days'].get(partition_date(path)) if index is not None else None
+
+def read_compacted_days(first_path, last_path, attempts=10):
+    """
+    Decompressed csv, header included, of the compacted days of a month from the day of the daily partition at
+    first_path to the one at last_path, read at once (days are stored in date order). None if the month wasn't
+    compacted. The index is read again when the file is being replaced by a compaction.
+    """
+    month_path = monthly_file_path(first_path)
+    first_date, last_date = partition_date(first_path), partition_date(last_path)
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(0.05)
+        index = read_compacted_index(month_path)
+        if index is None:
+            return None
+        days = [day for date_str, day in index['days'].items() if first_date <= date_str <= last_date]
+        data_path = os.path.join(os.path.dirname(month_path), index['path'])
+        try:
+            with open(data_path, 'rb') as month_file:
+                stat = os.fstat(month_file.fileno())
+                if [stat.st_size, stat.st_mtime_ns] != index['version']:
+                    continue
+                start = min((day['offset'] for day in days), default=0)
+                month_file.seek(start)
+                data = month_file.read(max((day['offset'] + day['length'] for day in days), default=0) - start)
+        except FileNotFoundError:
+            continue
+        return index['header'].encode('utf-8') + decompress_bytes(data, file_codec(data_path))
+    raise RuntimeError(f"Monthly file {month_path} keeps changing while it's read")
 
-def user_level_pk():
-    # pk is being assumed in this case, we would need more information to properly handle duplicates here
-    # we saw there are duplicates in the data, for the same user, jurisdiction and timestamp, there are different levels
-    # we would need more information to handle this, so we are assuming we can just arbritarily drop one of the rows
-    # so, we are keeping the last valid row in the drop_duplicates
-    # improvement: implement a business rule to keep the best row, or review the PK definition
-    return ['user_id', 'jurisdiction', 'event_timestamp'] 
+def partition_exists(path):
+    # a daily file or a compacted day
+    return resolve_file_path(path) is not None or compacted_day(path) is not None
 
-def user_level_table_name():
-    return 'user_level'
+def write_csv(df, path):
+    """
+    Writes df to path (compression inferred from the extension) and removes copies of the same file written
+    with another codec, so readers never pick a stale version.
+    """
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    df.to_csv(path, index=False)
+    remove_other_codec_copies(path)
 
-def user_level_schema():
-    schema = {
+def write_csv_chunks(chunks, path):
+    """
+    Streams an iterable of DataFrames to a single csv file at path, with the header of the first one. The file is
+    written to a temporary path and renamed at the end, so chunks can be read from the previous version of the file.
+    """
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    temporary_path = path + '.tmp'
+    with open_text_file(temporary_path, 'w') as handle:
+        header = True
+        for chunk in chunks:
+            chunk.to_csv(handle, index=False, header=header)
+            header = False
+
+    os.replace(temporary_path, path)
+    remove_other_codec_copies(path)
+
+def open_text_file(path, mode):
+    # codec of the final file (the temporary path has an extra suffix)
+    final_path = path[:-len('.tmp')] if path.endswith('.tmp') else path
+    if final_path.endswith(compression_extensions['gzip']):
+        return gzip.open(path, mode + 't', newline='')
+    if final_path.endswith(compression_extensions['zstd']):
+        import zstandard
+        return zstandard.open(path, mode + 't', newline='')
+    return open(path, mode, newline='')
+
+def sample_row_bytes(path, sample_bytes=1024 * 1024):
+    # average size of the lines in the first sample_bytes of a (decompressed) file
+    with open_text_file(path, 'r') as sample_file:
+        sample = sample_file.read(sample_bytes)
+    return max(1, len(sample.encode('utf-8')) / max(1, sample.count('\n')))
+
+def remove_other_codec_copies(path):
+    base_path = uncompressed_file_path(path)
+    for extension in compression_extensions.values():
+        if base_path + extension != path and os.path.isfile(base_path + extension):
+            os.remove(base_path + extension)
+
+def compress_bytes(data, codec):
+    if codec is None:
+        return data
+    if codec == 'gzip':
+        return gzip.compress(data)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+def decompress_bytes(data, codec):
+    # also reads concatenated gzip members / zstd frames
+    if codec is None:
+        return data
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    if codec == 'zstd':
+        import zstandard
+        with zstandard.ZstdDecompressor().stream_reader(data, read_across_frames=True) as reader:
+            return reader.read()
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+def file_codec(path):
+    # codec of a file, from its extension
+    for codec, extension in compression_extensions.items():
+        if extension and path.endswith(extension):
+            return codec
+    return None
+
+@dataclass(frozen=True)
+class TableSpec:
+    """
+    Declarative definition of a table in the data lake.
+    name         -> table (and folder/file) name
+    schema       -> column types, timestamps are declared as pd.Timestamp
+    primary_keys -> columns that identify a row, used to deduplicate
+    partitioning -> 'daily' for one file per date (<layer>/<table>/<date>/<table>.csv) or None for a single file
+    layers       -> data lake layers where the table is stored
+    format       -> file format, only csv for now (compression is set per layer, see layer_compression)
+    encodings    -> in-memory dtype for some columns when reading, e.g. 'category' for low cardinality strings
+    date_column  -> column used to replace the rows of a date when a curated table is reloaded
+    id_index     -> keep a persistent index of the accepted ids (single int64 primary key), so cleanup rejects ids
+                    re-sent on a later day (see id_index.py)
+    """
+    name: str
+    schema: dict
+    primary_keys: list
+    partitioning: str = 'daily'
+    layers: tuple = ('raw', 'trusted')
+    format: str = 'csv'
+    encodings: dict = field(default_factory=dict)
+    date_column: str = None
+    id_index: bool = False
+
+    def file_path(self, layer, date=None):
+        if self.partitioning == 'daily' and layer != 'curated':
+            return data_lake_file_path(self.name, layer, date)
+        return curated_file_path(self.name)
+
+    def timestamp_columns(self):
+        return [col for col, col_type in self.schema.items() if col_type == pd.Timestamp]
+
+    def dtypes(self, columns=None):
+        """
+        Explicit dtypes to read the columns, so pandas doesn't need to infer them.
+        """
+        dtypes = {str: str, int: 'int64', float: 'float64', bool: 'bool'}
+        columns = columns or list(self.schema.keys())
+        return {col: self.encodings.get(col, dtypes[self.schema[col]]) for col in columns if self.schema[col] != pd.Timestamp}
+
+
+# user_level pk is being assumed in this case, we would need more information to properly handle duplicates here
+# we saw there are duplicates in the data, for the same user, jurisdiction and timestamp, there are different levels
+# we would need more information to handle this, so we are assuming we can just arbritarily drop one of the rows
+# so, we are keeping the last valid row in the drop_duplicates
+# improvement: implement a business rule to keep the best row, or review the PK definition
+USER_LEVEL = TableSpec(
+    name='user_level',
+    schema={
         'user_id': str,
-        'jurisdiction': str, 
+        'jurisdiction': str,
         'level': int,
         'event_timestamp': pd.Timestamp
-    }
-    return schema
+    },
+    primary_keys=['user_id', 'jurisdiction', 'event_timestamp'],
+    layers=('raw', 'trusted', 'curated'),
+    date_column='event_timestamp'
+)
 
-def withdrawal_pk():
-    return ['id']
-
-def withdrawal_table_name():
-    return 'withdrawal'
-
-def withdrawal_schema():
-    schema = {
+WITHDRAWAL = TableSpec(
+    name='withdrawal',
+    schema={
         'id': int,
-        'event_timestamp': pd.Timestamp, 
+        'event_timestamp': pd.Timestamp,
         'user_id': str,
         'amount': float,
         'interface': str,
         'currency': str,
         'tx_status': str
-    }
-    return schema
-
-def user_id_pk():
-    return ['user_id']
-
-def user_id_table_name():
-    return 'user_id'
+    },
+    primary_keys=['id'],
+    layers=('raw', 'trusted', 'curated'),
+    date_column='event_timestamp',
+    id_index=True
+)
 
-def user_id_schema():
-    schema = {
+USER_ID = TableSpec(
+    name='user_id',
+    schema={
         'user_id': str
-    }
-    return schema;
+    },
+    primary_keys=['user_id']
+)
 
-def event_pk():
-    return ['id']
-
-def event_table_name():
-    return 'event'
-
-def event_schema():
-    schema = {
+EVENT = TableSpec(
+    name='event',
+    schema={
         'id': int,
-        'event_timestamp': pd.Timestamp, 
+        'event_timestamp': pd.Timestamp,
         'user_id': str,
         'event_name': str
-    }
-    return schema
-
-def deposit_pk():
-    return ['id']
+    },
+    primary_keys=['id'],
+    encodings={'event_name': 'category'}
+)
 
-def deposit_table_name():
-    return 'deposit'
-
-def deposit_schema():
-    schema = {
+DEPOSIT = TableSpec(
+    name='deposit',
+    schema={
         'id': int,
-        'event_timestamp': pd.Timestamp, 
+        'event_timestamp': pd.Timestamp,
         'user_id': str,
         'amount': float,
         'currency': str,
         'tx_status': str
-    }
-    return schema
+    },
+    primary_keys=['id'],
+    layers=('raw', 'trusted', 'curated'),
+    date_column='event_timestamp',
+    id_index=True
+)
 
-def dim_user_table_name():
-    return 'dim_user'
+DIM_USER = TableSpec(
+    name='dim_user',
+    schema={
+        'user_id': str,
+        'last_login': pd.Timestamp
+    },
+    primary_keys=['user_id'],
+    partitioning=None,
+    layers=('curated',)
+)
 
-def fact_user_daily_snapshot_name():
-    return 'user_daily_snapshot'
+# type 2 history of dim_user (optional, see load.set_dim_user_history): a row per value of last_login of each user,
+# valid from the load date it took it until the next one (valid_to is empty for the current value)
+DIM_USER_HISTORY = TableSpec(
+    name='dim_user_history',
+    schema={
+        'user_id': str,
+        'last_login': pd.Timestamp,
+        'valid_from': pd.Timestamp,
+        'valid_to': pd.Timestamp
+    },
+    primary_keys=['user_id', 'valid_from'],
+    partitioning=None,
+    layers=('curated',)
+)
 
-def fact_user_daily_snapshot_schema():
-    schema = {
+FACT_USER_DAILY_SNAPSHOT = TableSpec(
+    name='user_daily_snapshot',
+    schema={
         'user_id': str,
-        'date': pd.Timestamp, 
+        'date': pd.Timestamp,
         'qty_deposits': int,
         'qty_withdrawals': int,
         'qty_logins': int,
         'is_active': bool
-    }
-    return schema
-
-def fact_daily_stats_name():
-    return 'daily_stats'
+    },
+    primary_keys=['user_id', 'date'],
+    partitioning=None,
+    layers=('curated',),
+    date_column='date'
+)
 
-def fact_daily_stats_schema():
-    schema = {
-        'date': pd.Timestamp, 
+FACT_DAILY_STATS = TableSpec(
+    name='daily_stats',
+    schema={
+        'date': pd.Timestamp,
         'currency': str,
         'level': int,
         'jurisdiction': str,
@@ -128,6 +402,161 @@ def fact_daily_stats_schema():
         'total_distinct_deposit_users': int,
         'total_withdrawal_amount': float,
         'total_deposit_amount': float,
-    }
-    return schema
+        'active_users_sketch': str,
+        'withdrawal_users_sketch': str,
+        'deposit_users_sketch': str
+    },
+    primary_keys=['date', 'currency', 'level', 'jurisdiction'],
+    partitioning=None,
+    layers=('curated',),
+    date_column='date'
+)
+
+# all tables, source tables are listed in the order they are cleaned
+TABLES = {spec.name: spec for spec in [USER_LEVEL, WITHDRAWAL, USER_ID, EVENT, DEPOSIT, DIM_USER, DIM_USER_HISTORY, FACT_USER_DAILY_SNAPSHOT, FACT_DAILY_STATS]}
+
+def table_spec(table_name):
+    return TABLES[table_name]
+
+def source_tables():
+    # tables extracted to raw and cleaned into trusted layer
+    return [spec for spec in TABLES.values() if 'raw' in spec.layers]
+
+def load_csv_to_dataframe(table_name, layer, date=None, columns=None):
+    """
+    Typed reader for data lake tables: reads only the given columns (all by default) with explicit dtypes
+    and parses timestamp columns. Returns an empty DataFrame with the same columns if the file doesn't exist.
+    """
+    spec = table_spec(table_name)
+    columns = columns or list(spec.schema.keys())
+    path = spec.file_path(layer, date)
+
+    if not partition_exists(path):
+        return empty_table_dataframe(table_name, columns)
+
+    df = read_csv(path, usecols=columns, dtype=spec.dtypes(columns))
+    return memory.fit(parse_timestamp_columns(df, spec, columns))
+
+def empty_table_dataframe(table_name, columns=None):
+    # empty DataFrame with the columns and dtypes of the typed readers
+    spec = table_spec(table_name)
+    columns = columns or list(spec.schema.keys())
+    df = create_empty_dataframe({col: spec.schema[col] for col in columns})
+    for col, dtype in spec.dtypes(columns).items():
+        df[col] = df[col].astype(dtype)
+    return df
+
+def load_csv_chunks(table_name, layer, date=None, columns=None, chunksize=100000):
+    """
+    Same as load_csv_to_dataframe, yielding typed DataFrames of at most chunksize rows. Yields nothing if the file doesn't exist.
+    """
+    spec = table_spec(table_name)
+    columns = columns or list(spec.schema.keys())
+    path = spec.file_path(layer, date)
+
+    if not partition_exists(path):
+        return
+
+    with read_csv(path, usecols=columns, dtype=spec.dtypes(columns), chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield memory.fit(parse_timestamp_columns(chunk, spec, columns))
+
+def predicate_columns(predicates):
+    # columns read by filter predicates of the backends, (column, op, value) tuples or lists of them
+    columns = []
+    for predicate in predicates:
+        for column, _, _ in (predicate if isinstance(predicate, list) else [predicate]):
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+def parse_timestamp_columns(df, spec, columns):
+    for col in spec.timestamp_columns():
+        if col in columns:
+            # trusted timestamps are normalized and curated ones are written by pandas, both in ISO format
+            df[col] = pd.to_datetime(df[col], format='ISO8601')
+    return df[columns]
+
+def create_empty_dataframe(schema):
+    # Initialize an empty DataFrame with the specified column names and types
+    schema = {col: ('datetime64[ns]' if col_type == pd.Timestamp else col_type) for col, col_type in schema.items()}
+    df = pd.DataFrame({col: pd.Series(dtype=col_type) for col, col_type in schema.items()})
+    return df
+
+def late_arrivals_table_name():
+    return '_late_arrivals'
+
+LOCKS_DIR = 'data-lake/_locks'
+
+@contextmanager
+def file_lock(name):
+    """
+    Exclusive lock between processes (e.g. workers of work_queue cleaning several tables of a batch at once).
+    """
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    with open(os.path.join(LOCKS_DIR, name + '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def save_batch_manifest(manifest_name, layer, batch_date, table_name, manifest_df):
+    """
+    Saves the rows of a table in a per batch manifest (e.g. late arrivals, quarantine counters), where each table
+    has its own rows. Rows previously recorded for the same table and batch are replaced, so reprocessing a batch is idempotent.
+    """
+    manifest_path = data_lake_file_path(manifest_name, layer, batch_date)
+    manifest_df = manifest_df.assign(table_name=table_name)
+
+    # tables of a batch may be cleaned at the same time by different processes, each rewriting the manifest
+    with file_lock(manifest_name + '-' + batch_date.strftime('%Y-%m-%d')):
+        if resolve_file_path(manifest_path) is not None:
+            existing_df = read_csv(manifest_path)
+            existing_df = existing_df[existing_df['table_name'] != table_name]
+            manifest_df = pd.concat([existing_df, manifest_df], ignore_index=True)
+        elif manifest_df.empty:
+            # nothing to record, avoid creating one manifest per batch
+            return
+
+        write_csv(manifest_df, manifest_path)
+
+def save_late_arrivals(batch_date, table_name, late_dates):
+    """
+    Records, for a batch date, the earlier event dates of a table that received late arriving rows.
+    """
+    manifest_df = pd.DataFrame({'event_date': [date.strftime('%Y-%m-%d') for date in late_dates]})
+    save_batch_manifest(late_arrivals_table_name(), 'trusted', batch_date, table_name, manifest_df)
+
+def read_late_arrivals(batch_date):
+    """
+    Returns a dictionary with the event dates that received late arriving rows in the batch, for each table.
+    """
+    manifest_path = data_lake_file_path(late_arrivals_table_name(), 'trusted', batch_date)
+    if resolve_file_path(manifest_path) is None:
+        return {}
+
+    manifest_df = read_csv(manifest_path)
+    late_arrivals = {}
+    for table_name, dates in manifest_df.groupby('table_name')['event_date']:
+        late_arrivals[table_name] = sorted(datetime.strptime(date, '%Y-%m-%d') for date in dates)
+    return late_arrivals
+
+def quarantine_counters_table_name():
+    return '_counters'
+
+def save_quarantine_counters(batch_date, table_name, counters):
+    """
+    Records how many rows of a table were rejected by cleanup in a batch, for each reason.
+    """
+    counters_df = pd.DataFrame({
+        'reason': pd.Series(list(counters.keys()), dtype=object),
+        'rows': pd.Series(list(counters.values()), dtype='int64')
+    })
+    save_batch_manifest(quarantine_counters_table_name(), 'quarantine', batch_date, table_name, counters_df)
 
+def read_quarantine_counters(batch_date):
+    counters_path = data_lake_file_path(quarantine_counters_table_name(), 'quarantine', batch_date)
+    if resolve_file_path(counters_path) is None:
+        return pd.DataFrame({'reason': pd.Series(dtype=str), 'rows': pd.Series(dtype='int64'), 'table_name': pd.Series(dtype=str)})
+    return read_csv(counters_path)
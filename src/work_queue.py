@@ -0,0 +1,383 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+import pandas as pd
+import util
+import extract_daily_batches as e
+import cleanup as c
+import load as l
+import etl
+import sampling
+
+# Work queue on a shared filesystem to run the pipeline of a date range (e.g. a backfill) on several processes or
+# machines. A coordinator splits the (stage, table, date) work units of etl.plan_work_units into unit files, and
+# workers claim them by moving the file from pending/ to leased/ (a rename is atomic, so only one worker gets it).
+# A worker keeps touching its lease file while it runs the unit (heartbeat) and moves it to done/ when finished;
+# leases not touched for lease_seconds (a dead worker) are moved back to pending/ by the coordinator.
+# Load units are split: workers generate the increment of a curated table for a date into staging/, and the
+# coordinator merges the increments into the curated layer, a single committer in date order, so the result is the
+# same as a serial run. Units are only queued once the units they depend on are done:
+# - cleanup of a table is serial by date: a batch routes late rows to earlier partitions and checks the id index,
+# - increments of a batch read the trusted partitions as they are after its cleanup, so the cleanup of the next
+#   date waits for them (and for the commit, for tables the committer reads),
+# - daily_stats reads the curated user_level, it's generated by the committer.
+# Units may run twice (a lease expiring while the worker is alive), every stage overwrites its outputs.
+QUEUE_DIR = 'data-lake/_queue'
+STATES = ['pending', 'leased', 'done', 'failed']
+LEASE_SECONDS = 60
+HEARTBEAT_SECONDS = 5
+POLL_SECONDS = 0.2
+
+# load steps generated by the committer, since they read curated tables
+COMMITTER_STEPS = [l.load_fact_daily_stats]
+
+
+def state_dir(queue_dir, state):
+    return os.path.join(queue_dir, state)
+
+def unit_path(queue_dir, state, unit_id):
+    return os.path.join(queue_dir, state, unit_id + '.json')
+
+def staging_path(queue_dir, unit_id):
+    return os.path.join(queue_dir, 'staging', unit_id + '.pkl')
+
+def write_json(path, content):
+    # written aside and renamed, readers never see a partial file
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as file:
+        json.dump(content, file)
+    os.replace(temporary_path, path)
+
+def read_json(path):
+    with open(path) as file:
+        return json.load(file)
+
+def create_queue(queue_dir, settings):
+    """
+    Creates an empty queue (removing a previous one) with the process_etl settings the workers apply.
+    """
+    shutil.rmtree(queue_dir, ignore_errors=True)
+    for name in STATES + ['staging']:
+        os.makedirs(os.path.join(queue_dir, name))
+    write_json(os.path.join(queue_dir, 'queue.json'), {'settings': settings})
+
+def close_queue(queue_dir):
+    # workers exit once the queue is closed
+    open(os.path.join(queue_dir, 'closed'), 'w').close()
+
+def is_closed(queue_dir):
+    return os.path.exists(os.path.join(queue_dir, 'closed'))
+
+def date_str(date):
+    return date.strftime('%Y-%m-%d') if date is not None else None
+
+def enqueue(queue_dir, sequence, stage, table_name, date=None, **fields):
+    """
+    Adds a unit to pending/ and returns its id. Ids start with the sequence number, workers claim units in order.
+    """
+    unit_id = '-'.join([f'{sequence:06d}', stage, table_name] + ([date_str(date)] if date is not None else []))
+    unit = dict(id=unit_id, stage=stage, table=table_name, date=date_str(date), **fields)
+    write_json(unit_path(queue_dir, 'pending', unit_id), unit)
+    return unit_id
+
+def unit_state(queue_dir, unit_id):
+    for state in STATES:
+        if os.path.exists(unit_path(queue_dir, state, unit_id)):
+            return state
+    return None
+
+def claim(queue_dir):
+    """
+    Leases the first pending unit, returns it or None if there are no pending units.
+    """
+    for name in sorted(os.listdir(state_dir(queue_dir, 'pending'))):
+        if not name.endswith('.json'):
+            continue
+        pending_path = os.path.join(state_dir(queue_dir, 'pending'), name)
+        try:
+            # the lease starts now (a rename keeps the modification time), then only one worker wins the rename
+            os.utime(pending_path)
+            os.rename(pending_path, os.path.join(state_dir(queue_dir, 'leased'), name))
+        except FileNotFoundError:
+            # claimed by another worker
+            continue
+        return read_json(os.path.join(state_dir(queue_dir, 'leased'), name))
+    return None
+
+def heartbeat(queue_dir, unit_id):
+    # extends the lease, False if it was lost (expired and re-queued)
+    try:
+        os.utime(unit_path(queue_dir, 'leased', unit_id))
+        return True
+    except FileNotFoundError:
+        return False
+
+def release(queue_dir, unit_id, state='done', error=None):
+    """
+    Moves a leased unit to done/ or failed/. Returns False if the lease was lost, the unit runs again elsewhere.
+    """
+    leased_path = unit_path(queue_dir, 'leased', unit_id)
+    try:
+        if error is not None:
+            unit = read_json(leased_path)
+            write_json(leased_path, dict(unit, error=error))
+        os.rename(leased_path, unit_path(queue_dir, state, unit_id))
+        return True
+    except FileNotFoundError:
+        return False
+
+def requeue_expired(queue_dir, lease_seconds=LEASE_SECONDS):
+    """
+    Moves units whose lease wasn't extended in lease_seconds back to pending/, returns their ids.
+    """
+    expired = []
+    now = time.time()
+    for name in sorted(os.listdir(state_dir(queue_dir, 'leased'))):
+        leased_path = os.path.join(state_dir(queue_dir, 'leased'), name)
+        try:
+            if not name.endswith('.json') or os.path.getmtime(leased_path) > now - lease_seconds:
+                continue
+            os.rename(leased_path, os.path.join(state_dir(queue_dir, 'pending'), name))
+        except FileNotFoundError:
+            # released meanwhile
+            continue
+        expired.append(name[:-len('.json')])
+        print('Re-queued expired unit ' + expired[-1])
+    return expired
+
+
+def apply_settings(settings):
+    for layer, codec in (settings.get('compression') or {}).items():
+        util.set_layer_compression(layer, codec)
+    l.set_aggregation_engine(settings.get('aggregation_engine', 'default'))
+    l.set_backend(settings.get('backend', 'pandas'))
+    l.set_dim_user_history(settings.get('dim_user_history', False))
+    sampling.set_fraction(settings.get('sample_fraction'))
+
+def load_step(table_name):
+    return {table: step for step, (table, _) in l.load_step_tables().items()}[table_name]
+
+def run_unit(queue_dir, unit):
+    date = datetime.strptime(unit['date'], '%Y-%m-%d') if unit['date'] is not None else None
+    if unit['stage'] == 'extract':
+        e.extract(datetime.strptime(unit['start_date'], '%Y-%m-%d'), datetime.strptime(unit['end_date'], '%Y-%m-%d'), [unit['table']])
+    elif unit['stage'] == 'cleanup':
+        c.cleanup(date, date, [unit['table']])
+    elif unit['stage'] == 'generate':
+        increment = l.load_step_generators()[load_step(unit['table'])](date)
+        path = staging_path(queue_dir, unit['id'])
+        l.backend.to_pandas(increment).to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+    else:
+        raise ValueError(f"Unknown stage: {unit['stage']}")
+
+def run_leased_unit(queue_dir, unit, heartbeat_seconds):
+    # runs the unit while a thread extends its lease
+    stop = threading.Event()
+
+    def keep_lease():
+        while not stop.wait(heartbeat_seconds):
+            if not heartbeat(queue_dir, unit['id']):
+                print('Lost the lease of ' + unit['id'])
+                return
+
+    thread = threading.Thread(target=keep_lease, daemon=True)
+    thread.start()
+    try:
+        run_unit(queue_dir, unit)
+    finally:
+        stop.set()
+        thread.join()
+
+def run_worker(queue_dir=QUEUE_DIR, worker_id=None, heartbeat_seconds=HEARTBEAT_SECONDS, poll_seconds=POLL_SECONDS):
+    """
+    Claims and runs units until the queue is closed, returns the number of units run. The data lake and the queue
+    are relative to the current directory, every worker runs in the same (shared) directory.
+    """
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+    while not os.path.exists(os.path.join(queue_dir, 'queue.json')):
+        time.sleep(poll_seconds)
+    apply_settings(read_json(os.path.join(queue_dir, 'queue.json'))['settings'])
+
+    units_run = 0
+    while True:
+        unit = claim(queue_dir)
+        if unit is None:
+            if is_closed(queue_dir):
+                return units_run
+            time.sleep(poll_seconds)
+            continue
+
+        print(f"Worker {worker_id} running {unit['id']}")
+        try:
+            run_leased_unit(queue_dir, unit, heartbeat_seconds)
+        except Exception:
+            release(queue_dir, unit['id'], 'failed', traceback.format_exc())
+            continue
+        release(queue_dir, unit['id'])
+        units_run += 1
+
+
+def new_coordinator(queue_dir=QUEUE_DIR, lease_seconds=LEASE_SECONDS, poll_seconds=POLL_SECONDS):
+    # state of the coordinator: units queued (the sequence of the next unit id) and leases re-queued
+    return {'queue_dir': queue_dir, 'lease_seconds': lease_seconds, 'poll_seconds': poll_seconds, 'sequence': 0, 'requeued': 0}
+
+def queue_unit(coordinator, stage, table_name, date=None, **fields):
+    coordinator['sequence'] += 1
+    return enqueue(coordinator['queue_dir'], coordinator['sequence'], stage, table_name, date, **fields)
+
+def wait(coordinator, unit_ids):
+    # waits until the units are done, re-queuing expired leases meanwhile
+    queue_dir = coordinator['queue_dir']
+    remaining = list(unit_ids)
+    while remaining:
+        states = {unit_id: unit_state(queue_dir, unit_id) for unit_id in remaining}
+        failed = [unit_id for unit_id, state in states.items() if state == 'failed']
+        if failed:
+            error = read_json(unit_path(queue_dir, 'failed', failed[0])).get('error')
+            raise RuntimeError(f'Work unit {failed[0]} failed:\n{error}')
+        remaining = [unit_id for unit_id, state in states.items() if state != 'done']
+        if remaining:
+            coordinator['requeued'] += len(requeue_expired(queue_dir, coordinator['lease_seconds']))
+            time.sleep(coordinator['poll_seconds'])
+
+def batch_steps(batch_date, tables=None):
+    # (date, load step) of a batch in the order load() runs them: recomputations of late arriving data first
+    selected_steps = l.selected_load_steps(tables)
+    plan = l.plan_late_arrivals_recomputation(batch_date, util.read_late_arrivals(batch_date))
+    late_steps = [(date, step) for date, steps in plan.items() for step in steps if step in selected_steps]
+    return late_steps + [(batch_date, step) for step in selected_steps]
+
+def generate_batch(coordinator, batch_date, tables=None):
+    # queues the increments of a batch that workers can generate and waits for them, returns the unit of each (date, step)
+    unit_ids = {}
+    for date, step in batch_steps(batch_date, tables):
+        if step not in COMMITTER_STEPS:
+            unit_ids[(date, step)] = queue_unit(coordinator, 'generate', l.load_step_tables()[step][0], date, batch_date=date_str(batch_date))
+    wait(coordinator, unit_ids.values())
+    return unit_ids
+
+def commit_batch(coordinator, batch_date, unit_ids, tables=None):
+    """
+    Merges the increments of a batch into the curated layer, in the same order as load().
+    """
+    for date, step in batch_steps(batch_date, tables):
+        if date != batch_date:
+            print('Recomputing ' + date.strftime("%Y-%m-%d") + ' due to late arriving data in ' + batch_date.strftime("%Y-%m-%d"))
+        if (date, step) not in unit_ids:
+            step(date)
+            continue
+        path = staging_path(coordinator['queue_dir'], unit_ids[(date, step)])
+        step(date, increment=l.backend.from_pandas(pd.read_pickle(path)))
+        os.remove(path)
+    l.write_load_marker(batch_date)
+
+def coordinate(coordinator, start_date, end_date, tables=None, stages=etl.STAGES):
+    """
+    Queues the units of the date range as their dependencies are done and commits the load of each date in order.
+    """
+    units = etl.plan_work_units(start_date, end_date, tables, stages)
+    cleanup_tables = {table_name for stage, table_name, _ in units if stage == 'cleanup'}
+    # trusted tables read by the steps generated in the committer, their next cleanup waits for the commit
+    committer_tables = {source for step in COMMITTER_STEPS for source in l.load_step_tables()[step][1]} & cleanup_tables
+
+    wait(coordinator, [queue_unit(coordinator, 'extract', table_name, start_date=date_str(start_date), end_date=date_str(end_date))
+                       for stage, table_name, _ in units if stage == 'extract'])
+
+    def queue_cleanup(date, table_names):
+        if date > end_date:
+            return []
+        return [queue_unit(coordinator, 'cleanup', table_name, date) for table_name in sorted(table_names)]
+
+    cleanup_ids = queue_cleanup(start_date, cleanup_tables)
+    current_date = start_date
+    while current_date <= end_date:
+        wait(coordinator, cleanup_ids)
+        next_date = current_date + timedelta(days=1)
+        if 'load' not in stages:
+            cleanup_ids = queue_cleanup(next_date, cleanup_tables)
+        else:
+            unit_ids = generate_batch(coordinator, current_date, tables)
+            # the next cleanup of the other tables runs while the batch is committed
+            cleanup_ids = queue_cleanup(next_date, cleanup_tables - committer_tables)
+            commit_batch(coordinator, current_date, unit_ids, tables)
+            cleanup_ids += queue_cleanup(next_date, committer_tables)
+        current_date = next_date
+
+def run_coordinator(start_date, end_date, tables=None, stages=etl.STAGES, queue_dir=QUEUE_DIR, lease_seconds=LEASE_SECONDS,
+                    compression=None, aggregation_engine='default', backend='pandas', dim_user_history=False,
+                    sample_fraction=None):
+    """
+    Runs the pipeline of the date range on the workers of the queue, committing the curated layer in this process.
+    Settings are the same as process_etl, applied here and in the workers. Returns the state of the coordinator.
+    """
+    settings = {'compression': compression, 'aggregation_engine': aggregation_engine, 'backend': backend, 'dim_user_history': dim_user_history,
+                'sample_fraction': sample_fraction}
+    apply_settings(settings)
+    create_queue(queue_dir, settings)
+    coordinator = new_coordinator(queue_dir, lease_seconds)
+    try:
+        coordinate(coordinator, start_date, end_date, tables, stages)
+    finally:
+        close_queue(queue_dir)
+    return coordinator
+
+def run_local(start_date, end_date, workers=2, tables=None, stages=etl.STAGES, queue_dir=QUEUE_DIR, **settings):
+    """
+    Runs the coordinator and worker processes on this machine.
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(queue_dir, f'local-{i}')) for i in range(workers)]
+    # a queue left by a previous run would be picked up by the workers before the coordinator replaces it
+    shutil.rmtree(queue_dir, ignore_errors=True)
+    for process in processes:
+        process.start()
+    try:
+        return run_coordinator(start_date, end_date, tables, stages, queue_dir, **settings)
+    finally:
+        for process in processes:
+            process.join()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the pipeline of a date range on workers sharing the data lake directory.')
+    parser.add_argument('role', choices=['coordinator', 'worker', 'local'])
+    parser.add_argument('--from', dest='start_date', type=etl.parse_date, default=etl.DEFAULT_START_DATE, help='first date (YYYY-MM-DD)')
+    parser.add_argument('--to', dest='end_date', type=etl.parse_date, default=etl.DEFAULT_END_DATE, help='last date (YYYY-MM-DD)')
+    parser.add_argument('--tables', type=etl.parse_list, default=None, help='comma separated tables, all by default')
+    parser.add_argument('--stages', type=etl.parse_list, default=etl.STAGES, help='comma separated stages: ' + ','.join(etl.STAGES))
+    parser.add_argument('--workers', type=int, default=2, help='worker processes of the local role')
+    parser.add_argument('--queue-dir', default=QUEUE_DIR)
+    parser.add_argument('--lease-seconds', type=float, default=LEASE_SECONDS, help='seconds without heartbeat before a unit is re-queued')
+    parser.add_argument('--compression', type=etl.parse_compression, default=None, help='codec by layer, as in etl.py')
+    parser.add_argument('--aggregation-engine', choices=l.AGGREGATION_ENGINES, default='default')
+    parser.add_argument('--backend', choices=l.BACKENDS, default='pandas')
+    parser.add_argument('--dim-user-history', action='store_true', help='keep the type 2 history of dim_user')
+    parser.add_argument('--sample', dest='sample_fraction', type=float, default=None, help='fraction of the users to extract, as in etl.py')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.role == 'worker':
+        run_worker(args.queue_dir)
+        return
+
+    settings = {'compression': args.compression, 'aggregation_engine': args.aggregation_engine, 'backend': args.backend,
+                'dim_user_history': args.dim_user_history, 'sample_fraction': args.sample_fraction}
+    if args.role == 'local':
+        coordinator = run_local(args.start_date, args.end_date, args.workers, args.tables, args.stages, args.queue_dir,
+                                lease_seconds=args.lease_seconds, **settings)
+    else:
+        coordinator = run_coordinator(args.start_date, args.end_date, args.tables, args.stages, args.queue_dir, args.lease_seconds, **settings)
+    print(f"{coordinator['sequence']} work units, {coordinator['requeued']} re-queued")
+
+
+if __name__ == '__main__':
+    main()